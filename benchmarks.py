@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+# Microbenchmarks for the routing and ring maintenance algorithms
+#
+# Like test.py, everything runs on in-process nodes, so these time the
+# algorithms in Node, not the network.  Results are written as JSON,
+# and a previous run can be passed with --compare to flag regressions.
+
+import bisect
+import json
+import optparse
+import platform
+import random
+import sys
+import time
+import timeit
+import types
+
+import dyschord
+from dyschord import compactstore
+
+
+class BenchNode(dyschord.Node) :
+  """Node recording how long each finger update takes
+
+  The finger updates only make sense as part of a join or departure,
+  so rather than calling them directly, the benchmark joins and
+  removes nodes and collects the times of the calls they make."""
+
+  timings = {"update_fingers_on_insert": [], "update_fingers_on_leave": []}
+
+  def update_fingers_on_insert(self, newnode) :
+    start = timeit.default_timer()
+    try :
+      return dyschord.Node.update_fingers_on_insert(self, newnode)
+    finally :
+      self.timings["update_fingers_on_insert"].append(
+        timeit.default_timer() - start)
+
+  def update_fingers_on_leave(self, leaving, successor_of_leaving) :
+    start = timeit.default_timer()
+    try :
+      return dyschord.Node.update_fingers_on_leave(self, leaving,
+                                                  successor_of_leaving)
+    finally :
+      self.timings["update_fingers_on_leave"].append(
+        timeit.default_timer() - start)
+
+
+def build_ring(size, nfingers, metric=None) :
+  """Build a ring of size initialized nodes with correct fingers
+
+  Joining nodes one at a time announces each to the whole ring, which
+  is quadratic, so instead the fingers are computed directly."""
+  if metric is None :
+    metric = dyschord.Md5Metric()
+  ring_size = 2**metric.hash_bits
+  nodes = {}
+  while len(nodes) < size :
+    node = BenchNode(nfingers=nfingers, metric=metric)
+    nodes[node.id] = node
+  ids = sorted(nodes)
+  ring = [nodes[i] for i in ids]
+  for i, node in enumerate(ring) :
+    node.predecessor = ring[i-1]
+    node.fingers = [ring[bisect.bisect_left(ids, (node.id + step) % ring_size)
+                         % size]
+                    for step in node.finger_steps]
+    node.initialized = True
+  return ring
+
+
+def fill(ring, nkeys, value_size=100) :
+  value = json.dumps("x" * value_size)
+  start = ring[0]
+  for i in xrange(nkeys) :
+    key = "key%d" % i
+    dyschord.find_node(start, start.hash_key(key))[key] = value
+
+
+def summarize(times) :
+  times = sorted(times)
+  n = len(times)
+  return {"reps": n,
+          "mean": sum(times) / n,
+          "min": times[0],
+          "median": times[n//2],
+          "p90": times[min(n-1, int(0.9*n))],
+          "max": times[-1]}
+
+
+def time_calls(function, args_list, batch=10, repeat=3) :
+  """Time per call of function over args_list
+
+  A single call takes about as long as the timer's resolution, so the
+  calls are timed in batches of batch, each the best of repeat runs,
+  and divided by the number of calls.  Returns one time per batch."""
+  times = []
+  for i in xrange(0, len(args_list), batch) :
+    chunk = args_list[i:i + batch]
+    def calls() :
+      for args in chunk :
+        function(*args)
+    timer = timeit.Timer(calls)
+    times.append(min(timer.repeat(repeat, 1)) / len(chunk))
+  return times
+
+
+def random_hashes(n) :
+  return [random.getrandbits(128) for i in xrange(n)]
+
+
+def bench_lookup(ring, reps) :
+  starts = [random.choice(ring) for i in xrange(reps)]
+  hashes = random_hashes(reps)
+  return {
+    "find_node": time_calls(dyschord.find_node, zip(starts, hashes)),
+    "closest_preceding_node": time_calls(
+      lambda node, key_hash : node.closest_preceding_node(key_hash),
+      zip(starts, hashes))}
+
+
+def bench_membership(ring, reps, nfingers) :
+  for times in BenchNode.timings.itervalues() :
+    del times[:]
+  joins = []
+  leaves = []
+  members = dict((node.id, node) for node in ring)
+  for i in xrange(reps) :
+    newnode = BenchNode(nfingers=nfingers)
+    if newnode.id in members :
+      continue
+    successor = dyschord.find_node(ring[0], newnode.id)
+    start = timeit.default_timer()
+    successor.prepend_node(newnode)
+    joins.append(timeit.default_timer() - start)
+    members[newnode.id] = newnode
+
+    # Leave with a different node, so the ring isn't just restored
+    leaving = random.choice([node for node in members.itervalues()
+                             if node is not ring[0]])
+    start = timeit.default_timer()
+    leaving.leave()
+    leaves.append(timeit.default_timer() - start)
+    del members[leaving.id]
+  rslt = {"prepend_node": joins, "leave": leaves}
+  for name, times in BenchNode.timings.iteritems() :
+    rslt[name] = list(times)
+  return rslt
+
+
+def bench_hash_key(reps, key_length) :
+  metric = dyschord.Md5Metric()
+  keys = [("%0" + str(key_length) + "d") % i for i in xrange(reps)]
+  return {"hash_key": time_calls(metric.hash_key, [(k,) for k in keys])}
+
+
+def deep_sizeof(obj, seen=None) :
+  """Bytes taken by obj and everything it holds, counting each object
+  once"""
+  if seen is None :
+    seen = set()
+  if id(obj) in seen or isinstance(obj, (type, types.ModuleType,
+                                         types.FunctionType,
+                                         types.MethodType,
+                                         types.BuiltinFunctionType)) :
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict) :
+    size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen)
+                for k, v in obj.iteritems())
+  elif isinstance(obj, (list, tuple, set, frozenset)) :
+    size += sum(deep_sizeof(item, seen) for item in obj)
+  elif hasattr(obj, "__dict__") :
+    size += deep_sizeof(obj.__dict__, seen)
+  return size
+
+
+def node_memory_usage(node) :
+  # Everything the node keeps per key: the data, versions, expiry
+  # times and timers, and the Merkle tree
+  seen = set()
+  return sum(deep_sizeof(part, seen)
+             for part in (node.data, node.versions, node.expiry,
+                          node.timers, node.merkle))
+
+
+store_types = {
+  "dict": lambda metric : {},
+  "compact": lambda metric : compactstore.CompactStore(metric.hash_key)}
+
+
+def bench_store(kind, nkeys, reps, key_length=16, value_size=100) :
+  """Memory per key and lookup times of a node with each data store
+
+  Every key is stored through the node with a ttl, so the memory
+  includes its version, expiry time and timer, and its place in the
+  Merkle tree.  Returns the bytes per key, and the lookup times."""
+  metric = dyschord.Md5Metric()
+  node = dyschord.Node(metric=metric, store=store_types[kind](metric))
+  node.initialized = True
+  empty = node_memory_usage(node)
+  keys = [("%0" + str(key_length) + "d") % i for i in xrange(nkeys)]
+  for key in keys :
+    # A new value each time, as they would be when they arrive over the
+    # network
+    node.store(key, json.dumps("x" * value_size), ttl=3600)
+  bytes_per_key = float(node_memory_usage(node) - empty) / nkeys
+  sample = [(random.choice(keys),) for i in xrange(reps)]
+  return bytes_per_key, {"store_get": time_calls(node.data.__getitem__,
+                                                 sample)}
+
+
+def run(sizes, finger_sizes, key_counts, reps, membership_reps) :
+  results = []
+  def add(benchmark, times, **params) :
+    if not times :
+      return
+    entry = dict(params)
+    entry["benchmark"] = benchmark
+    entry.update(summarize(times))
+    results.append(entry)
+    sys.stderr.write("%-26s %s  median %.2f us\n"
+                     % (benchmark, params, entry["median"]*1e6))
+
+  for key_length in (8, 64, 1024) :
+    for name, times in bench_hash_key(reps, key_length).iteritems() :
+      add(name, times, key_length=key_length)
+
+  for kind in sorted(store_types) :
+    for nkeys in key_counts :
+      if not nkeys :
+        continue
+      for value_size in (10, 100, 1000) :
+        params = {"store": kind, "keys": nkeys, "value_size": value_size}
+        bytes_per_key, timings = bench_store(kind, nkeys, reps,
+                                             value_size=value_size)
+        entry = dict(params, benchmark="store_memory",
+                     bytes_per_key=bytes_per_key)
+        results.append(entry)
+        sys.stderr.write("%-26s %s  %.1f bytes per key\n"
+                         % ("store_memory", params, bytes_per_key))
+        for name, times in timings.iteritems() :
+          add(name, times, **params)
+
+  for size in sizes :
+    for nfingers in finger_sizes :
+      for nkeys in key_counts :
+        ring = build_ring(size, nfingers)
+        fill(ring, nkeys)
+        params = {"nodes": size, "fingers": nfingers, "keys": nkeys}
+        for name, times in bench_lookup(ring, reps).iteritems() :
+          add(name, times, **params)
+        if size > 1 :
+          for name, times in \
+                bench_membership(ring, membership_reps, nfingers).iteritems() :
+            add(name, times, **params)
+  return results
+
+
+def _result_key(entry) :
+  return tuple(sorted((k, v) for k, v in entry.iteritems()
+                      if k in ("benchmark", "nodes", "fingers", "keys",
+                               "key_length", "store", "value_size")))
+
+
+def compare(old, new, threshold) :
+  """List the benchmarks whose median got more than threshold slower"""
+  old_results = dict((_result_key(e), e) for e in old["results"])
+  regressions = []
+  for entry in new["results"] :
+    previous = old_results.get(_result_key(entry))
+    # Memory results have no times
+    if previous is None or "median" not in previous :
+      continue
+    if previous["median"] :
+      change = entry["median"] / previous["median"] - 1
+    else :
+      change = float("inf") if entry["median"] else 0
+    if change > threshold :
+      regressions.append((entry, previous, change))
+  return regressions
+
+
+def _int_list(value) :
+  return [int(v) for v in value.split(",") if v]
+
+
+def main(args=sys.argv) :
+  parser = optparse.OptionParser("%prog [OPTIONS]")
+  parser.add_option("--sizes", default="10,100,1000,10000",
+                    help="Comma-separated ring sizes [default: %default]")
+  parser.add_option("--fingers", default=str(dyschord.finger_table_size),
+                    help="Comma-separated finger table sizes "
+                    "[default: %default]")
+  parser.add_option("--keys", default="0,10000",
+                    help="Comma-separated numbers of keys to store "
+                    "[default: %default]")
+  parser.add_option("--reps", type=int, default=1000,
+                    help="Repetitions of the lookup benchmarks "
+                    "[default: %default]")
+  parser.add_option("--membership-reps", dest="membership_reps", type=int,
+                    default=3,
+                    help="Number of joins and departures [default: %default]")
+  parser.add_option("--seed", type=int,
+                    help="Random seed, for comparable runs")
+  parser.add_option("-o", "--output",
+                    help="File to write the JSON results to "
+                    "[default: standard output]")
+  parser.add_option("--compare",
+                    help="Previous results to compare against")
+  parser.add_option("--threshold", type=float, default=0.2,
+                    help="Fractional slowdown of the median counted as a "
+                    "regression [default: %default]")
+  options, args = parser.parse_args(args)
+
+  if options.seed is not None :
+    random.seed(options.seed)
+
+  results = run(_int_list(options.sizes), _int_list(options.fingers),
+                _int_list(options.keys), options.reps,
+                options.membership_reps)
+  report = {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "results": results}
+  if options.output :
+    with open(options.output, "w") as out :
+      json.dump(report, out, indent=1, sort_keys=True)
+  else :
+    json.dump(report, sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write("\n")
+
+  if options.compare :
+    regressions = compare(json.load(open(options.compare)), report,
+                          options.threshold)
+    for entry, previous, change in regressions :
+      sys.stderr.write("REGRESSION %s: median %.2f us -> %.2f us (%+.0f%%)\n"
+                       % (dict(_result_key(entry)), previous["median"]*1e6,
+                          entry["median"]*1e6, change*100))
+    if regressions :
+      sys.exit(1)
+
+
+if __name__=="__main__" :
+  main()
@@ -0,0 +1,604 @@
+"""Load generator for measuring a dyschord cloud
+
+Runs YCSB-style workloads through Client: a load phase inserting the
+records, then a run phase mixing reads, updates, inserts and
+read-modify-writes, with keys chosen uniformly, from a Zipfian
+distribution, or skewed towards the latest inserts.  Throughput and
+latency percentiles are reported for each operation.
+
+By default a local cluster of dyschord-server processes is started
+for the run, but an existing cloud can be given with --peers."""
+
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import optparse
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+from .client import Client, NodeProxy, ConnectionError
+
+
+# The YCSB core workloads, minus the scans dyschord doesn't support
+workloads = {
+  "a": {"read": 0.5, "update": 0.5},
+  "b": {"read": 0.95, "update": 0.05},
+  "c": {"read": 1.0},
+  "d": {"read": 0.95, "insert": 0.05, "distribution": "latest"},
+  "f": {"read": 0.5, "read_modify_write": 0.5},
+  }
+
+
+class ZipfianGenerator(object) :
+  """Integers in [0, items) with item i drawn with weight 1/(i+1)**theta
+
+  This is the algorithm from Gray et al., "Quickly Generating
+  Billion-Record Synthetic Databases", as used by YCSB."""
+
+  def __init__(self, items, theta=0.99, rng=None) :
+    self.items = items
+    self.theta = theta
+    self.rng = rng or random.Random()
+    self.zetan = self._zeta(items, theta)
+    zeta2 = self._zeta(2, theta)
+    self.alpha = 1.0 / (1.0 - theta)
+    self.eta = ((1 - (2.0 / items)**(1 - theta))
+                / (1 - zeta2 / self.zetan))
+
+  @staticmethod
+  def _zeta(n, theta) :
+    return sum(1.0 / (i+1)**theta for i in xrange(n))
+
+  def next(self) :
+    u = self.rng.random()
+    uz = u * self.zetan
+    if uz < 1.0 :
+      return 0
+    if uz < 1.0 + 0.5**self.theta :
+      return 1
+    return min(self.items - 1,
+               int(self.items * (self.eta*u - self.eta + 1)**self.alpha))
+
+
+def _fnv_hash(value) :
+  # 64-bit FNV-1a, as YCSB uses to scramble the popular items
+  h = 0xcbf29ce484222325
+  for c in str(value) :
+    h = ((h ^ ord(c)) * 0x100000001b3) & 0xffffffffffffffff
+  return h
+
+
+class ScrambledZipfianGenerator(ZipfianGenerator) :
+  """Zipfian, but with the popular items spread over the whole range
+
+  Otherwise the hot keys would all be adjacent record numbers."""
+
+  def next(self) :
+    return _fnv_hash(ZipfianGenerator.next(self)) % self.items
+
+
+class Workload(object) :
+  """Mix of operations and the distributions of keys and values"""
+
+  def __init__(self, records=1000, read=0.0, update=0.0, insert=0.0,
+               read_modify_write=0.0, distribution="zipfian",
+               value_size=100, max_value_size=None,
+               value_size_distribution="constant", seed=None) :
+    """Create a new workload
+
+    parameters
+    - records                   Number of records inserted by the load
+                                phase
+    - read, update, insert, read_modify_write
+                                Proportions of each operation in the
+                                run phase
+    - distribution              Distribution of the keys, "uniform",
+                                "zipfian" or "latest"
+    - value_size                Size of the values in bytes, or the
+                                smallest size if max_value_size is given
+    - max_value_size            Largest value size
+    - value_size_distribution   "constant", "uniform" or "zipfian"
+                                (favoring small values)
+    - seed                      Random seed"""
+    if distribution not in ("uniform", "zipfian", "latest") :
+      raise ValueError("Unknown key distribution %s" % distribution)
+    if value_size_distribution not in ("constant", "uniform", "zipfian") :
+      raise ValueError("Unknown value size distribution %s"
+                       % value_size_distribution)
+    total = float(read + update + insert + read_modify_write)
+    if total <= 0 :
+      raise ValueError("Workload has no operations")
+    self.records = records
+    self.operations = []
+    cumulative = 0
+    for name, proportion in (("read", read), ("update", update),
+                             ("insert", insert),
+                             ("read_modify_write", read_modify_write)) :
+      if proportion > 0 :
+        cumulative += proportion / total
+        self.operations.append((cumulative, name))
+    self.distribution = distribution
+    self.value_size = value_size
+    self.max_value_size = max_value_size or value_size
+    self.value_size_distribution = value_size_distribution
+    self.rng = random.Random(seed)
+    if distribution == "uniform" :
+      self._keys = None
+    elif distribution == "zipfian" :
+      self._keys = ScrambledZipfianGenerator(records, rng=self.rng)
+    else :
+      self._keys = ZipfianGenerator(records, rng=self.rng)
+    if value_size_distribution == "zipfian" :
+      self._sizes = ZipfianGenerator(
+        self.max_value_size - self.value_size + 1, rng=self.rng)
+    # Inserts by all threads come from one counter, so keys aren't reused
+    self.inserted = records
+    self._insert_numbers = itertools.count(records)
+    self._payload = "".join(chr(self.rng.randint(32, 126))
+                            for i in xrange(self.max_value_size))
+
+  def next_operation(self) :
+    u = self.rng.random()
+    for cumulative, name in self.operations :
+      if u < cumulative :
+        return name
+    return self.operations[-1][1]
+
+  def next_key(self) :
+    if self.distribution == "uniform" :
+      number = self.rng.randrange(self.records)
+    elif self.distribution == "zipfian" :
+      number = self._keys.next()
+    else :
+      # The latest inserts are the most popular
+      number = max(0, self.inserted - 1 - self._keys.next())
+    return self.key(number)
+
+  def next_insert_key(self) :
+    number = self._insert_numbers.next()
+    self.inserted = max(self.inserted, number + 1)
+    return self.key(number)
+
+  @staticmethod
+  def key(number) :
+    return "user%d" % _fnv_hash(number)
+
+  def next_value(self) :
+    if self.value_size_distribution == "constant" :
+      size = self.value_size
+    elif self.value_size_distribution == "uniform" :
+      size = self.rng.randint(self.value_size, self.max_value_size)
+    else :
+      size = self.value_size + self._sizes.next()
+    # Random offsets into random text, so the values don't all compress
+    # down to nothing
+    start = self.rng.randrange(self.max_value_size - size + 1)
+    return self._payload[start:start+size]
+
+
+class Recorder(object) :
+  """Latencies and errors of each operation"""
+
+  def __init__(self) :
+    self.latencies = {}
+    self.errors = {}
+
+  def record(self, operation, latency, error=False) :
+    if error :
+      self.errors[operation] = self.errors.get(operation, 0) + 1
+    else :
+      self.latencies.setdefault(operation, []).append(latency)
+
+  def merge(self, other) :
+    for operation, latencies in other.latencies.iteritems() :
+      self.latencies.setdefault(operation, []).extend(latencies)
+    for operation, errors in other.errors.iteritems() :
+      self.errors[operation] = self.errors.get(operation, 0) + errors
+
+  def summary(self, elapsed) :
+    rslt = {}
+    for operation in set(self.latencies) | set(self.errors) :
+      latencies = sorted(self.latencies.get(operation, []))
+      entry = {"count": len(latencies),
+               "errors": self.errors.get(operation, 0),
+               "throughput": len(latencies) / elapsed if elapsed else None}
+      if latencies :
+        entry.update(mean=sum(latencies) / len(latencies),
+                     p50=percentile(latencies, 0.5),
+                     p99=percentile(latencies, 0.99),
+                     p999=percentile(latencies, 0.999),
+                     max=latencies[-1])
+      rslt[operation] = entry
+    return rslt
+
+
+def percentile(ordered, fraction) :
+  """Value at fraction of the way through the sorted list ordered"""
+  index = int(math.ceil(fraction * len(ordered))) - 1
+  return ordered[min(len(ordered) - 1, max(0, index))]
+
+
+def _perform(client, workload, operation) :
+  if operation == "read" :
+    try :
+      client.lookup(workload.next_key())
+    except KeyError :
+      # Counts as a success.  With the "latest" distribution another
+      # thread may not have finished inserting the key yet.
+      pass
+  elif operation == "update" :
+    client.store(workload.next_key(), workload.next_value())
+  elif operation == "insert" :
+    client.store(workload.next_insert_key(), workload.next_value())
+  elif operation == "read_modify_write" :
+    key = workload.next_key()
+    try :
+      client.lookup(key)
+    except KeyError :
+      pass
+    client.store(key, workload.next_value())
+
+
+# Failed requests are counted, but don't stop the benchmark
+request_errors = (socket.error, xmlrpclib.Fault, EnvironmentError,
+                  ConnectionError)
+
+
+def reconnect(client, peers, client_options) :
+  """Replace client with a new one if it has lost all its peers
+
+  The client forgets peers it failed to reach, so after enough errors
+  it knows none.  It finds them again in the background, but
+  recreating it doesn't wait for that.  Returns the client to carry
+  on with."""
+  if client.cloud :
+    return client
+  try :
+    replacement = Client(peers, **client_options)
+  except ConnectionError :
+    return client
+  client.close()
+  return replacement
+
+
+def _worker(peers, client_options, workload, phase, thread_number, nthreads,
+            operations, deadline, recorder) :
+  client = Client(peers, **client_options)
+  if phase == "load" :
+    for number in xrange(thread_number, workload.records, nthreads) :
+      start = time.time()
+      try :
+        client.store(workload.key(number), workload.next_value())
+      except request_errors :
+        recorder.record("insert", time.time() - start, error=True)
+        client = reconnect(client, peers, client_options)
+      else :
+        recorder.record("insert", time.time() - start)
+    client.close()
+    return
+  while True :
+    # The operation budget is shared by all the threads
+    if ((operations is not None and operations.next() <= 0)
+        or (deadline is not None and time.time() >= deadline)) :
+      client.close()
+      return
+    operation = workload.next_operation()
+    start = time.time()
+    try :
+      _perform(client, workload, operation)
+    except request_errors :
+      recorder.record(operation, time.time() - start, error=True)
+      client = reconnect(client, peers, client_options)
+    else :
+      recorder.record(operation, time.time() - start)
+
+
+def run_phase(peers, workload_options, phase, threads=8, operations=None,
+              duration=None, client_options={}, process_number=0,
+              nprocesses=1) :
+  """Run one phase of the benchmark in this process
+
+  Returns the Recorder with the results and the elapsed seconds.  With
+  several processes, each is given its share of the threads, records
+  and operations."""
+  options = dict(workload_options)
+  if options.get("seed") is not None :
+    options["seed"] += process_number
+  workload = Workload(**options)
+  if nprocesses > 1 :
+    # Interleave the inserted record numbers of the processes
+    workload._insert_numbers = itertools.count(
+      workload.records + process_number, nprocesses)
+  budget = None
+  if operations is not None :
+    budget = itertools.count(operations, -1)
+  deadline = time.time() + duration if duration else None
+  recorders = [Recorder() for i in xrange(threads)]
+  workers = [threading.Thread(
+      target=_worker, name="bench-%d" % i,
+      args=(peers, client_options, workload, phase,
+            process_number + i*nprocesses, threads*nprocesses,
+            budget, deadline, recorders[i]))
+             for i in xrange(threads)]
+  start = time.time()
+  for worker in workers :
+    worker.daemon = True
+    worker.start()
+  for worker in workers :
+    worker.join()
+  elapsed = time.time() - start
+  rslt = Recorder()
+  for recorder in recorders :
+    rslt.merge(recorder)
+  return rslt, elapsed
+
+
+def _run_phase_star(args) :
+  peers, workload_options, phase, kwargs = args
+  recorder, elapsed = run_phase(peers, workload_options, phase, **kwargs)
+  return recorder.latencies, recorder.errors, elapsed
+
+
+def run_phase_processes(peers, workload_options, phase, processes=1,
+                        threads=8, operations=None, duration=None,
+                        client_options={}) :
+  """Run one phase split over several processes, to get past the GIL"""
+  if processes <= 1 :
+    return run_phase(peers, workload_options, phase, threads, operations,
+                     duration, client_options)
+  jobs = []
+  for i in xrange(processes) :
+    share = None
+    if operations is not None :
+      share = operations // processes + (i < operations % processes)
+    jobs.append((peers, workload_options, phase,
+                 dict(threads=threads, operations=share, duration=duration,
+                      client_options=client_options, process_number=i,
+                      nprocesses=processes)))
+  pool = multiprocessing.Pool(processes)
+  try :
+    results = pool.map(_run_phase_star, jobs)
+  finally :
+    pool.close()
+    pool.join()
+  rslt = Recorder()
+  for latencies, errors, elapsed in results :
+    partial = Recorder()
+    partial.latencies = latencies
+    partial.errors = errors
+    rslt.merge(partial)
+  return rslt, max(elapsed for latencies, errors, elapsed in results)
+
+
+class LocalCluster(object) :
+  """dyschord-server processes on consecutive localhost ports"""
+
+  def __init__(self, nodes, base_port=10000, config={}, log_dir=None,
+               advertised_urls=None) :
+    """Create a new local cluster
+
+    parameters
+    - nodes             Number of servers
+    - base_port         Port of the first server
+    - config            Extra settings for the servers' config file
+    - log_dir           Directory for the servers' output, a temporary
+                        directory by default
+    - advertised_urls   Urls the servers tell each other to use, if
+                        not their own ports (for instance proxies)"""
+    self.ports = range(base_port, base_port + nodes)
+    self.urls = ["http://localhost:%d" % port for port in self.ports]
+    self.advertised_urls = advertised_urls or self.urls
+    self.config = dict(config)
+    self.config["cloud_members"] = self.advertised_urls
+    self.log_dir = log_dir
+    self.processes = [None] * nodes
+    self._conf = None
+
+  def start(self, timeout=30) :
+    """Start the servers, one at a time so their joins don't race"""
+    for i in xrange(len(self.ports)) :
+      self.start_node(i, timeout)
+
+  def start_node(self, index, timeout=30) :
+    """Start server number index and wait for it to join"""
+    if self.log_dir is None :
+      self.log_dir = tempfile.mkdtemp(prefix="dyschord-bench-")
+    if self._conf is None :
+      self._conf = os.path.join(self.log_dir, "cluster.conf")
+      with open(self._conf, "w") as out :
+        json.dump(self.config, out)
+    port = self.ports[index]
+    command = [sys.executable, "-m", "dyschord.server", "--conf", self._conf,
+               "--port", str(port)]
+    if self.advertised_urls[index] != self.urls[index] :
+      command += ["--url", self.advertised_urls[index]]
+    # Appending, so the logs of restarted servers are kept
+    log = open(os.path.join(self.log_dir, "server-%d.log" % port), "a")
+    self.processes[index] = subprocess.Popen(command, stdout=log,
+                                             stderr=subprocess.STDOUT)
+    self.wait_until_up(self.urls[index], timeout)
+
+  def wait_until_up(self, url, timeout=30) :
+    node = NodeProxy(url, timeout=1)
+    deadline = time.time() + timeout
+    while True :
+      try :
+        # Only answers once the node has joined the cloud
+        node.get_load()
+        return
+      except (socket.error, xmlrpclib.Fault), e :
+        if time.time() > deadline :
+          raise RuntimeError("Server %s didn't start: %s" % (url, e))
+        time.sleep(0.1)
+
+  def is_running(self, index) :
+    process = self.processes[index]
+    return process is not None and process.poll() is None
+
+  def kill_node(self, index, sig=signal.SIGKILL) :
+    """Stop server number index, by default without any cleanup"""
+    process = self.processes[index]
+    if process is not None :
+      if process.poll() is None :
+        process.send_signal(sig)
+      process.wait()
+      self.processes[index] = None
+
+  def stop(self) :
+    for process in self.processes :
+      if process is not None and process.poll() is None :
+        process.terminate()
+    for process in self.processes :
+      if process is not None :
+        process.wait()
+    self.processes = [None] * len(self.ports)
+
+
+def format_report(phases) :
+  """Text table of the summaries of each phase"""
+  lines = ["%-8s %-18s %9s %7s %10s %9s %9s %9s %9s %9s"
+           % ("phase", "operation", "count", "errors", "ops/s",
+              "mean ms", "p50 ms", "p99 ms", "p999 ms", "max ms")]
+  for phase, summary in phases :
+    for operation, entry in sorted(summary["operations"].iteritems()) :
+      millis = [("%9.2f" % (entry[f]*1000) if f in entry else "%9s" % "-")
+                for f in ("mean", "p50", "p99", "p999", "max")]
+      lines.append("%-8s %-18s %9d %7d %10.1f %s"
+                   % (phase, operation, entry["count"], entry["errors"],
+                      entry["throughput"] or 0, " ".join(millis)))
+    lines.append("%-8s %-18s %9d %7s %10.1f"
+                 % (phase, "total", summary["count"], "",
+                    summary["throughput"]))
+  return "\n".join(lines)
+
+
+def summarize_phase(recorder, elapsed) :
+  count = sum(len(latencies) for latencies in recorder.latencies.values())
+  return {"elapsed": elapsed,
+          "count": count,
+          "throughput": count / elapsed if elapsed else 0,
+          "operations": recorder.summary(elapsed)}
+
+
+def main(args=sys.argv) :
+  parser = optparse.OptionParser("%prog [OPTIONS]")
+  parser.add_option("-n", "--nodes", type=int, default=4,
+                    help="Number of local servers to start [default: %default]")
+  parser.add_option("--base-port", dest="base_port", type=int, default=10000,
+                    help="Port of the first local server [default: %default]")
+  parser.add_option("--server-conf", dest="server_conf",
+                    help="Config file whose settings are used for the "
+                    "local servers (cloud_members is replaced)")
+  parser.add_option("--peers",
+                    help="Comma-separated urls of an already running cloud, "
+                    "instead of starting local servers")
+  parser.add_option("-w", "--workload", default="a",
+                    help="YCSB core workload: %s [default: %%default]"
+                    % ", ".join(sorted(workloads)))
+  parser.add_option("--read", type=float, help="Override read proportion")
+  parser.add_option("--update", type=float, help="Override update proportion")
+  parser.add_option("--insert", type=float, help="Override insert proportion")
+  parser.add_option("--rmw", dest="read_modify_write", type=float,
+                    help="Override read-modify-write proportion")
+  parser.add_option("--distribution",
+                    help="Key distribution: uniform, zipfian or latest "
+                    "[default: per workload, usually zipfian]")
+  parser.add_option("-r", "--records", type=int, default=1000,
+                    help="Records inserted in the load phase "
+                    "[default: %default]")
+  parser.add_option("-o", "--operations", type=int, default=10000,
+                    help="Operations in the run phase [default: %default]")
+  parser.add_option("-d", "--duration", type=float,
+                    help="Run for this many seconds instead of a number of "
+                    "operations")
+  parser.add_option("--value-size", dest="value_size", type=int, default=100,
+                    help="Value size in bytes, or the smallest size "
+                    "[default: %default]")
+  parser.add_option("--max-value-size", dest="max_value_size", type=int,
+                    help="Largest value size")
+  parser.add_option("--value-size-distribution",
+                    dest="value_size_distribution", default="constant",
+                    help="constant, uniform or zipfian [default: %default]")
+  parser.add_option("-t", "--threads", type=int, default=8,
+                    help="Worker threads per process [default: %default]")
+  parser.add_option("-P", "--processes", type=int, default=1,
+                    help="Worker processes [default: %default]")
+  parser.add_option("--cache-size", dest="cache_size", type=int, default=0,
+                    help="Client cache size [default: %default]")
+  parser.add_option("--skip-load", dest="skip_load", action="store_true",
+                    help="Don't run the load phase")
+  parser.add_option("--seed", type=int, help="Random seed")
+  parser.add_option("--json", help="File to write the results to as JSON")
+  options, args = parser.parse_args(args)
+
+  logging.basicConfig()
+
+  try :
+    workload_options = dict(workloads[options.workload.lower()])
+  except KeyError :
+    parser.error("Unknown workload %s" % options.workload)
+  for name in ("read", "update", "insert", "read_modify_write",
+               "distribution") :
+    if getattr(options, name) is not None :
+      workload_options[name] = getattr(options, name)
+  workload_options.update(records=options.records,
+                          value_size=options.value_size,
+                          max_value_size=options.max_value_size,
+                          value_size_distribution=
+                            options.value_size_distribution,
+                          seed=options.seed)
+  client_options = {"cache_size": options.cache_size}
+
+  cluster = None
+  if options.peers :
+    peers = options.peers.split(",")
+  else :
+    config = {}
+    if options.server_conf :
+      config = json.load(open(options.server_conf))
+    cluster = LocalCluster(options.nodes, options.base_port, config)
+    peers = cluster.urls
+
+  phases = []
+  try :
+    if cluster is not None :
+      print "Starting %d servers" % options.nodes
+      cluster.start()
+      print "Server logs in", cluster.log_dir
+    if not options.skip_load :
+      recorder, elapsed = run_phase_processes(
+        peers, workload_options, "load", options.processes, options.threads,
+        client_options=client_options)
+      phases.append(("load", summarize_phase(recorder, elapsed)))
+    operations = options.operations if not options.duration else None
+    recorder, elapsed = run_phase_processes(
+      peers, workload_options, "run", options.processes, options.threads,
+      operations, options.duration, client_options)
+    phases.append(("run", summarize_phase(recorder, elapsed)))
+  finally :
+    if cluster is not None :
+      cluster.stop()
+
+  print format_report(phases)
+  if options.json :
+    with open(options.json, "w") as out :
+      json.dump({"workload": workload_options,
+                 "nodes": len(peers),
+                 "threads": options.threads,
+                 "processes": options.processes,
+                 "phases": dict(phases)},
+                out, indent=1, sort_keys=True)
+
+
+if __name__=="__main__" :
+  main()
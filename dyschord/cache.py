@@ -0,0 +1,116 @@
+"""Bounded caches for looked up values
+
+Values are cached along with the version the owning node assigned
+them, so an invalidation for a newer version can never be undone by a
+slow response carrying an older one."""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object) :
+  """Least-recently-used cache with expiring, versioned entries
+
+  Invalidated keys are remembered (as entries without a value) until
+  they fall out of the cache, so that a put of a version older than
+  the invalidation is ignored."""
+
+  _missing = object()
+
+  def __init__(self, max_entries=10000, ttl=30.0, clock=time.time) :
+    """Create a new cache
+
+    parameters
+    - max_entries  Maximum number of entries to hold
+    - ttl          Seconds an entry stays valid, None for no expiry
+    - clock        Time function, replaceable for testing"""
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.clock = clock
+    # key -> (value, version, expiry)
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.invalidations = 0
+
+  def __len__(self) :
+    return len(self._entries)
+
+  def _insert(self, key, value, version, expiry) :
+    self._entries.pop(key, None)
+    self._entries[key] = (value, version, expiry)
+    while len(self._entries) > self.max_entries :
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  def get(self, key) :
+    """Return the (value, version) pair for key
+
+    Raises KeyError if the key is not cached, has expired, or has
+    been invalidated."""
+    with self._lock :
+      entry = self._entries.get(key)
+      if entry is None or entry[0] is self._missing :
+        self.misses += 1
+        raise KeyError(key)
+      value, version, expiry = entry
+      if expiry is not None and expiry <= self.clock() :
+        del self._entries[key]
+        self.expirations += 1
+        self.misses += 1
+        raise KeyError(key)
+      # Move to the most recently used end
+      del self._entries[key]
+      self._entries[key] = entry
+      self.hits += 1
+      return value, version
+
+  def put(self, key, value, version, ttl=None) :
+    """Cache value for key, unless a newer version is known
+
+    ttl overrides the cache's default time to live for this entry."""
+    if ttl is None :
+      ttl = self.ttl
+    with self._lock :
+      entry = self._entries.get(key)
+      if entry is not None and entry[1] > version :
+        return False
+      expiry = self.clock() + ttl if ttl is not None else None
+      self._insert(key, value, version, expiry)
+      return True
+
+  def invalidate(self, key, version=None) :
+    """Drop key from the cache
+
+    If version is given, any later put with an older version is
+    ignored."""
+    with self._lock :
+      entry = self._entries.pop(key, None)
+      if entry is not None :
+        self.invalidations += 1
+      if version is not None :
+        if entry is not None and entry[1] > version :
+          version = entry[1]
+        expiry = self.clock() + self.ttl if self.ttl is not None else None
+        self._insert(key, self._missing, version, expiry)
+
+  def clear(self) :
+    with self._lock :
+      self._entries.clear()
+
+  def stats(self) :
+    """Dictionary of hit, miss and eviction counts"""
+    with self._lock :
+      requests = self.hits + self.misses
+      return {"entries": len(self._entries),
+              "max_entries": self.max_entries,
+              "hits": self.hits,
+              "misses": self.misses,
+              "hit_rate": float(self.hits)/requests if requests else 0.0,
+              "evictions": self.evictions,
+              "expirations": self.expirations,
+              "invalidations": self.invalidations}
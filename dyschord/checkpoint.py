@@ -0,0 +1,73 @@
+"""Checkpoints of a node's state, for warm restarts
+
+A checkpoint holds the node's id, the urls of its fingers, and its
+data with the versions and expiry times.  A node restarted from one
+joins in front of the same successor as before, with the fingers as
+the first nodes to ask, and tells the successor the versions it has.
+The successor only sends the entries that changed since, and the keys
+of the rest, which the node keeps from the checkpoint.
+
+The file is a pickle, written to a temporary file next to it and
+renamed over it, so a crash while saving leaves the last one whole."""
+
+import cPickle
+import logging
+import os
+import tempfile
+import time
+
+_logger = logging.getLogger("dyschord.checkpoint")
+
+
+def save(node, path, clean=False) :
+  """Write a checkpoint of node to path
+
+  parameters
+  - clean   Whether the node is shutting down cleanly, so nothing else
+            is at its position on the ring and a restart can take it
+            back.  After a crash the successor may not have noticed
+            the node is gone by the time it's back."""
+  # Copy under the lock, but pickle without it, so writes don't wait
+  # on the disk
+  with node.data_lock.rdlocked() :
+    data = dict(node._live_items())
+    versions = node._versions_for(data)
+    expiries = node._expiries_for(data)
+  with node.finger_lock.rdlocked() :
+    fingers = list(node.fingers)
+  urls = []
+  for finger in fingers :
+    url = getattr(finger, "url", None)
+    if finger.id != node.id and url is not None and url not in urls :
+      urls.append(url)
+  state = {"id": node.id,
+           "clean": clean,
+           "time": time.time(),
+           "fingers": urls,
+           "data": data,
+           "versions": versions,
+           "expiries": expiries}
+  directory = os.path.dirname(os.path.abspath(path))
+  fd, temp_path = tempfile.mkstemp(prefix=".checkpoint-", dir=directory)
+  try :
+    with os.fdopen(fd, "wb") as out :
+      cPickle.dump(state, out, 2)
+    os.rename(temp_path, path)
+  except Exception :
+    os.remove(temp_path)
+    raise
+  node.metrics.count("checkpoint.saves")
+  return len(data)
+
+
+def load(path) :
+  """The state saved in the checkpoint at path, or None if there's
+  none that can be read"""
+  try :
+    with open(path, "rb") as f :
+      return cPickle.load(f)
+  except IOError :
+    return None
+  except Exception, e :
+    _logger.warn("Ignoring unreadable checkpoint %s: %s", path, e)
+    return None
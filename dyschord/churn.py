@@ -0,0 +1,529 @@
+"""Churn and fault injection harness for a local cluster
+
+Runs a local cluster with every server behind a proxy that can add
+latency, drop connections and cut the server off, then kills and
+restarts servers on a schedule while a load generator runs.  It
+reports how long the ring takes to become consistent again after each
+event, the requests that failed or were slow meanwhile, and the RPCs
+spent on repair_fingers, repair_predecessor and announcing joins.
+
+The servers are told to advertise the proxies' urls, so all traffic
+between them goes through the proxies as well.  The harness itself
+checks the ring through the servers' own ports."""
+
+import SocketServer
+import json
+import logging
+import optparse
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import xmlrpclib
+
+from . import bench
+from .client import Client, NodeProxy
+
+
+class FaultProxy(SocketServer.ThreadingMixIn, SocketServer.TCPServer) :
+  """TCP proxy to a local port that injects faults
+
+  XML-RPC makes a new connection for each call, so dropping a
+  connection stands in for losing a request.  Dropped connections are
+  held open without a reply, like packets that never arrive, so the
+  caller waits for its timeout."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, port, target_port, latency=0.0, jitter=0.0, drop=0.0,
+               seed=None) :
+    """Create a new proxy
+
+    parameters
+    - port          Port to listen on
+    - target_port   Port to forward to
+    - latency       Seconds added to each transfer in each direction
+    - jitter        Up to this many extra random seconds of latency
+    - drop          Fraction of connections to drop
+    - seed          Random seed"""
+    SocketServer.TCPServer.__init__(self, ("localhost", port), _ProxyHandler)
+    self.port = self.server_address[1]
+    self.target_port = target_port
+    self.latency = latency
+    self.jitter = jitter
+    self.drop = drop
+    # While set, connections are refused and open ones are cut
+    self.partitioned = False
+    self.rng = random.Random(seed)
+    self.counts = {"connections": 0, "dropped": 0, "refused": 0}
+    self._lock = threading.Lock()
+    self._thread = None
+
+  @property
+  def url(self) :
+    return "http://localhost:%d" % self.port
+
+  def start(self) :
+    self._thread = threading.Thread(target=self.serve_forever,
+                                    name="proxy-%d" % self.port)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self) :
+    self.shutdown()
+    self.server_close()
+
+  def _count(self, name) :
+    with self._lock :
+      self.counts[name] += 1
+
+  def _delay(self) :
+    return self.latency + (self.rng.random() * self.jitter
+                           if self.jitter else 0)
+
+
+class _ProxyHandler(SocketServer.BaseRequestHandler) :
+
+  def handle(self) :
+    proxy = self.server
+    proxy._count("connections")
+    if proxy.partitioned :
+      proxy._count("refused")
+      self._reset()
+      return
+    if proxy.drop and proxy.rng.random() < proxy.drop :
+      proxy._count("dropped")
+      self._swallow()
+      return
+    try :
+      upstream = socket.create_connection(("localhost", proxy.target_port))
+    except socket.error :
+      self._reset()
+      return
+    try :
+      replies = threading.Thread(target=self._pump,
+                                 args=(upstream, self.request),
+                                 name="proxy-reply")
+      replies.daemon = True
+      replies.start()
+      self._pump(self.request, upstream)
+      replies.join()
+    finally :
+      upstream.close()
+
+  def _pump(self, source, destination) :
+    try :
+      while True :
+        data = source.recv(65536)
+        if not data or self.server.partitioned :
+          break
+        delay = self.server._delay()
+        if delay :
+          time.sleep(delay)
+        destination.sendall(data)
+    except socket.error :
+      pass
+    finally :
+      try :
+        destination.shutdown(socket.SHUT_WR)
+      except socket.error :
+        pass
+
+  def _reset(self) :
+    # Close with a reset, so the caller gets a socket error as if the
+    # connection had been refused, not an empty reply
+    self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack("ii", 1, 0))
+    self.request.close()
+
+  def _swallow(self) :
+    try :
+      while self.request.recv(65536) :
+        pass
+    except socket.error :
+      pass
+
+
+# Actions for schedule events, each with a "node" index
+actions = ("kill", "start", "partition", "heal", "latency", "drop")
+
+
+def generate_schedule(nodes, duration, interval, downtime, rng=random,
+                      min_running=2) :
+  """Kill a random server every interval seconds, restarting it downtime
+  seconds later
+
+  Returns a list of events, dictionaries with the time in seconds from
+  the start ("at"), the action and the node's index."""
+  events = []
+  down_until = {}
+  at = interval
+  while at < duration :
+    running = [i for i in xrange(nodes) if down_until.get(i, 0) <= at]
+    if len(running) > min_running :
+      victim = rng.choice(running)
+      events.append({"at": at, "action": "kill", "node": victim})
+      if at + downtime < duration :
+        events.append({"at": at + downtime, "action": "start",
+                       "node": victim})
+        down_until[victim] = at + downtime
+      else :
+        down_until[victim] = float("inf")
+    at += interval
+  events.sort(key=lambda event : event["at"])
+  return events
+
+
+class LoadGenerator(object) :
+  """Threads running a workload, recording when each request happened"""
+
+  def __init__(self, peers, workload_options, threads=4) :
+    self.peers = peers
+    self.workload = bench.Workload(**workload_options)
+    self.threads = threads
+    # (seconds since start, latency, succeeded) for each request
+    self.requests = []
+    self._lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._workers = []
+    self.started = None
+
+  def start(self) :
+    self.started = time.time()
+    for i in xrange(self.threads) :
+      worker = threading.Thread(target=self._run, name="load-%d" % i)
+      worker.daemon = True
+      worker.start()
+      self._workers.append(worker)
+
+  def stop(self) :
+    self._stop_event.set()
+    for worker in self._workers :
+      worker.join()
+
+  def _run(self) :
+    client = Client(self.peers)
+    while not self._stop_event.is_set() :
+      operation = self.workload.next_operation()
+      start = time.time()
+      try :
+        bench._perform(client, self.workload, operation)
+        succeeded = True
+      except bench.request_errors :
+        succeeded = False
+        client = bench.reconnect(client, self.peers, {})
+      with self._lock :
+        self.requests.append((start - self.started, time.time() - start,
+                              succeeded))
+    client.close()
+
+
+class ChurnHarness(object) :
+  """Local cluster behind fault injecting proxies"""
+
+  def __init__(self, nodes=5, base_port=10000, proxy_base_port=11000,
+               config={"heartbeat": 1}, latency=0.0, jitter=0.0, drop=0.0,
+               seed=None) :
+    """Create a new harness
+
+    parameters
+    - nodes             Number of servers
+    - base_port         Port of the first server
+    - proxy_base_port   Port of the first server's proxy
+    - config            Settings for the servers' config file
+    - latency, jitter, drop
+                        Faults the proxies inject, once the data has
+                        been loaded
+    - seed              Random seed"""
+    self.proxies = [FaultProxy(proxy_base_port + i, base_port + i,
+                               seed=None if seed is None else seed + i)
+                    for i in xrange(nodes)]
+    self.faults = {"latency": latency, "jitter": jitter, "drop": drop}
+    self.cluster = bench.LocalCluster(
+      nodes, base_port, config,
+      advertised_urls=[proxy.url for proxy in self.proxies])
+    # Latest stats of each run of each server, by (index, incarnation)
+    self.stats = {}
+    self.incarnations = [0] * nodes
+    self.recoveries = []
+    self._stats_lock = threading.Lock()
+
+  def start(self) :
+    for proxy in self.proxies :
+      proxy.start()
+    self.cluster.start()
+
+  def stop(self) :
+    self.cluster.stop()
+    for proxy in self.proxies :
+      proxy.stop()
+
+  def set_faults(self, latency=0.0, jitter=0.0, drop=0.0) :
+    for proxy in self.proxies :
+      proxy.latency = latency
+      proxy.jitter = jitter
+      proxy.drop = drop
+
+  def live_nodes(self) :
+    """Indices of the servers that are up and reachable"""
+    return [i for i in xrange(len(self.proxies))
+            if self.cluster.is_running(i) and not self.proxies[i].partitioned]
+
+  def ring_consistent(self) :
+    """Whether the live servers form a single ring, with correct
+    successors and predecessors"""
+    live = self.live_nodes()
+    if not live :
+      return False
+    links = {}
+    try :
+      for i in live :
+        server = NodeProxy(self.cluster.urls[i], timeout=1).server
+        links[self.proxies[i].url] = (int(server.ping()["id"]),
+                                      server.get_next()["url"],
+                                      server.get_predecessor()["url"])
+    except (socket.error, xmlrpclib.Fault) :
+      return False
+    ring = sorted(links, key=lambda url : links[url][0])
+    for n, url in enumerate(ring) :
+      node_id, successor, predecessor = links[url]
+      if (successor != ring[(n + 1) % len(ring)]
+          or predecessor != ring[n - 1]) :
+        return False
+    return True
+
+  def poll_stats(self) :
+    for i in xrange(len(self.proxies)) :
+      if not self.cluster.is_running(i) :
+        continue
+      try :
+        stats = NodeProxy(self.cluster.urls[i], timeout=1).stats()
+      except (socket.error, xmlrpclib.Fault) :
+        continue
+      with self._stats_lock :
+        self.stats[(i, self.incarnations[i])] = stats
+
+  def apply(self, event) :
+    node = event["node"]
+    action = event["action"]
+    if action == "kill" :
+      # Catch the last of its stats before they're lost
+      self.poll_stats()
+      self.cluster.kill_node(node)
+    elif action == "start" :
+      self.incarnations[node] += 1
+      self.cluster.start_node(node)
+    elif action == "partition" :
+      self.proxies[node].partitioned = True
+    elif action == "heal" :
+      self.proxies[node].partitioned = False
+    elif action == "latency" :
+      self.proxies[node].latency = event["value"]
+    elif action == "drop" :
+      self.proxies[node].drop = event["value"]
+    else :
+      raise ValueError("Unknown action %s" % action)
+
+  def _measure_recovery(self, record, timeout) :
+    start = time.time()
+    while time.time() - start < timeout :
+      if self.ring_consistent() :
+        record["ring_recovery"] = time.time() - start
+        return
+      time.sleep(0.2)
+    record["ring_recovery"] = None
+
+  def run(self, schedule, duration, workload_options, threads=4,
+          recovery_timeout=60) :
+    """Run the load and the schedule of events for duration seconds
+
+    Returns the load generator and the events, each with when it was
+    applied and how long the ring took to recover."""
+    bench.run_phase(self.cluster.advertised_urls, workload_options, "load",
+                    threads)
+    self.set_faults(**self.faults)
+    load = LoadGenerator(self.cluster.advertised_urls, workload_options,
+                         threads)
+    load.start()
+    stop_polling = threading.Event()
+    def poll() :
+      while not stop_polling.wait(1) :
+        self.poll_stats()
+    poller = threading.Thread(target=poll, name="stats-poller")
+    poller.daemon = True
+    poller.start()
+
+    events = []
+    measurers = []
+    try :
+      for event in sorted(schedule, key=lambda event : event["at"]) :
+        delay = load.started + event["at"] - time.time()
+        if delay > 0 :
+          time.sleep(delay)
+        record = dict(event)
+        try :
+          self.apply(event)
+        except RuntimeError, e :
+          record["error"] = str(e)
+        record["applied"] = time.time() - load.started
+        events.append(record)
+        measurer = threading.Thread(target=self._measure_recovery,
+                                    args=(record, recovery_timeout),
+                                    name="recovery")
+        measurer.daemon = True
+        measurer.start()
+        measurers.append(measurer)
+      remaining = load.started + duration - time.time()
+      if remaining > 0 :
+        time.sleep(remaining)
+    finally :
+      load.stop()
+      for measurer in measurers :
+        measurer.join()
+      stop_polling.set()
+      poller.join()
+      self.poll_stats()
+    return load, events
+
+
+def summarize(load, events, stats, slow=1.0) :
+  """Summary of the requests around each event and the RPC volume"""
+  def window_counts(start, end) :
+    failed = slow_count = total = 0
+    for at, latency, succeeded in load.requests :
+      if start <= at < end :
+        total += 1
+        if not succeeded :
+          failed += 1
+        elif latency >= slow :
+          slow_count += 1
+    return {"requests": total, "failed": failed, "slow": slow_count}
+
+  for n, event in enumerate(events) :
+    end = (event["applied"] + event["ring_recovery"]
+           if event.get("ring_recovery") is not None
+           else (events[n+1]["applied"] if n + 1 < len(events)
+                 else float("inf")))
+    event.update(window_counts(event["applied"], end))
+
+  rpcs = {}
+  for run_stats in stats.itervalues() :
+    for name, count in run_stats["counters"].iteritems() :
+      if name.startswith("rpcs.") or name.startswith("repair_") :
+        rpcs[name] = rpcs.get(name, 0) + count
+    for name, histogram in run_stats["histograms"].iteritems() :
+      if name.startswith("requests.") :
+        rpcs[name] = rpcs.get(name, 0) + histogram["count"]
+  recoveries = [event["ring_recovery"] for event in events
+                if event.get("ring_recovery") is not None]
+  return {"overall": window_counts(0, float("inf")),
+          "events": events,
+          "unrecovered": sum(1 for event in events
+                             if event.get("ring_recovery") is None),
+          "max_recovery": max(recoveries) if recoveries else None,
+          "rpcs": rpcs}
+
+
+def format_summary(summary) :
+  lines = ["%8s %-10s %4s %10s %9s %7s %6s"
+           % ("at", "action", "node", "recovery", "requests", "failed",
+              "slow")]
+  for event in summary["events"] :
+    recovery = event.get("ring_recovery")
+    lines.append("%8.1f %-10s %4d %10s %9d %7d %6d"
+                 % (event["applied"], event["action"], event["node"],
+                    "%.2fs" % recovery if recovery is not None else "never",
+                    event["requests"], event["failed"], event["slow"]))
+  overall = summary["overall"]
+  lines.append("Overall: %d requests, %d failed, %d slow"
+               % (overall["requests"], overall["failed"], overall["slow"]))
+  lines.append("RPCs:")
+  for name, count in sorted(summary["rpcs"].iteritems()) :
+    lines.append("  %-40s %d" % (name, count))
+  return "\n".join(lines)
+
+
+def main(args=sys.argv) :
+  parser = optparse.OptionParser("%prog [OPTIONS]")
+  parser.add_option("-n", "--nodes", type=int, default=5,
+                    help="Number of local servers [default: %default]")
+  parser.add_option("--base-port", dest="base_port", type=int, default=10000,
+                    help="Port of the first server [default: %default]")
+  parser.add_option("--proxy-base-port", dest="proxy_base_port", type=int,
+                    default=11000,
+                    help="Port of the first proxy [default: %default]")
+  parser.add_option("--server-conf", dest="server_conf",
+                    help="Config file whose settings are used for the "
+                    "servers (cloud_members is replaced)")
+  parser.add_option("-d", "--duration", type=float, default=60,
+                    help="Seconds to run the load [default: %default]")
+  parser.add_option("--schedule",
+                    help="JSON file with a list of events, each with the "
+                    "seconds from the start (at), action (%s), node index "
+                    "and for latency and drop a value" % ", ".join(actions))
+  parser.add_option("--kill-every", dest="kill_every", type=float, default=15,
+                    help="Without a schedule, kill a random server this "
+                    "often [default: %default]")
+  parser.add_option("--downtime", type=float, default=5,
+                    help="Seconds before restarting a killed server "
+                    "[default: %default]")
+  parser.add_option("--latency", type=float, default=0,
+                    help="Seconds of latency added in each direction")
+  parser.add_option("--jitter", type=float, default=0,
+                    help="Maximum seconds of random extra latency")
+  parser.add_option("--drop", type=float, default=0,
+                    help="Fraction of connections dropped")
+  parser.add_option("-w", "--workload", default="b",
+                    help="YCSB core workload [default: %default]")
+  parser.add_option("-r", "--records", type=int, default=1000,
+                    help="Records inserted before the churn "
+                    "[default: %default]")
+  parser.add_option("-t", "--threads", type=int, default=4,
+                    help="Load generator threads [default: %default]")
+  parser.add_option("--slow", type=float, default=1.0,
+                    help="Requests taking at least this many seconds count "
+                    "as slow [default: %default]")
+  parser.add_option("--seed", type=int, help="Random seed")
+  parser.add_option("--json", help="File to write the results to as JSON")
+  options, args = parser.parse_args(args)
+
+  logging.basicConfig()
+
+  config = {"heartbeat": 1}
+  if options.server_conf :
+    config = json.load(open(options.server_conf))
+  rng = random.Random(options.seed)
+  if options.schedule :
+    schedule = json.load(open(options.schedule))
+  else :
+    schedule = generate_schedule(options.nodes, options.duration,
+                                 options.kill_every, options.downtime, rng)
+  try :
+    workload_options = dict(bench.workloads[options.workload.lower()])
+  except KeyError :
+    parser.error("Unknown workload %s" % options.workload)
+  workload_options.update(records=options.records, seed=options.seed)
+
+  harness = ChurnHarness(options.nodes, options.base_port,
+                         options.proxy_base_port, config, options.latency,
+                         options.jitter, options.drop, options.seed)
+  try :
+    harness.start()
+    print "Server logs in", harness.cluster.log_dir
+    load, events = harness.run(schedule, options.duration, workload_options,
+                               options.threads)
+  finally :
+    harness.stop()
+
+  summary = summarize(load, events, harness.stats, options.slow)
+  print format_summary(summary)
+  if options.json :
+    with open(options.json, "w") as out :
+      json.dump(summary, out, indent=1, sort_keys=True)
+
+
+if __name__=="__main__" :
+  main()
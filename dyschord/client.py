@@ -1,8 +1,16 @@
 import xmlrpclib
 import socket
 import logging
-import json
 import random
+import threading
+import time
+import urlparse
+import weakref
+
+from .cache import LRUCache
+from . import codec
+from . import metrics
+from .mux import MuxServerProxy
 
 # Timeout XML-RPC ServerProxy code.
 #
@@ -23,17 +31,37 @@ class TimeoutHTTP(httplib.HTTP):
 
 class TimeoutTransport(xmlrpclib.Transport):
   def __init__(self, timeout=10, *l, **kw):
+    # metrics is an optional metrics.Registry to record the latency
+    # of each request to the host in.
+    self.metrics = kw.pop('metrics', None)
     xmlrpclib.Transport.__init__(self,*l,**kw)
     self.timeout=timeout
   def make_connection(self, host):
     conn = TimeoutHTTPConnection(host)
     conn.timeout = self.timeout
     return conn
+  def request(self, host, handler, request_body, verbose=0):
+    if self.metrics is None:
+      return xmlrpclib.Transport.request(self, host, handler, request_body,
+                                         verbose)
+    activity = metrics.current_activity()
+    if activity is not None:
+      self.metrics.count("rpcs.%s" % activity)
+    start = time.time()
+    try:
+      return xmlrpclib.Transport.request(self, host, handler, request_body,
+                                         verbose)
+    except (socket.error, socket.timeout):
+      self.metrics.count("peer_errors.%s" % host)
+      raise
+    finally:
+      self.metrics.observe("peer_latency.%s" % host, time.time() - start)
 
 class TimeoutServerProxy(xmlrpclib.ServerProxy):
   def __init__(self,uri,timeout=10,*l,**kw):
     kw['transport']=TimeoutTransport(
-      timeout=timeout, use_datetime=kw.get('use_datetime',0))
+      timeout=timeout, use_datetime=kw.get('use_datetime',0),
+      metrics=kw.pop('metrics', None))
     xmlrpclib.ServerProxy.__init__(self,uri,*l,**kw)
 
 
@@ -50,16 +78,24 @@ class ProxyTranslation(object) :
     parameters
     - url    URL to use for describing nodes in current process"""
     self.url = url
+    # "host:port" of the mux listener of the current process, if any
+    self.mux = None
     self.local_nodes = {}
 
+  # Ids don't fit in XML-RPC integers, so they're sent as strings
   def to_descr(self, node) :
-    return {"id": node.id, "url": getattr(node, "url", self.url)}
+    descr = {"id": str(node.id), "url": getattr(node, "url", self.url)}
+    mux = getattr(node, "mux", self.mux)
+    if mux is not None :
+      descr["mux"] = mux
+    return descr
 
   def from_descr(self, descr) :
     try :
-      node_id = descr["id"]
+      node_id = int(descr["id"])
     except KeyError :
-      proxy = NodeProxy(url=descr["url"], id=descr.get("id"))
+      proxy = NodeProxy(url=descr["url"], id=descr.get("id"),
+                        mux=descr.get("mux"))
       node_id = proxy.id
     else :
       proxy = None
@@ -69,7 +105,7 @@ class ProxyTranslation(object) :
       if proxy is not None :
         return proxy
       else :
-        return NodeProxy(url=descr["url"], id=node_id)
+        return NodeProxy(url=descr["url"], id=node_id, mux=descr.get("mux"))
 
 
 
@@ -82,6 +118,9 @@ class ProxyTranslation(object) :
 # Closing the connection doesn't seem to work though.
 class NodeProxy(object) :
   verbose = False
+  # Registry to record the latency of calls to each peer in, set by
+  # the server.
+  metrics = None
 
   # Class-level object to handle the translation between nodes
   # descriptions and actual nodes.  Class-level, so that the server
@@ -99,13 +138,22 @@ class NodeProxy(object) :
     return cls.node_translator.from_descr(descr)
 
 
-  def __init__(self, url, id=None, timeout=5, verbose=None) :
+  def __init__(self, url, id=None, timeout=5, verbose=None, mux=None) :
     # Should parse the URL to makes sure it's http, or if not, add the protocol
     self.url = url
     if verbose is None :
       verbose = self.verbose
-    self.server = TimeoutServerProxy(url, timeout=timeout, verbose=verbose,
-                                     allow_none=True)
+    # mux is the "host:port" of the node's mux listener, if it has one,
+    # in which case calls share a single connection to it
+    self.mux = mux
+    if mux is not None :
+      host, port = mux.rsplit(":", 1)
+      self.server = MuxServerProxy((host, int(port)),
+                                   host=urlparse.urlparse(url).netloc,
+                                   metrics=self.metrics)
+    else :
+      self.server = TimeoutServerProxy(url, timeout=timeout, verbose=verbose,
+                                       allow_none=True, metrics=self.metrics)
     self.__id = id
     self.logger = logging.getLogger("dyschord.nodeproxy")
     self.logger.debug("Created node proxy to url %s with id %s", url, id)
@@ -147,24 +195,72 @@ class NodeProxy(object) :
   def lookup(self, key) :
     return self.server.lookup(key)
 
-  def store(self, key, value) :
-    return self.server.store(key, value)
+  def lookup_versioned(self, key, subscriber=None) :
+    value, version = self.server.lookup_versioned(key, subscriber)
+    return value, version
+
+  def lookup_if_changed(self, key, version) :
+    return self.server.lookup_if_changed(key, version)
+
+  def lookup_leased(self, key) :
+    value, version, lease = self.server.lookup_leased(key)
+    return value, version, lease
+
+  def invalidate(self, key, version=None) :
+    return self.server.invalidate(key, version)
 
-  def store_backup(self, key, value, predecessor) :
+  def cache_stats(self) :
+    return self.server.cache_stats()
+
+  def stats(self) :
+    return self.server.stats()
+
+  def store(self, key, value, ttl=None) :
+    return self.server.store(key, value, ttl)
+
+  def store_if(self, key, value, expected_version, ttl=None) :
+    return self.server.store_if(key, value, expected_version, ttl)
+
+  def store_backup(self, key, value, predecessor, version=None, expiry=None) :
     return self.server.store_backup(key, value,
-                                    self.node_translator.to_descr(predecessor))
+                                    self.node_translator.to_descr(predecessor),
+                                    version, expiry)
 
-  def update_backup(self, data) :
+  def update_backup(self, data, versions=None, expiries=None) :
     self.logger.debug("Updating backup to include %s", data)
-    return self.server.update_backup(data)
+    return self.server.update_backup(codec.pack_batch(data), versions,
+                                     expiries)
+
+  def merkle_digests(self, indices) :
+    # Digests are 128-bit, so they're sent as hex strings
+    return [int(digest, 16) for digest in self.server.merkle_digests(indices)]
+
+  def merkle_entries(self, buckets, start, end) :
+    return self.server.merkle_entries(buckets, str(start), str(end))
+
+  def fetch_entries(self, keys) :
+    data, versions, expiries = self.server.fetch_entries(keys)
+    return codec.unpack_batch(data), versions, expiries
 
   def find_node(self, key_hash) :
-    node_info = self.server.find_node(key_hash)
+    node_info = self.server.find_successor(str(key_hash))
     self.logger.debug("Making new proxy for %s", node_info)
     return self.node_translator.from_descr(node_info)
 
+  def find_closest(self, key_hash, count, sender=None) :
+    if sender is not None :
+      sender = self.node_translator.to_descr(sender)
+    return [self.node_translator.from_descr(descr) for descr
+            in self.server.find_closest(str(key_hash), count, sender)]
+
+  def koorde_step(self, key_hash, imaginary, shifted) :
+    descr, imaginary, shifted, done = self.server.koorde_step(
+      str(key_hash), str(imaginary), shifted)
+    return (self.node_translator.from_descr(descr), int(imaginary), shifted,
+            done)
+
   def closest_preceding_node(self, key_hash) :
-    node_info = self.server.closest_preceding_node(key_hash)
+    node_info = self.server.closest_preceding_node(str(key_hash))
     self.logger.debug("Closest node to %d is %s", key_hash, node_info)
     return self.node_translator.from_descr(node_info)
 
@@ -179,15 +275,23 @@ class NodeProxy(object) :
       self.node_translator.to_descr(successor_of_leaving))
 
 
-  def prepend_node(self, node, url=None) :
-    return self.server.prepend_node(self.node_translator.to_descr(node))
-
-  def setup(self, predecessor, fingers, data) :
-    self.server.setup(
-      self.node_translator.to_descr(predecessor),
-      dict((str(step), self.node_translator.to_descr(finger))
-           for step, finger in fingers.iteritems()),
-      data)
+  def prepend_node(self, node, url=None, known_versions=None) :
+    descr = self.node_translator.to_descr(node)
+    # Only passed when given, so nodes from before warm restarts can
+    # still be joined
+    if known_versions is None :
+      return self.server.prepend_node(descr)
+    return self.server.prepend_node(descr, known_versions)
+
+  def setup(self, predecessor, fingers, data, versions=None, expiries=None,
+            unchanged=None) :
+    params = (self.node_translator.to_descr(predecessor),
+              dict((str(step), self.node_translator.to_descr(finger))
+                   for step, finger in fingers.iteritems()),
+              codec.pack_batch(data), versions, expiries)
+    if unchanged is not None :
+      params += (unchanged,)
+    self.server.setup(*params)
 
   def get_fingers(self) :
     fingers = self.server.get_fingers()
@@ -195,6 +299,13 @@ class NodeProxy(object) :
                    for step, descr in fingers.iteritems())
     return fingers
 
+  def get_load(self) :
+    return self.server.get_load()
+
+  def split_point(self, by="keys") :
+    rslt = self.server.split_point(by)
+    return int(rslt) if rslt is not None else None
+
   def repair_fingers(self) :
     return self.server.repair_fingers()
 
@@ -207,9 +318,11 @@ class NodeProxy(object) :
       self.id, new_successor.id)
     self.server.successor_leaving(self.node_translator.to_descr(new_successor))
 
-  def predecessor_leaving(self, new_predecessor,data) :
+  def predecessor_leaving(self, new_predecessor, data, versions=None,
+                          expiries=None) :
     self.server.predecessor_leaving(
-      self.node_translator.to_descr(new_predecessor), data)
+      self.node_translator.to_descr(new_predecessor), codec.pack_batch(data),
+      versions, expiries)
 
   def leave(self) :
     return self.server.leave()
@@ -218,64 +331,220 @@ class NodeProxy(object) :
 class ConnectionError(Exception) :
   pass
 
+class VersionConflict(Exception) :
+  pass
+
+class PeerMaintainer(threading.Thread) :
+  """Keeps a client's set of peers topped up, off the request path
+
+  Every interval seconds, or as soon as the client loses a peer, it
+  looks for more if the client knows fewer than it wants.  The client
+  only starts one the first time it loses a peer."""
+
+  def __init__(self, client, interval=30) :
+    threading.Thread.__init__(self, name="PeerMaintainer")
+    self.daemon = True
+    # Only a weak reference, so a client dropped without being closed
+    # can still be collected, and the thread ends with it
+    self.client = weakref.ref(client)
+    self.interval = interval
+    self.wakeup = threading.Event()
+    self._stop_event = threading.Event()
+    self.logger = logging.getLogger("dyschord.client.maintainer")
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      self.wakeup.wait(self.interval)
+      self.wakeup.clear()
+      if self._stop_event.is_set() :
+        break
+      client = self.client()
+      if client is None :
+        break
+      try :
+        client.refresh_peers()
+      except ConnectionError, e :
+        self.logger.warn("Unable to find peers: %s", e)
+      del client
+
+  def stop(self) :
+    self._stop_event.set()
+    self.wakeup.set()
+
+
 class Client(object) :
   """Client to a cloud of dyschord nodes"""
-  def __init__(self, peers, min_connections=3) :
+
+  # Weight of each new round trip time in the moving averages
+  rtt_smoothing = 0.2
+
+  def __init__(self, peers, min_connections=3, cache_size=0,
+               compress_threshold=codec.default_threshold,
+               serializer=codec.json_serializer, refresh_interval=30) :
     """Create a client to a cloud of dyschord nodes
 
     parameters
     - peers                A list of urls of nodes to initiate
                            the connections
-    - min_connections      Minimum number of connections to try to keep up"""
+    - min_connections      Minimum number of connections to try to keep up
+    - cache_size           Maximum number of values to cache locally
+                           under read leases, 0 to turn off caching
+    - compress_threshold   Encoded values at least this many bytes
+                           long are compressed, None to never
+                           compress
+    - serializer           Object with dumps and loads methods used
+                           to encode values.  Its flags attribute
+                           should be codec.RAW if it produces binary
+                           data rather than text.
+    - refresh_interval     Seconds between checks for more peers in
+                           the background, once the client has lost
+                           one, None to only look for them when the
+                           client is created or has none left"""
     self.logger = logging.getLogger("dyschord.client")
+    self.cache = LRUCache(max_entries=cache_size, ttl=None) \
+        if cache_size else None
+    self.compress_threshold = compress_threshold
+    self.serializer = serializer
+    self.peers = list(peers)
     self.cloud = {}
-    for p in peers :
+    # Moving average of the round trip time to each peer, failed
+    # requests included, and the requests waiting on each
+    self.latency = {}
+    self._outstanding = {}
+    self._lock = threading.Lock()
+    self.min_connections = min_connections
+    self.refresh_interval = refresh_interval
+    self.maintainer = None
+    self._closed = False
+    self._connect_to_seeds()
+    if len(self.cloud) < self.min_connections :
+      self._find_connections()
+
+  def close(self) :
+    """Stop looking for peers in the background"""
+    with self._lock :
+      self._closed = True
+      maintainer = self.maintainer
+    if maintainer is not None :
+      maintainer.stop()
+      maintainer.join()
+
+  def _connect_to_seeds(self) :
+    for p in self.peers :
       peer = NodeProxy(p)
       try :
         peer_id = peer.id
       except (socket.error, socket.timeout) :
         # Error connecting to node
         continue
-      self.cloud[p] = peer
+      with self._lock :
+        self.cloud[p] = peer
     if not self.cloud :
       raise ConnectionError("Unable to connect to any nodes")
-    self.min_connections = min_connections
-    if len(self.cloud) < self.min_connections :
-      self._find_connections()
 
   def _find_connections(self) :
     # Try find more connections to bring number of connections back at
-    # or above minimum desired
-    known_peers = list(self.cloud.values())
+    # or above minimum desired.  The lock is only held to update the
+    # cloud, so requests carry on with the peers already known.
+    with self._lock :
+      known_peers = list(self.cloud.values())
     while len(self.cloud) < self.min_connections and known_peers :
       peer = known_peers.pop(0)
       try :
         others = peer.get_fingers()
       except (socket.error, socket.timeout) :
-        del self.cloud[peer.url]
+        self._drop(peer.url)
         continue
-      for finger in others.itervalues() :
-        if finger.url not in self.cloud :
-          self.cloud[finger.url] = finger
-          known_peers.append(finger)
+      with self._lock :
+        for finger in others.itervalues() :
+          if finger.url not in self.cloud :
+            self.cloud[finger.url] = finger
+            known_peers.append(finger)
     if not self.cloud :
       raise ConnectionError("Unable to connect to any nodes")
     if len(self.cloud) < self.min_connections :
       self.logger.warn("Only aware of %d peers", len(self.cloud))
 
+  def refresh_peers(self) :
+    """Look for more peers if fewer than min_connections are known,
+    starting over from the peers the client was created with if all
+    of them have been lost"""
+    if not self.cloud :
+      self._connect_to_seeds()
+    if len(self.cloud) < self.min_connections :
+      self._find_connections()
+
+  def _expected_latency(self, url) :
+    # Peers not tried yet count as fastest, so they get tried
+    return self.latency.get(url, 0.0) * (self._outstanding.get(url, 0) + 1)
+
+  def _pick_peer(self, exclude) :
+    # Power of two choices: of two peers picked at random, the one
+    # expected to answer sooner.  Always picking the best of them all
+    # would have every client pile onto the same node.
+    with self._lock :
+      candidates = [url for url in self.cloud if url not in exclude]
+      if not candidates :
+        return None, None
+      pair = random.sample(candidates, min(2, len(candidates)))
+      url = min(pair, key=self._expected_latency)
+      self._outstanding[url] = self._outstanding.get(url, 0) + 1
+      return url, self.cloud[url]
+
+  def _record(self, url, rtt) :
+    with self._lock :
+      self._outstanding[url] -= 1
+      previous = self.latency.get(url)
+      if previous is None :
+        self.latency[url] = rtt
+      else :
+        self.latency[url] = previous + self.rtt_smoothing * (rtt - previous)
+
+  def _drop(self, url) :
+    # The latency is kept, with the time the failure took, so the peer
+    # has to prove itself again if it's found again
+    with self._lock :
+      self.cloud.pop(url, None)
+      if len(self.cloud) >= self.min_connections or not self.refresh_interval :
+        return
+      # Started the first time it's needed, so a client that never
+      # loses a peer doesn't get a thread
+      if self.maintainer is None and not self._closed :
+        self.maintainer = PeerMaintainer(self, self.refresh_interval)
+        self.maintainer.start()
+      maintainer = self.maintainer
+    if maintainer is not None :
+      maintainer.wakeup.set()
+
   def _node_method(self, method) :
-    while self.cloud :
-      cloud = self.cloud.items()
-      random.shuffle(cloud)
-      for peer_id, peer in cloud :
-        try :
-          return method(peer)
-        except (socket.error, socket.timeout) :
-          # Error connecting to node
-          del self.cloud[peer_id]
-          continue
-    else :
-      raise ConnectionError("No nodes up")
+    tried = set()
+    refreshed = False
+    while True :
+      url, peer = self._pick_peer(tried)
+      if peer is None :
+        if refreshed :
+          raise ConnectionError("No nodes up")
+        # Out of peers, so rather than wait for the maintainer, look
+        # for more now, from the seeds if need be
+        refreshed = True
+        self.refresh_peers()
+        continue
+      tried.add(url)
+      start = time.time()
+      try :
+        return method(peer)
+      except (socket.error, socket.timeout) :
+        # Error connecting to node
+        self._drop(url)
+      finally :
+        self._record(url, time.time() - start)
+
+  def _encode(self, value, serializer=None) :
+    return codec.encode(value, serializer or self.serializer,
+                        self.compress_threshold)
+
+  def _decode(self, value, serializer=None) :
+    return codec.decode(value, serializer or self.serializer)
 
   def lookup(self, key) :
     """Lookup value for key
@@ -284,29 +553,143 @@ class Client(object) :
       - key       string
 
     Raises KeyError if not found"""
+    return self._lookup(key, self.serializer)
+
+  def lookup_bytes(self, key) :
+    """Lookup the raw bytes stored for key with store_bytes
+
+    parameters:
+      - key       string
+
+    Raises KeyError if not found"""
+    return self._lookup(key, codec.raw_serializer)
+
+  def _lookup(self, key, serializer) :
     # Note: keys are str not basestring, to avoid worrying about unicode issues
     if not isinstance(key, str) :
       raise Exception("Unable to handle nonstring key %s" % key)
-    self._find_connections()
+    if self.cache is not None :
+      try :
+        # Cached values are shared, so callers must not modify them
+        (cached_serializer, value), version = self.cache.get(key)
+      except KeyError :
+        pass
+      else :
+        if cached_serializer is serializer :
+          return value
 
     try :
-      rslt = self._node_method(lambda node : node.lookup(key))
+      if self.cache is None :
+        return self._decode(self._node_method(lambda node : node.lookup(key)),
+                            serializer)
+      # The lease is counted from before the request was sent, so it
+      # always runs out here before it does on the owner.
+      requested = time.time()
+      rslt, version, lease = self._node_method(
+        lambda node : node.lookup_leased(key))
     except xmlrpclib.Fault, e :
       if e.faultCode == 404 :
         raise KeyError(e.faultString)
       raise
-    else :
-      return json.loads(rslt)
+    value = self._decode(rslt, serializer)
+    remaining = lease - (time.time() - requested)
+    if remaining > 0 :
+      self.cache.put(key, (serializer, value), version, ttl=remaining)
+    return value
 
-  def store(self, key, value) :
+  def store(self, key, value, ttl=None) :
     """Store value for key
 
     parameters:
       - key       string
-      - value     a json-encodable object"""
+      - value     an object the client's serializer can encode (by
+                  default, any json-encodable object)
+      - ttl       seconds after which the key expires, or None to keep
+                  it until it is overwritten"""
+    self._store(key, value, self.serializer, ttl)
+
+  def store_bytes(self, key, data, ttl=None) :
+    """Store raw bytes for key
+
+    The bytes are sent and stored as a binary blob, without any JSON
+    encoding.
+
+    parameters:
+      - key       string
+      - data      a byte string
+      - ttl       seconds after which the key expires"""
+    self._store(key, data, codec.raw_serializer, ttl)
+
+  def _store(self, key, value, serializer, ttl=None) :
     if not isinstance(key, str) :
       raise Exception("Unable to handle nonstring key %s" % key)
-    self._find_connections()
+    encoded = self._encode(value, serializer)
+    if self.cache is not None :
+      self.cache.invalidate(key)
+    self._node_method(lambda node : node.store(key, encoded, ttl))
+
+  def lookup_versioned(self, key) :
+    """Lookup value and version for key
+
+    parameters:
+      - key       string
 
-    json_value = json.dumps(value)
-    self._node_method(lambda node : node.store(key, json_value))
+    Returns a (value, version) pair.  Raises KeyError if not found"""
+    if not isinstance(key, str) :
+      raise Exception("Unable to handle nonstring key %s" % key)
+    try :
+      rslt, version = self._node_method(
+        lambda node : node.lookup_versioned(key))
+    except xmlrpclib.Fault, e :
+      if e.faultCode == 404 :
+        raise KeyError(e.faultString)
+      raise
+    return self._decode(rslt), version
+
+  def lookup_if_changed(self, key, version) :
+    """Lookup value for key if it has changed since version
+
+    parameters:
+      - key       string
+      - version   version returned by an earlier lookup
+
+    Returns a (value, version) pair, or None if the key is still at
+    version, in which case the value is not transferred.  Raises
+    KeyError if not found"""
+    if not isinstance(key, str) :
+      raise Exception("Unable to handle nonstring key %s" % key)
+    try :
+      rslt = self._node_method(
+        lambda node : node.lookup_if_changed(key, version))
+    except xmlrpclib.Fault, e :
+      if e.faultCode == 404 :
+        raise KeyError(e.faultString)
+      raise
+    if not rslt["modified"] :
+      return None
+    return self._decode(rslt["value"]), rslt["version"]
+
+  def store_if(self, key, value, expected_version, ttl=None) :
+    """Store value for key if the key is still at expected_version
+
+    parameters:
+      - key               string
+      - value             an object the client's serializer can encode
+      - expected_version  version returned by an earlier lookup, or 0
+                          if the key must not exist yet
+      - ttl               seconds after which the key expires
+
+    Returns the new version.  Raises VersionConflict if the key has
+    been changed."""
+    if not isinstance(key, str) :
+      raise Exception("Unable to handle nonstring key %s" % key)
+    encoded = self._encode(value)
+    if self.cache is not None :
+      self.cache.invalidate(key)
+    try :
+      return self._node_method(
+        lambda node : node.store_if(key, encoded, expected_version, ttl))
+    except xmlrpclib.Fault, e :
+      if e.faultCode == 409 :
+        raise VersionConflict(e.faultString)
+      raise
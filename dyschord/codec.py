@@ -0,0 +1,129 @@
+"""Wire and storage encodings for values
+
+Values normally travel as the JSON text the client produced.  Large
+values, and values that are raw bytes rather than JSON, are sent as an
+XML-RPC Binary whose first byte holds flags describing the encoding.
+The nodes never look inside values, so they keep the encoded form in
+memory and in backups, and only the reading client decodes it.
+
+Bulk transfers between nodes (joins, departures and backups) are
+packed into a single compressed blob as well."""
+
+import json
+import xmlrpclib
+import zlib
+
+# Flags for the header byte of encoded values
+COMPRESSED = 0x01
+RAW = 0x02
+# Only set by the nodes, on the markers bounded-load placement leaves
+# in place of a value stored elsewhere
+DISPLACED = 0x04
+
+# Values shorter than this aren't worth compressing
+default_threshold = 1024
+
+# Batch marker, so a packed batch is never confused with a value
+_BATCH = "B"
+
+
+class JsonSerializer(object) :
+  """Serializes json-encodable objects (the default)"""
+  flags = 0
+
+  def dumps(self, value) :
+    return json.dumps(value)
+
+  def loads(self, payload) :
+    return json.loads(payload)
+
+
+class RawSerializer(object) :
+  """Passes byte strings through untouched"""
+  flags = RAW
+
+  def dumps(self, value) :
+    if not isinstance(value, str) :
+      raise TypeError("Raw values must be byte strings, not %s"
+                      % type(value).__name__)
+    return value
+
+  def loads(self, payload) :
+    return payload
+
+
+json_serializer = JsonSerializer()
+raw_serializer = RawSerializer()
+
+
+def encode_value(payload, threshold=default_threshold, flags=0) :
+  """Encode a serialized value for storage
+
+  The payload is compressed if it's at least threshold bytes long.
+  Returns either the payload itself, for uncompressed JSON, or an
+  xmlrpclib.Binary."""
+  if isinstance(payload, unicode) :
+    payload = payload.encode("utf-8")
+  if threshold is not None and len(payload) >= threshold :
+    compressed = zlib.compress(payload)
+    # Skip incompressible values, so the reader doesn't pay to
+    # decompress them
+    if len(compressed) < len(payload) :
+      payload = compressed
+      flags |= COMPRESSED
+  if not flags :
+    return payload
+  return xmlrpclib.Binary(chr(flags) + payload)
+
+
+def value_flags(value) :
+  """Flags of an encoded value"""
+  if not isinstance(value, xmlrpclib.Binary) :
+    return 0
+  return ord(value.data[0])
+
+
+def decode_value(value) :
+  """Return the serialized payload of an encoded value"""
+  if not isinstance(value, xmlrpclib.Binary) :
+    return value
+  flags = ord(value.data[0])
+  payload = value.data[1:]
+  if flags & COMPRESSED :
+    payload = zlib.decompress(payload)
+  return payload
+
+
+def encode(value, serializer=json_serializer, threshold=default_threshold) :
+  """Serialize and encode value for storage"""
+  return encode_value(serializer.dumps(value), threshold, serializer.flags)
+
+
+def decode(value, serializer=json_serializer) :
+  """Inverse of encode
+
+  Raises TypeError if the value was stored with a serializer of a
+  different kind."""
+  if value_flags(value) & RAW != serializer.flags & RAW :
+    raise TypeError("Value was not stored with a %s"
+                    % type(serializer).__name__)
+  return serializer.loads(decode_value(value))
+
+
+def pack_batch(data) :
+  """Pack a dictionary of keys and values into one compressed blob"""
+  return xmlrpclib.Binary(
+    _BATCH + zlib.compress(xmlrpclib.dumps((data,), allow_none=True)))
+
+
+def unpack_batch(batch) :
+  """Inverse of pack_batch
+
+  Dictionaries are returned unchanged, so nodes still accept batches
+  from peers that don't pack them."""
+  if not isinstance(batch, xmlrpclib.Binary) :
+    return batch
+  if batch.data[:1] != _BATCH :
+    raise ValueError("Not a packed batch")
+  params, method = xmlrpclib.loads(zlib.decompress(batch.data[1:]))
+  return params[0]
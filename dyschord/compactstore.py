@@ -0,0 +1,359 @@
+"""Compact node storage
+
+A dictionary of strings costs over a hundred bytes per entry on top of
+the key and value themselves: the dict slot, and a full string object
+for each.  A CompactStore instead keeps the keys and values as bytes
+in a single arena, and everything else in flat arrays forming an open
+addressing hash table, which is roughly half the memory for small
+entries.  It also keeps the ring hash of each key, so the node can
+find which keys fall in a range without hashing them all again, and
+the node's version and expiry time of each key, in the versions and
+expiry mappings, so the node doesn't need dictionaries of its own with
+another entry per key.
+
+Values come back as new objects on every lookup, so there is no
+sharing between readers, but it costs a copy."""
+
+import array
+from collections import MutableMapping
+import cPickle
+import struct
+import sys
+import xmlrpclib
+
+
+# Value types, in the low bits of the tags
+_STR = 0
+_UNICODE = 1
+_BINARY = 2
+_PICKLE = 3
+# Set in the tags of unicode keys, which are stored UTF-8 encoded
+_UNICODE_KEY = 0x10
+# Set in the tags of keys with a version and an expiry time
+_VERSIONED = 0x20
+_EXPIRES = 0x40
+_FIELDS = _VERSIONED | _EXPIRES
+
+_EMPTY = -1
+_DELETED = -2
+
+# Ring hashes are kept as 16 bytes, big-endian
+_ring_hash = struct.Struct(">QQ")
+_LOW_BITS = 2**64 - 1
+
+
+def _encode(value) :
+  if isinstance(value, str) :
+    return _STR, value
+  if isinstance(value, unicode) :
+    return _UNICODE, value.encode("utf-8")
+  if isinstance(value, xmlrpclib.Binary) :
+    return _BINARY, value.data
+  return _PICKLE, cPickle.dumps(value, 2)
+
+
+def _decode(tag, data) :
+  tag &= 0xf
+  if tag == _STR :
+    return data
+  if tag == _UNICODE :
+    return data.decode("utf-8")
+  if tag == _BINARY :
+    return xmlrpclib.Binary(data)
+  return cPickle.loads(data)
+
+
+class CompactStore(MutableMapping) :
+
+  def __init__(self, hash_key, capacity=8, compact_threshold=1 << 20) :
+    """Create an empty store
+
+    parameters
+    - hash_key            Hash function of the node's metric, whose
+                          results are kept with the keys
+    - capacity            Initial number of slots, rounded up to a
+                          power of two.  The table doubles when it is
+                          two thirds full.
+    - compact_threshold   Bytes of overwritten entries the arena may
+                          hold before it is rewritten, as long as they
+                          are also at least half of it"""
+    self.hash_key = hash_key
+    self.compact_threshold = compact_threshold
+    size = 8
+    while size < capacity :
+      size *= 2
+    self._allocate(size)
+    self._arena = bytearray()
+    self._garbage = 0
+    self.versions = _Field(self, "_versions", _VERSIONED)
+    self.expiry = _Field(self, "_expiries", _EXPIRES)
+
+  def _allocate(self, size) :
+    self._mask = size - 1
+    self._used = 0
+    # Slots holding a deleted entry, which probes must step over
+    self._deleted = 0
+    # Offset of each entry in the arena, or _EMPTY or _DELETED
+    self._offsets = array.array("l", [_EMPTY]) * size
+    # Python hash of the key, to skip comparing most keys' bytes
+    self._key_hashes = array.array("l", [0]) * size
+    # Ring hash of the key
+    self._ring_hashes = bytearray(_ring_hash.size * size)
+    self._key_lengths = array.array("I", [0]) * size
+    self._value_lengths = array.array("I", [0]) * size
+    self._tags = array.array("B", [0]) * size
+    # Version and expiry time of each key, for the fields whose flags
+    # are set in the tags
+    self._versions = array.array("l", [0]) * size
+    self._expiries = array.array("d", [0.0]) * size
+
+  def __len__(self) :
+    return self._used
+
+  def _find(self, key, encoded_key, key_hash) :
+    # Slot holding key, or the slot it should go in if it's missing,
+    # as a (slot, found) pair
+    offsets = self._offsets
+    mask = self._mask
+    slot = key_hash & mask
+    # Perturbed probing, as the dictionary does, so keys with similar
+    # hashes don't pile up in runs
+    perturb = key_hash & sys.maxint
+    free = None
+    while True :
+      offset = offsets[slot]
+      if offset == _EMPTY :
+        return (slot if free is None else free), False
+      if offset == _DELETED :
+        if free is None :
+          free = slot
+      elif (self._key_hashes[slot] == key_hash
+            and self._key_lengths[slot] == len(encoded_key)
+            and self._arena[offset:offset + len(encoded_key)] == encoded_key) :
+        return slot, True
+      slot = (5*slot + 1 + perturb) & mask
+      perturb >>= 5
+
+  @staticmethod
+  def _encode_key(key) :
+    if isinstance(key, unicode) :
+      return key.encode("utf-8"), _UNICODE_KEY
+    if not isinstance(key, str) :
+      raise TypeError("Keys must be strings, not %r" % (key,))
+    return key, 0
+
+  def _slot_of(self, key) :
+    # Slot holding key, or None
+    try :
+      encoded_key, key_tag = self._encode_key(key)
+    except TypeError :
+      return None
+    slot, found = self._find(key, encoded_key, hash(key))
+    return slot if found else None
+
+  def _key_at(self, slot) :
+    offset = self._offsets[slot]
+    key = str(self._arena[offset:offset + self._key_lengths[slot]])
+    if self._tags[slot] & _UNICODE_KEY :
+      return key.decode("utf-8")
+    return key
+
+  def _value_at(self, slot) :
+    start = self._offsets[slot] + self._key_lengths[slot]
+    return _decode(self._tags[slot],
+                   str(self._arena[start:start + self._value_lengths[slot]]))
+
+  def __contains__(self, key) :
+    try :
+      encoded_key, key_tag = self._encode_key(key)
+    except TypeError :
+      return False
+    return self._find(key, encoded_key, hash(key))[1]
+
+  def __getitem__(self, key) :
+    encoded_key, key_tag = self._encode_key(key)
+    slot, found = self._find(key, encoded_key, hash(key))
+    if not found :
+      raise KeyError(key)
+    return self._value_at(slot)
+
+  def __setitem__(self, key, value) :
+    encoded_key, key_tag = self._encode_key(key)
+    key_hash = hash(key)
+    tag, data = _encode(value)
+    slot, found = self._find(key, encoded_key, key_hash)
+    if found :
+      # Overwriting the value keeps the version and expiry time
+      tag |= self._tags[slot] & _FIELDS
+      if len(data) <= self._value_lengths[slot] :
+        # Fits where the old value was
+        start = self._offsets[slot] + len(encoded_key)
+        self._garbage += self._value_lengths[slot] - len(data)
+        self._arena[start:start + len(data)] = data
+        self._value_lengths[slot] = len(data)
+        self._tags[slot] = tag | key_tag
+        return
+      self._garbage += len(encoded_key) + self._value_lengths[slot]
+    else :
+      if self._offsets[slot] == _DELETED :
+        self._deleted -= 1
+      self._used += 1
+      ring_hash = self.hash_key(key)
+      _ring_hash.pack_into(self._ring_hashes, slot * _ring_hash.size,
+                           ring_hash >> 64, ring_hash & _LOW_BITS)
+      self._key_hashes[slot] = key_hash
+      self._key_lengths[slot] = len(encoded_key)
+    self._offsets[slot] = len(self._arena)
+    self._arena += encoded_key
+    self._arena += data
+    self._value_lengths[slot] = len(data)
+    self._tags[slot] = tag | key_tag
+    if found :
+      self._maybe_compact()
+    elif (self._used + self._deleted) * 3 > len(self._offsets) * 2 :
+      self._resize(len(self._offsets) * 2 if self._used * 3 > len(self._offsets)
+                   else len(self._offsets))
+
+  def __delitem__(self, key) :
+    encoded_key, key_tag = self._encode_key(key)
+    slot, found = self._find(key, encoded_key, hash(key))
+    if not found :
+      raise KeyError(key)
+    self._garbage += self._key_lengths[slot] + self._value_lengths[slot]
+    self._offsets[slot] = _DELETED
+    self._used -= 1
+    self._deleted += 1
+    self._maybe_compact()
+
+  def _slots(self) :
+    offsets = self._offsets
+    return [slot for slot in xrange(len(offsets)) if offsets[slot] >= 0]
+
+  def __iter__(self) :
+    # Like a dictionary, modifying the store while iterating over it
+    # isn't allowed, but it isn't detected either.
+    for slot in self._slots() :
+      yield self._key_at(slot)
+
+  def iteritems(self) :
+    for slot in self._slots() :
+      yield self._key_at(slot), self._value_at(slot)
+
+  def iterhashes(self) :
+    """(key, ring hash) pairs, without hashing the keys again"""
+    for slot in self._slots() :
+      high, low = _ring_hash.unpack_from(self._ring_hashes,
+                                         slot * _ring_hash.size)
+      yield self._key_at(slot), (high << 64) | low
+
+  def iterhashed_items(self) :
+    """(key, ring hash, value) triples"""
+    for slot in self._slots() :
+      high, low = _ring_hash.unpack_from(self._ring_hashes,
+                                         slot * _ring_hash.size)
+      yield self._key_at(slot), (high << 64) | low, self._value_at(slot)
+
+  def clear(self) :
+    self._allocate(8)
+    self._arena = bytearray()
+    self._garbage = 0
+
+  def _resize(self, size) :
+    # Rehashing reuses the stored hashes, and writes the entries to a
+    # new arena, dropping the garbage
+    old = (self._offsets, self._key_hashes, self._ring_hashes,
+           self._key_lengths, self._value_lengths, self._tags,
+           self._versions, self._expiries)
+    old_arena = self._arena
+    self._allocate(size)
+    self._arena = bytearray()
+    self._garbage = 0
+    (offsets, key_hashes, ring_hashes, key_lengths, value_lengths, tags,
+     versions, expiries) = old
+    width = _ring_hash.size
+    mask = self._mask
+    for i in xrange(len(offsets)) :
+      offset = offsets[i]
+      if offset < 0 :
+        continue
+      key_hash = key_hashes[i]
+      slot = key_hash & mask
+      perturb = key_hash & sys.maxint
+      while self._offsets[slot] != _EMPTY :
+        slot = (5*slot + 1 + perturb) & mask
+        perturb >>= 5
+      length = key_lengths[i] + value_lengths[i]
+      self._offsets[slot] = len(self._arena)
+      self._arena += old_arena[offset:offset + length]
+      self._key_hashes[slot] = key_hash
+      self._ring_hashes[slot*width:(slot + 1)*width] = \
+          ring_hashes[i*width:(i + 1)*width]
+      self._key_lengths[slot] = key_lengths[i]
+      self._value_lengths[slot] = value_lengths[i]
+      self._tags[slot] = tags[i]
+      self._versions[slot] = versions[i]
+      self._expiries[slot] = expiries[i]
+      self._used += 1
+
+  def _maybe_compact(self) :
+    if (self._garbage >= self.compact_threshold
+        and self._garbage * 2 >= len(self._arena)) :
+      self._resize(len(self._offsets))
+
+  def memory_usage(self) :
+    """Bytes used by the store's buffers"""
+    arrays = (self._offsets, self._key_hashes, self._ring_hashes,
+              self._key_lengths, self._value_lengths, self._tags,
+              self._versions, self._expiries)
+    return (sys.getsizeof(self._arena)
+            + sum(sys.getsizeof(a) for a in arrays))
+
+
+class _Field(MutableMapping) :
+  """One of the per-key fields kept in the store's arrays, as a mapping
+
+  Only keys in the store can have the field, so setting it for any
+  other key raises KeyError, and a key deleted from the store loses
+  it."""
+
+  def __init__(self, store, values, flag) :
+    self._store = store
+    # Name of the store's array, which is replaced when it resizes
+    self._values = values
+    self._flag = flag
+
+  def _slot_with(self, key) :
+    slot = self._store._slot_of(key)
+    if slot is None or not self._store._tags[slot] & self._flag :
+      raise KeyError(key)
+    return slot
+
+  def __getitem__(self, key) :
+    return getattr(self._store, self._values)[self._slot_with(key)]
+
+  def __setitem__(self, key, value) :
+    store = self._store
+    slot = store._slot_of(key)
+    if slot is None :
+      raise KeyError(key)
+    getattr(store, self._values)[slot] = value
+    store._tags[slot] |= self._flag
+
+  def __delitem__(self, key) :
+    self._store._tags[self._slot_with(key)] &= ~self._flag
+
+  def _slots(self) :
+    tags = self._store._tags
+    return [slot for slot in self._store._slots() if tags[slot] & self._flag]
+
+  def __iter__(self) :
+    for slot in self._slots() :
+      yield self._store._key_at(slot)
+
+  def __len__(self) :
+    return len(self._slots())
+
+  def clear(self) :
+    tags = self._store._tags
+    for slot in self._slots() :
+      tags[slot] &= ~self._flag
@@ -0,0 +1,91 @@
+"""Read leases for client-side caching
+
+A client can only cache a value if it knows the value won't change
+underneath it.  The owning node grants short read leases, and before
+changing a key it revokes them: new leases for the key are refused and
+the write waits until the outstanding ones have run out.  Clients
+aren't servers, so they can't be called back, and waiting out the
+lease is the only way to revoke it.  Keep the duration short."""
+
+import contextlib
+import threading
+import time
+
+
+class LeaseTable(object) :
+  """Tracks the read leases granted for each key"""
+
+  def __init__(self, duration=2.0, clock=time.time, sleep=time.sleep) :
+    """Create a new lease table
+
+    parameters
+    - duration  Seconds each lease is valid for
+    - clock     Time function, replaceable for testing
+    - sleep     Sleep function, replaceable for testing"""
+    self.duration = duration
+    self.clock = clock
+    self.sleep = sleep
+    self._expiry = {}
+    self._pending_writes = {}
+    self._lock = threading.Lock()
+    self._prune_at = 1024
+
+  def _prune(self, now) :
+    # Expired leases are only removed when the table grows, so the
+    # cost is amortized over the grants.
+    if len(self._expiry) < self._prune_at :
+      return
+    for key, expiry in self._expiry.items() :
+      if expiry <= now :
+        del self._expiry[key]
+    self._prune_at = max(1024, 2*len(self._expiry))
+
+  def grant(self, key) :
+    """Grant a lease for key
+
+    Returns the lease duration in seconds, or 0 if a write to the key
+    is in progress and no lease can be granted."""
+    with self._lock :
+      if self._pending_writes.get(key) :
+        return 0
+      now = self.clock()
+      self._expiry[key] = now + self.duration
+      self._prune(now)
+      return self.duration
+
+  @contextlib.contextmanager
+  def writing(self, key) :
+    """Context manager to revoke the leases on key for a write
+
+    Blocks until all leases granted on key have expired."""
+    with self._lock :
+      self._pending_writes[key] = self._pending_writes.get(key, 0) + 1
+      expiry = self._expiry.pop(key, None)
+    try :
+      if expiry is not None :
+        remaining = expiry - self.clock()
+        if remaining > 0 :
+          self.sleep(remaining)
+      yield
+    finally :
+      with self._lock :
+        self._pending_writes[key] -= 1
+        if not self._pending_writes[key] :
+          del self._pending_writes[key]
+
+  def __len__(self) :
+    return len(self._expiry)
+
+
+class NoLeases(object) :
+  """Lease table for nodes that don't grant leases"""
+
+  def grant(self, key) :
+    return 0
+
+  @contextlib.contextmanager
+  def writing(self, key) :
+    yield
+
+  def __len__(self) :
+    return 0
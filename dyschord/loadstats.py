@@ -0,0 +1,68 @@
+"""Request load tracking for a node
+
+The rebalancer needs a rough idea of how busy each node is.  Counting
+every request forever would let old bursts dominate, so the counts
+decay exponentially with a configurable half life."""
+
+import collections
+import math
+import threading
+import time
+
+
+class LoadTracker(object) :
+  """Exponentially decayed request rate counter
+
+  Besides the per-operation rates, the hashes of the most recently
+  requested keys are kept so a node can tell where in its range the
+  requests are landing."""
+
+  def __init__(self, half_life=60.0, nsamples=256, clock=time.time) :
+    """Create a new load tracker
+
+    parameters
+    - half_life  Seconds for a recorded request to lose half its weight
+    - nsamples   Number of recent key hashes to remember
+    - clock      Time function, replaceable for testing"""
+    self.half_life = float(half_life)
+    self.clock = clock
+    self.recent_hashes = collections.deque(maxlen=nsamples)
+    self._counts = {}
+    self._last_decay = clock()
+    self._lock = threading.Lock()
+
+  def _decay(self, now) :
+    elapsed = now - self._last_decay
+    if elapsed <= 0 :
+      return
+    factor = 0.5 ** (elapsed / self.half_life)
+    for op in self._counts :
+      self._counts[op] *= factor
+    self._last_decay = now
+
+  def record(self, op, key_hash=None) :
+    """Record a single request of type op"""
+    with self._lock :
+      self._decay(self.clock())
+      self._counts[op] = self._counts.get(op, 0.0) + 1
+      if key_hash is not None :
+        self.recent_hashes.append(key_hash)
+
+  def rates(self) :
+    """Requests per second for each operation"""
+    # A constant rate r decays to a steady count of r/lambda, where
+    # lambda = ln(2)/half_life, so scaling by lambda recovers the rate.
+    scale = math.log(2) / self.half_life
+    with self._lock :
+      self._decay(self.clock())
+      return dict((op, count * scale) for op, count in self._counts.iteritems())
+
+  def rate(self) :
+    """Total requests per second over all operations"""
+    return sum(self.rates().itervalues())
+
+  def reset(self) :
+    with self._lock :
+      self._counts.clear()
+      self.recent_hashes.clear()
+      self._last_decay = self.clock()
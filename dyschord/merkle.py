@@ -0,0 +1,120 @@
+"""Hash trees for comparing a node's data with its replica's
+
+The ring is cut into 2**depth buckets by the top bits of the key
+hashes, and each bucket gets the XOR of the digests of its (key,
+version) entries.  Each node of the tree above holds the XOR of its
+children, so adding or removing an entry only touches the path from
+its bucket to the root, and two nodes holding the same entries in a
+range of the ring have the same digests for every tree node inside
+it.
+
+The tree is stored heap-ordered in a flat list: the root is 1, the
+children of i are 2*i and 2*i + 1, and the buckets are leaves through
+2*leaves - 1."""
+
+import hashlib
+
+
+def entry_digest(key, version) :
+  if isinstance(key, unicode) :
+    key = key.encode("utf-8")
+  return int(hashlib.md5("%s\0%d" % (key, version)).hexdigest(), 16)
+
+
+class MerkleTree(object) :
+
+  def __init__(self, hash_bits=128, depth=10, hashed_keys=None) :
+    """Create an empty tree
+
+    parameters
+    - hash_bits     Bits in the ring size, as for the metric
+    - depth         Levels below the root.  The tree has 2**depth
+                    buckets.
+    - hashed_keys   Callable giving the (key, hash) pairs of every
+                    entry, for a store that keeps the hashes already.
+                    The keys in a bucket are then found by going
+                    through those, rather than kept in the tree too."""
+    self.hash_bits = hash_bits
+    self.depth = depth
+    self.leaves = 1 << depth
+    self._shift = max(0, hash_bits - depth)
+    self.digests = [0] * (2 * self.leaves)
+    self._hashed_keys = hashed_keys
+    # Keys in each bucket, for the buckets that have any
+    self._bucket_keys = {} if hashed_keys is None else None
+
+  def bucket(self, key_hash) :
+    return key_hash >> self._shift
+
+  def is_leaf(self, index) :
+    return index >= self.leaves
+
+  def _toggle(self, key, key_hash, version) :
+    # XOR is its own inverse, so the same walk adds and removes
+    digest = entry_digest(key, version)
+    digests = self.digests
+    i = self.leaves + self.bucket(key_hash)
+    while i :
+      digests[i] ^= digest
+      i >>= 1
+
+  def add(self, key, key_hash, version) :
+    self._toggle(key, key_hash, version)
+    if self._bucket_keys is None :
+      return
+    self._bucket_keys.setdefault(self.bucket(key_hash), set()).add(key)
+
+  def remove(self, key, key_hash, version) :
+    self._toggle(key, key_hash, version)
+    if self._bucket_keys is None :
+      return
+    bucket = self.bucket(key_hash)
+    keys = self._bucket_keys[bucket]
+    keys.discard(key)
+    if not keys :
+      del self._bucket_keys[bucket]
+
+  def keys_in(self, buckets) :
+    """Keys in the given buckets"""
+    if self._bucket_keys is None :
+      buckets = set(buckets)
+      for key, key_hash in self._hashed_keys() :
+        if self.bucket(key_hash) in buckets :
+          yield key
+      return
+    for bucket in buckets :
+      for key in self._bucket_keys.get(bucket, ()) :
+        yield key
+
+  def clear(self) :
+    self.digests = [0] * (2 * self.leaves)
+    if self._bucket_keys is not None :
+      self._bucket_keys.clear()
+
+  def cover(self, start, end) :
+    """Fewest tree nodes whose buckets together hold the ring range
+    (start, end]
+
+    The buckets at the ends can also hold hashes outside the range."""
+    size = 2**self.hash_bits
+    first = self.bucket((start + 1) % size)
+    last = self.bucket(end % size)
+    if (start + 1) % size <= end % size :
+      spans = [(first, last)]
+    else :
+      # Wraps past zero
+      spans = [(first, self.leaves - 1), (0, last)]
+    nodes = set()
+    for first, last in spans :
+      low = first + self.leaves
+      high = last + self.leaves + 1
+      while low < high :
+        if low & 1 :
+          nodes.add(low)
+          low += 1
+        if high & 1 :
+          high -= 1
+          nodes.add(high)
+        low >>= 1
+        high >>= 1
+    return sorted(nodes)
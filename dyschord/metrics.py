@@ -0,0 +1,149 @@
+"""Lightweight counters and histograms for monitoring nodes
+
+Everything here is meant to be left on in production, so recording a
+value is just a lock, a bisect and a couple of additions."""
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+
+# Bucket upper bounds for latencies, doubling from 10 microseconds,
+# which covers everything from a dictionary lookup to a timed out RPC.
+latency_bounds = [1e-5 * 2**i for i in xrange(24)]
+
+# Bucket upper bounds for small counts, such as routing hops
+count_bounds = range(1, 17) + [24, 32, 48, 64, 128]
+
+
+# Name of what the current thread is doing, for attributing the RPCs it
+# makes to the maintenance task that caused them
+_activity = threading.local()
+
+
+def current_activity() :
+  return getattr(_activity, "name", None)
+
+
+def attributed(name) :
+  """Decorator marking the RPCs made by a function as part of activity name
+
+  The proxies count each request made under an activity as
+  "rpcs.<name>".  Nested activities are attributed to the innermost."""
+  def decorator(function) :
+    @functools.wraps(function)
+    def wrapped(*args, **kwargs) :
+      previous = current_activity()
+      _activity.name = name
+      try :
+        return function(*args, **kwargs)
+      finally :
+        _activity.name = previous
+    return wrapped
+  return decorator
+
+
+class Histogram(object) :
+  """Fixed-bucket histogram"""
+
+  def __init__(self, bounds=latency_bounds) :
+    self.bounds = bounds
+    # The last bucket holds everything above the largest bound
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0
+    self.max = None
+
+  def observe(self, value) :
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+    if self.max is None or value > self.max :
+      self.max = value
+
+  def percentile(self, fraction) :
+    """Upper bound of the bucket holding the given fraction of values"""
+    if not self.count :
+      return None
+    target = fraction * self.count
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts) :
+      seen += count
+      if seen >= target :
+        return min(bound, self.max)
+    return self.max
+
+  def snapshot(self) :
+    return {"count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            # Only the non-empty buckets, as [upper bound, count] pairs
+            "buckets": [[bound, count] for bound, count
+                        in zip(self.bounds + ["inf"], self.counts) if count]}
+
+
+class Registry(object) :
+  """Named counters, histograms and gauges"""
+
+  def __init__(self) :
+    self.counters = {}
+    self.histograms = {}
+    # Functions called when a snapshot is taken
+    self.gauges = {}
+    self.started = time.time()
+    self._lock = threading.Lock()
+
+  def count(self, name, n=1) :
+    with self._lock :
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def observe(self, name, value, bounds=latency_bounds) :
+    with self._lock :
+      try :
+        histogram = self.histograms[name]
+      except KeyError :
+        histogram = self.histograms[name] = Histogram(bounds)
+      histogram.observe(value)
+
+  @contextlib.contextmanager
+  def timed(self, name) :
+    """Context manager recording the time spent in the block"""
+    start = time.time()
+    try :
+      yield
+    finally :
+      self.observe(name, time.time() - start)
+
+  def gauge(self, name, function) :
+    self.gauges[name] = function
+
+  def snapshot(self) :
+    """Dictionary of all the metrics, suitable for sending over XML-RPC"""
+    with self._lock :
+      rslt = {"uptime": time.time() - self.started,
+              "counters": dict(self.counters),
+              "histograms": dict((name, histogram.snapshot())
+                                 for name, histogram
+                                 in self.histograms.iteritems())}
+    rslt["gauges"] = dict((name, function())
+                          for name, function in self.gauges.iteritems())
+    return rslt
+
+  def render_text(self) :
+    """Plain text listing of the metrics, one value per line"""
+    snapshot = self.snapshot()
+    lines = ["uptime %f" % snapshot["uptime"]]
+    for name, value in sorted(snapshot["counters"].iteritems()) :
+      lines.append("%s %d" % (name, value))
+    for name, value in sorted(snapshot["gauges"].iteritems()) :
+      lines.append("%s %s" % (name, value))
+    for name, histogram in sorted(snapshot["histograms"].iteritems()) :
+      for field in ("count", "sum", "max", "p50", "p99") :
+        lines.append("%s.%s %s" % (name, field, histogram[field]))
+      for bound, count in histogram["buckets"] :
+        lines.append('%s.bucket{le="%s"} %d' % (name, bound, count))
+    return "\n".join(lines) + "\n"
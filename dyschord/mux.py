@@ -0,0 +1,308 @@
+"""Multiplexed XML-RPC between nodes
+
+xmlrpclib sends one request at a time over a connection and waits for
+the response, so a node forwarding many lookups at once to the same
+finger needs a connection for each.  Here each node keeps a single
+connection to each peer and tags every request with an id.  Any
+number of calls can be in flight on it at once; the peer handles each
+in its own thread and sends the responses back as they finish, in
+whatever order, and the ids match them up with the waiting callers.
+
+Each frame is an 8 byte header, the request id and the payload length
+as big-endian unsigned ints, followed by the payload, which is the
+same XML-RPC request or response that would have been sent over HTTP,
+so the server dispatches it exactly like one that came in over HTTP."""
+
+import errno
+import itertools
+import logging
+import socket
+import struct
+import threading
+import time
+import xmlrpclib
+
+from . import metrics as metrics_module
+
+_header = struct.Struct(">II")
+# struct timeval, for SO_SNDTIMEO
+_timeval = struct.Struct("ll")
+
+_logger = logging.getLogger("dyschord.mux")
+
+
+def _recv_exactly(sock, size) :
+  chunks = []
+  while size :
+    chunk = sock.recv(min(size, 1 << 16))
+    if not chunk :
+      raise socket.error("Connection closed")
+    chunks.append(chunk)
+    size -= len(chunk)
+  return "".join(chunks)
+
+
+def _read_frame(sock) :
+  request_id, size = _header.unpack(_recv_exactly(sock, _header.size))
+  return request_id, _recv_exactly(sock, size)
+
+
+def _write_frame(sock, request_id, payload) :
+  sock.sendall(_header.pack(request_id, len(payload)) + payload)
+
+
+class _Call(object) :
+  # A request waiting for its response
+  __slots__ = ("done", "payload", "error")
+
+  def __init__(self) :
+    self.done = threading.Event()
+    self.payload = None
+    self.error = None
+
+
+class Channel(object) :
+  """Connection to one peer, shared by all the calls made to it"""
+
+  def __init__(self, address, timeout=5) :
+    """Connect to a peer
+
+    parameters
+    - address   (host, port) the peer's mux listener is on
+    - timeout   Seconds to wait for a connection or a response"""
+    self.address = address
+    self.timeout = timeout
+    self.sock = socket.create_connection(address, timeout)
+    # Timeouts are per call, not per read, since the reader waits for
+    # whichever response comes next.  Writes still need one, or a peer
+    # that stops reading would leave every caller stuck behind the
+    # write lock.
+    self.sock.settimeout(None)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                         _timeval.pack(int(timeout),
+                                       int(timeout % 1 * 1000000)))
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.closed = False
+    self._ids = itertools.count(1)
+    self._pending = {}
+    self._lock = threading.Lock()
+    self._write_lock = threading.Lock()
+    self._reader = threading.Thread(target=self._read_responses,
+                                    name="mux-reader")
+    self._reader.daemon = True
+    self._reader.start()
+
+  def _read_responses(self) :
+    try :
+      while True :
+        request_id, payload = _read_frame(self.sock)
+        with self._lock :
+          call = self._pending.pop(request_id, None)
+        # Calls that timed out are gone already
+        if call is not None :
+          call.payload = payload
+          call.done.set()
+    except (socket.error, struct.error), e :
+      self._fail(e)
+
+  def _fail(self, error) :
+    # Fail every outstanding call, and the channel, so it gets replaced
+    with self._lock :
+      self.closed = True
+      pending, self._pending = self._pending, {}
+    for call in pending.itervalues() :
+      call.error = error
+      call.done.set()
+
+  def call(self, method, params) :
+    """Call method on the peer, returning its result
+
+    Raises xmlrpclib.Fault if the method raised, and socket.error or
+    socket.timeout if the peer couldn't be reached in time."""
+    call = _Call()
+    with self._lock :
+      if self.closed :
+        raise socket.error("Channel to %s:%d closed" % self.address)
+      request_id = next(self._ids) & 0xffffffff
+      self._pending[request_id] = call
+    request = xmlrpclib.dumps(params, method, allow_none=True)
+    try :
+      with self._write_lock :
+        _write_frame(self.sock, request_id, request)
+    except socket.error, e :
+      # Part of the frame may have gone, so the channel can't be used
+      # again either way
+      self.close()
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) :
+        raise socket.timeout("Unable to send to %s:%d" % self.address)
+      raise
+    if not call.done.wait(self.timeout) :
+      with self._lock :
+        self._pending.pop(request_id, None)
+      raise socket.timeout("No response from %s:%d to %s"
+                           % (self.address + (method,)))
+    if call.error is not None :
+      raise socket.error(str(call.error))
+    return xmlrpclib.loads(call.payload)[0][0]
+
+  def close(self) :
+    try :
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error :
+      pass
+    self.sock.close()
+    self._fail(socket.error("Channel closed"))
+
+
+class ChannelPool(object) :
+  """One channel per peer, reconnected when it fails"""
+
+  def __init__(self, timeout=5) :
+    self.timeout = timeout
+    self._channels = {}
+    self._lock = threading.Lock()
+
+  def get(self, address) :
+    with self._lock :
+      channel = self._channels.get(address)
+    if channel is not None and not channel.closed :
+      return channel
+    # Connect without the lock, so a peer that's down doesn't hold up
+    # calls to the others
+    channel = Channel(address, self.timeout)
+    with self._lock :
+      current = self._channels.get(address)
+      if current is not None and not current.closed :
+        # Someone else connected first
+        extra, channel = channel, current
+      else :
+        extra = None
+        self._channels[address] = channel
+    if extra is not None :
+      extra.close()
+    return channel
+
+  def close(self) :
+    with self._lock :
+      channels, self._channels = self._channels, {}
+    for channel in channels.itervalues() :
+      channel.close()
+
+
+# Shared by all the proxies in the process
+pool = ChannelPool()
+
+
+class MuxServerProxy(object) :
+  """Drop-in for an xmlrpclib.ServerProxy that calls over a channel
+
+  parameters
+  - address   (host, port) of the peer's mux listener
+  - host      Name to record latencies under, normally the host and
+              port of the peer's url, as for HTTP calls
+  - metrics   Optional metrics.Registry"""
+
+  def __init__(self, address, host=None, metrics=None, pool=pool) :
+    self.address = address
+    self.host = host or "%s:%d" % address
+    self.metrics = metrics
+    self.pool = pool
+
+  def _call(self, method, params) :
+    if self.metrics is None :
+      return self.pool.get(self.address).call(method, params)
+    activity = metrics_module.current_activity()
+    if activity is not None :
+      self.metrics.count("rpcs.%s" % activity)
+    start = time.time()
+    try :
+      return self.pool.get(self.address).call(method, params)
+    except (socket.error, socket.timeout) :
+      self.metrics.count("peer_errors.%s" % self.host)
+      raise
+    finally :
+      self.metrics.observe("peer_latency.%s" % self.host, time.time() - start)
+
+  def __getattr__(self, name) :
+    if name.startswith("__") :
+      raise AttributeError(name)
+    return lambda *params : self._call(name, params)
+
+  def __call__(self, attr) :
+    # Like ServerProxy, for proxy("close")().  The channel is shared,
+    # so there's nothing to close.
+    if attr == "close" :
+      return lambda : None
+    raise AttributeError(attr)
+
+
+class MuxListener(threading.Thread) :
+  """Accepts channels and dispatches their requests to an XML-RPC server
+
+  Each request runs in its own thread, so a slow one doesn't hold up
+  those behind it on the same channel."""
+
+  def __init__(self, server, port, host="localhost") :
+    """Listen for channels
+
+    parameters
+    - server   SimpleXMLRPCServer whose registered functions to call
+    - port     Port to listen on"""
+    threading.Thread.__init__(self, name="mux-listener")
+    self.daemon = True
+    self.server = server
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind((host, port))
+    self.sock.listen(64)
+    self.address = self.sock.getsockname()
+    self._request_ids = itertools.count(1)
+    self._stop_event = threading.Event()
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      try :
+        conn, peer = self.sock.accept()
+      except socket.error :
+        if self._stop_event.is_set() :
+          break
+        raise
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      thread = threading.Thread(target=self._serve, args=(conn, peer),
+                                name="mux-connection")
+      thread.daemon = True
+      thread.start()
+
+  def _serve(self, conn, peer) :
+    write_lock = threading.Lock()
+    try :
+      while True :
+        request_id, payload = _read_frame(conn)
+        thread = threading.Thread(
+          target=self._handle, args=(conn, write_lock, request_id, payload),
+          name="mux-request-%d" % next(self._request_ids))
+        thread.daemon = True
+        thread.start()
+    except (socket.error, struct.error), e :
+      _logger.debug("Channel from %s:%d closed: %s", peer[0], peer[1], e)
+    finally :
+      conn.close()
+
+  def _handle(self, conn, write_lock, request_id, payload) :
+    # _marshaled_dispatch turns exceptions into faults, the same as
+    # for HTTP requests
+    response = self.server._marshaled_dispatch(payload)
+    try :
+      with write_lock :
+        _write_frame(conn, request_id, response)
+    except socket.error, e :
+      _logger.debug("Unable to send response %d: %s", request_id, e)
+
+  def stop(self) :
+    self._stop_event.set()
+    try :
+      # Wakes up the accept
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error :
+      pass
+    self.sock.close()
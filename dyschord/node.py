@@ -8,8 +8,13 @@ import logging
 import socket
 import itertools
 import threading
+import time
 
 from . import readwritelock
+from . import loadstats
+from . import merkle
+from . import metrics
+from . import timerwheel
 
 _logger = logging.getLogger("dyschord.core")
 
@@ -65,16 +70,23 @@ def compute_finger_steps(hash_bits, finger_table_size) :
 
 
 # Node finding function taken from <http://www.linuxjournal.com/article/6797>
-def find_predecessor(start, key_hash) :
+#
+# If given, record_hops is called with the number of nodes the lookup
+# went through.
+def find_predecessor(start, key_hash, record_hops=None) :
   _logger.debug("Finding predecessor for %d starting at node %d",
                 key_hash, start.id)
   current = start
+  hops = 0
   while True :
     next = current.closest_preceding_node(key_hash)
     if next.id == current.id :
       break
     else :
       current = next
+      hops += 1
+  if record_hops is not None :
+    record_hops(hops)
   return current
 
 
@@ -91,8 +103,8 @@ def find_predecessor_without_fingers(start, key_hash) :
       break
   return current
 
-def find_node(start, key_hash) :
-  rslt = find_predecessor(start, key_hash)
+def find_node(start, key_hash, record_hops=None) :
+  rslt = find_predecessor(start, key_hash, record_hops)
   return rslt.next
 
 
@@ -102,6 +114,9 @@ class Uninitialized(Exception) :
 class RingBroken(Exception) :
   pass
 
+class VersionMismatch(Exception) :
+  pass
+
 # Helper function to deactivate methods while the node is starting up.
 # The other options are:
 #
@@ -142,13 +157,15 @@ def initialization_check(wrappee) :
 
 class Node(MutableMapping) :
 
-  def __init__(self, id=None, nfingers=None, metric=None) :
+  def __init__(self, id=None, nfingers=None, metric=None, store=None) :
     """Create a new node
 
     parameters
     - id         The id of the node, None means random
     - nfingers   The number of fingers in the finger table
-    - metric     The metric to use. Md5Metric by default"""
+    - metric     The metric to use. Md5Metric by default
+    - store      Empty mutable mapping to keep the data in, such as a
+                 spillstore.SpillingStore.  A dict by default."""
 
     self.__metric = metric if metric else Md5Metric()
 
@@ -163,7 +180,32 @@ class Node(MutableMapping) :
     else :
       self.id = id
 
-    self.data = {}
+    self.data = store if store is not None else {}
+    # Version of each key owned by this node, bumped on every write so
+    # cached copies elsewhere can be invalidated.  Stores that can keep
+    # it with the data, like compactstore.CompactStore, save another
+    # dictionary entry per key, and the same for the expiry times.
+    self.versions = getattr(self.data, "versions", None)
+    if self.versions is None :
+      self.versions = {}
+    # Callables taking (key, version), run after each successful write
+    # or deletion.  version is None for deletions.
+    self.write_listeners = []
+    # Absolute expiry time of each key stored with a ttl, backups
+    # included, and the wheel that says when to drop them.
+    self.expiry = getattr(self.data, "expiry", None)
+    if self.expiry is None :
+      self.expiry = {}
+    self.clock = time.time
+    self.timers = timerwheel.TimerWheel(now=self.clock())
+    # Digests of the (key, version) entries, for comparing the data
+    # with the successor's backups.  A store that keeps the key hashes
+    # also saves the tree keeping every key by bucket.
+    self.merkle = merkle.MerkleTree(
+      self.__metric.hash_bits,
+      hashed_keys=getattr(self.data, "iterhashes", None))
+    # Routing overlay, which sets itself here when attached
+    self.overlay = None
 
     self.predecessor = self
     if not nfingers :
@@ -176,6 +218,14 @@ class Node(MutableMapping) :
     self.logger = _logger.getChild("Node")
     self.data_lock = readwritelock.RWLock()
     self.finger_lock = readwritelock.RWLock()
+    self.load = loadstats.LoadTracker()
+    self.metrics = metrics.Registry()
+    self.data_lock.wait_observer = functools.partial(
+      self.metrics.observe, "data_lock_wait")
+    self.finger_lock.wait_observer = functools.partial(
+      self.metrics.observe, "finger_lock_wait")
+    if hasattr(self.data, "register_metrics") :
+      self.data.register_metrics(self.metrics)
 
   @property
   def distance(self) :
@@ -185,6 +235,10 @@ class Node(MutableMapping) :
   def hash_key(self) :
     return self.__metric.hash_key
 
+  @property
+  def hash_bits(self) :
+    return self.__metric.hash_bits
+
   def get_next(self) :
     # Need to lock this in case it gets hit while prepending a new node
     with self.finger_lock.rdlocked() :
@@ -228,25 +282,84 @@ class Node(MutableMapping) :
 
   @initialization_check
   def __getitem__(self, key) :
-    if not self._responsible_for(self.hash_key(key)) :
+    key_hash = self.hash_key(key)
+    if not self._responsible_for(key_hash) :
       raise Exception("Node %d not responsible for key %d"
-                      % (self.id, self.hash_key(key)))
+                      % (self.id, key_hash))
+    self.load.record("lookup", key_hash)
     with self.data_lock.rdlocked() :
+      if self._expired(key) :
+        raise KeyError(key)
       return self.data[key]
 
+  @initialization_check
+  def get_versioned(self, key) :
+    """Return the (value, version) pair for key"""
+    key_hash = self.hash_key(key)
+    if not self._responsible_for(key_hash) :
+      raise Exception("Node %d not responsible for key %d"
+                      % (self.id, key_hash))
+    self.load.record("lookup", key_hash)
+    with self.data_lock.rdlocked() :
+      if self._expired(key) :
+        raise KeyError(key)
+      return self.data[key], self.versions.get(key, 0)
+
+  def _notify_write(self, key, version) :
+    for listener in self.write_listeners :
+      try :
+        listener(key, version)
+      except Exception :
+        self.logger.exception("Write listener failed for key %s", key)
+
   @initialization_check
   def __setitem__(self, key, value) :
+    self._store(key, value)
+
+  @initialization_check
+  def store(self, key, value, ttl=None) :
+    """Set key to value, expiring after ttl seconds if given
+
+    Returns the new version."""
+    return self._store(key, value, ttl=ttl)
+
+  @initialization_check
+  def set_if(self, key, value, expected_version, ttl=None) :
+    """Set key to value only if its version is expected_version
+
+    An expected_version of 0 means the key must not exist yet, or has
+    expired.  Returns the new version, or raises VersionMismatch."""
+    return self._store(key, value, expected_version, ttl)
+
+  def _store(self, key, value, expected_version=None, ttl=None) :
     self.logger.debug("Setting key %s to value %s", key, value)
-    if not self._responsible_for(self.hash_key(key)) :
+    key_hash = self.hash_key(key)
+    if not self._responsible_for(key_hash) :
       raise Exception("Node %d responsible for key %d"
-                      % (self.id, self.hash_key(key)))
+                      % (self.id, key_hash))
+    self.load.record("store", key_hash)
+    expiry = self.clock() + ttl if ttl is not None else None
     with self.data_lock.wrlocked() :
+      old_version = self.versions.get(key, 0)
+      # The version keeps counting up through an expiry, so caches
+      # can't mistake the new value for the old one, but to a
+      # conditional store an expired key is as good as missing.
+      current_version = 0 if self._expired(key) else old_version
+      if (expected_version is not None
+          and expected_version != current_version) :
+        raise VersionMismatch(
+          "Key %s is at version %d, not %d"
+          % (key, current_version, expected_version))
+      version = old_version + 1
       old_value_exists = True
       try :
         old_value = self.data[key]
       except KeyError :
         old_value_exists = False
+      old_expiry = self.expiry.get(key)
+      self._untrack(key)
       self.data[key] = value
+      self._set_expiry(key, expiry)
       try :
         self.logger.debug("Backing up in successors")
         current = self
@@ -254,7 +367,7 @@ class Node(MutableMapping) :
         for node in itertools.islice(walk(self.next), self.n_backups) :
           if self.id == node.id :
             break
-          node.store_backup(key, value, current)
+          node.store_backup(key, value, current, version, expiry)
           current = node
       except Exception :
         self.logger.info("Problem backing up data.  Rolling back")
@@ -262,10 +375,16 @@ class Node(MutableMapping) :
           self.data[key] = old_value
         else :
           del self.data[key]
+        self._set_expiry(key, old_expiry)
+        self._track(key)
         raise
+      self.versions[key] = version
+      self._track(key)
+    self._notify_write(key, version)
+    return version
 
   @initialization_check
-  def store_backup(self, key, value, predecessor) :
+  def store_backup(self, key, value, predecessor, version=None, expiry=None) :
     # predecessor is the preceding node, as determined by the node
     # who's data is being backed up.  If this does not match our
     # actual predecessor, there is a problem with the pointers in the
@@ -276,12 +395,131 @@ class Node(MutableMapping) :
         raise RingBroken(
           "Storing backup for node %d, but actual predecessor is %d"
           % (predecessor.id, self.predecessor.id))
+      self._untrack(key)
       self.data[key] = value
+      if version is not None :
+        self.versions[key] = version
+      self._set_expiry(key, expiry)
+      self._track(key)
+
+  @staticmethod
+  def _subset(mapping, keys) :
+    return dict((k, mapping[k]) for k in keys if k in mapping)
+
+  def _versions_for(self, keys) :
+    # Versions of the given keys, to send along with the data when
+    # handing it to another node.  Must hold the data lock.
+    versions = self.versions
+    return dict((k, versions[k]) for k in keys if k in versions)
+
+  def _expiries_for(self, keys) :
+    # Same for expiry times
+    expiry = self.expiry
+    return dict((k, expiry[k]) for k in keys if k in expiry)
+
+  def _expired(self, key, now=None) :
+    # Expired keys stay in data until the reaper gets to them, so
+    # anything reading data directly has to check.  Must hold the
+    # data lock.
+    expiry = self.expiry.get(key)
+    if expiry is None :
+      return False
+    return expiry <= (self.clock() if now is None else now)
+
+  def _live_items(self) :
+    # Items of data that haven't expired.  Must hold the data lock.
+    now = self.clock()
+    return ((k, v) for k, v in self.data.iteritems()
+            if not self._expired(k, now))
+
+  def _key_hashes(self) :
+    # (key, hash) pairs of the data.  Stores that keep the hashes, like
+    # compactstore.CompactStore, save hashing every key again.
+    if hasattr(self.data, "iterhashes") :
+      return self.data.iterhashes()
+    return ((k, self.hash_key(k)) for k in self.data)
+
+  def _live_hashed_items(self) :
+    # (key, hash, value) for the data that hasn't expired.  Must hold
+    # the data lock.
+    now = self.clock()
+    if hasattr(self.data, "iterhashed_items") :
+      items = self.data.iterhashed_items()
+    else :
+      items = ((k, self.hash_key(k), v) for k, v in self.data.iteritems())
+    return ((k, key_hash, v) for k, key_hash, v in items
+            if not self._expired(k, now))
+
+  def _set_expiry(self, key, expiry) :
+    # Must hold the data lock for writing
+    if expiry is None :
+      if self.expiry.pop(key, None) is not None :
+        self.timers.cancel(key)
+    else :
+      self.expiry[key] = expiry
+      self.timers.schedule(key, expiry)
+
+  def _untrack(self, key) :
+    # Take key out of the Merkle tree before changing it.  Must hold
+    # the data lock for writing.
+    if key in self.data :
+      self.merkle.remove(key, self.hash_key(key), self.versions.get(key, 0))
+
+  def _track(self, key) :
+    # And put it back afterwards
+    if key in self.data :
+      self.merkle.add(key, self.hash_key(key), self.versions.get(key, 0))
+
+  def _forget(self, key) :
+    # Must hold the data lock for writing
+    self._untrack(key)
+    del self.data[key]
+    self.versions.pop(key, None)
+    self._set_expiry(key, None)
+
+  def _take_data(self, data, versions, expiries=None) :
+    # Must hold the data lock for writing
+    for k in data :
+      self._untrack(k)
+    self.data.update(data)
+    if versions :
+      self.versions.update(versions)
+    expiries = expiries or {}
+    for k in data :
+      self._set_expiry(k, expiries.get(k))
+      self._track(k)
+
+  def expire(self, now=None) :
+    """Drop the keys whose ttl has run out, backups included
+
+    Returns the number of keys dropped."""
+    if now is None :
+      now = self.clock()
+    dropped = []
+    with self.data_lock.wrlocked() :
+      for key in self.timers.advance(now) :
+        if key not in self.data :
+          continue
+        if not self._expired(key, now) :
+          # Only if the clock was changed under the wheel
+          self.timers.schedule(key, self.expiry[key])
+          continue
+        # Only the owner tells caches; backups just disappear
+        owned = (self.initialized
+                 and self._responsible_for(self.hash_key(key)))
+        self._forget(key)
+        if owned :
+          dropped.append(key)
+        self.metrics.count("expired")
+    for key in dropped :
+      self._notify_write(key, None)
+    return len(dropped)
 
   @initialization_check
   def __delitem__(self, key) :
     with self.data_lock.wrlocked() :
-      del self.data[key]
+      self._forget(key)
+    self._notify_write(key, None)
 
   @initialization_check
   def iterkeys(self) :
@@ -289,8 +527,8 @@ class Node(MutableMapping) :
     # Instead I won't bother and fall back on the same failure cases
     # that a normal python dictionary has (e.g. iterators throw
     # exceptions if the keys of the underlying dict have changes.)
-    return (k for k in self.data.iterkeys()
-            if self._responsible_for(self.hash_key(k)))
+    return (k for k, key_hash in self._key_hashes()
+            if self._responsible_for(key_hash))
   __iter__ = iterkeys
 
   @initialization_check
@@ -301,15 +539,15 @@ class Node(MutableMapping) :
   @initialization_check
   def __contains__(self, key) :
     with self.data_lock.rdlocked() :
-      return key in self.data
+      return key in self.data and not self._expired(key)
 
   @initialization_check
   def __len__(self) :
     # Because I'm storing not storing the backup data in a separate
     # dictionary, computing the length is not O(1), but O(n).
     with self.data_lock.rdlocked() :
-      return sum(1 for key in self.data
-                 if self._responsible_for(self.hash_key(key)))
+      return sum(1 for key, key_hash in self._key_hashes()
+                 if self._responsible_for(key_hash))
 
 
   @initialization_check
@@ -338,6 +576,86 @@ class Node(MutableMapping) :
       self.logger.log(5, "Closest node is myself")
       return self
 
+  @initialization_check
+  def get_load(self) :
+    """Summary of the request rate and data size of this node's range"""
+    return {"requests": self.load.rate(), "keys": len(self)}
+
+  @initialization_check
+  def split_point(self, by="keys") :
+    """Hash that divides this node's range into two halves
+
+    by is either "keys", to split the stored keys evenly, or
+    "requests", to split the recently requested keys evenly.  Returns
+    None if there is nothing to split."""
+    if by == "requests" :
+      hashes = [h for h in list(self.load.recent_hashes)
+                if self._responsible_for(h)]
+    else :
+      with self.data_lock.rdlocked() :
+        hashes = [h for k, h in self._key_hashes()
+                  if self._responsible_for(h)]
+    # Order by position after the predecessor, so ranges wrapping past
+    # zero are split correctly.
+    start = self.predecessor.id
+    hashes = sorted(set(hashes), key=lambda h : self.distance(start, h))
+    if len(hashes) < 2 :
+      return None
+    return hashes[len(hashes)//2 - 1]
+
+  def relocate(self, new_id) :
+    """Move this node to a new position on the ring
+
+    The node hands off its data with the normal departure logic, then
+    rejoins in front of whichever node now owns new_id, taking over
+    the range up to its new id.
+
+    If the join fails once the node has left, it rejoins at its old
+    id, or failing that a random one, rather than be left out of the
+    ring.  Returns whether it got to new_id."""
+    successor = self.next
+    if successor.id == self.id :
+      raise Exception("Cannot relocate the only node in the ring")
+    # Check the target before leaving, since there's no going back
+    new_successor = find_node(successor, new_id)
+    if new_successor.id == new_id :
+      raise Exception("Preexisting node with id")
+    old_id = self.id
+    self.logger.info("Relocating node %d to %d", old_id, new_id)
+    self.leave()
+    self._reset(new_id)
+    try :
+      new_successor.prepend_node(self)
+      return True
+    except Exception, e :
+      self.logger.warn("Unable to join at %d: %s", new_id, e)
+    for fallback_id in (old_id, uuid.uuid4().int) :
+      for start in (successor, new_successor) :
+        self._reset(fallback_id)
+        try :
+          find_node(start, self.id).prepend_node(self)
+        except Exception, e :
+          self.logger.warn("Unable to rejoin at %d: %s", self.id, e)
+          continue
+        self.metrics.count("relocate.fallback")
+        return False
+    raise RingBroken("Node %d unable to rejoin the ring" % old_id)
+
+  def _reset(self, new_id) :
+    # Forget everything, ready to join again as new_id
+    with self.data_lock.wrlocked() :
+      with self.finger_lock.wrlocked() :
+        self.initialized = False
+        self.data.clear()
+        self.versions.clear()
+        self.expiry.clear()
+        self.timers = timerwheel.TimerWheel(now=self.clock())
+        self.merkle.clear()
+        self.load.reset()
+        self.id = new_id
+        self.predecessor = self
+        self.fingers = [self for f in self.finger_steps]
+
   def ping(self) :
     # Default ping method
     return {"id": str(self.id)}
@@ -345,6 +663,15 @@ class Node(MutableMapping) :
   def get_fingers(self) :
     return dict(zip(self.finger_steps, self.fingers))
 
+  def find_closest(self, key_hash, count, sender=None) :
+    """The nodes nearest key_hash by XOR distance that this node's
+    overlay knows of"""
+    return self.overlay.find_closest(key_hash, count, sender)
+
+  def koorde_step(self, key_hash, imaginary, shifted) :
+    """One hop of a Koorde lookup through this node"""
+    return self.overlay.step(key_hash, imaginary, shifted)
+
   def repair_successor(self) :
     with self.finger_lock.wrlocked() :
       self.logger.debug(
@@ -354,8 +681,10 @@ class Node(MutableMapping) :
         curr_successor = curr_successor.predecessor
       self.fingers[0] = curr_successor
 
+  @metrics.attributed("repair_fingers")
   def repair_fingers(self) :
     self.logger.info("Repairing fingers")
+    self.metrics.count("repair_fingers")
     furthest_known = None
     with self.finger_lock.wrlocked() :
       self.logger.debug("Old fingers: %s", [f.id for f in self.fingers])
@@ -363,6 +692,7 @@ class Node(MutableMapping) :
         try :
           finger.ping()
         except (socket.error, socket.timeout) :
+          self.metrics.count("repair_fingers.dead_fingers")
           self.fingers[i] = furthest_known
         else :
           if furthest_known is None :
@@ -378,16 +708,19 @@ class Node(MutableMapping) :
     # the node that thinks we are its predecessor.
     self.repair_successor()
 
+  @metrics.attributed("repair_predecessor")
   def repair_predecessor(self) :
     # I'll use the finger lock because the predecessor is essentially
     # another finger.
     self.logger.debug("Repairing predecessor")
+    self.metrics.count("repair_predecessor")
     with self.finger_lock.wrlocked() :
       self.logger.debug("Old predecessor %s", self.predecessor.id)
       try :
         self.predecessor.ping()
       except (socket.error, socket.timeout) :
         self.logger.warn("Preceding node %s down", self.predecessor.id)
+        self.metrics.count("repair_predecessor.replaced")
 
         # Who should it be...
         furthest_known = self
@@ -429,7 +762,11 @@ class Node(MutableMapping) :
     self.logger.debug("Notifying new predecessor %s", self.predecessor.id)
     possible_pred.successor_leaving(self)
 
-    # Need to get the data from it for backup purposes...
+    # The range of the dead predecessor is now ours, and only we had
+    # the backups of it
+    successor = self.next
+    if successor.id != self.id :
+      self.sync_backup(successor)
 
 
   def update_fingers(self) :
@@ -516,12 +853,16 @@ class Node(MutableMapping) :
 
 
   @initialization_check
-  def prepend_node(self, newnode) :
+  def prepend_node(self, newnode, known_versions=None) :
     # By making the method a "prepend node" called on the new
     # successor, I can reduce the traffic by combining the data and
     # fingers for the new node.  More importantly, I can lock the data
     # so any incoming stores for data that would no longer be in the
     # successor's control is blocked.
+    #
+    # A node restarting from a checkpoint passes the versions of the
+    # keys it has in known_versions, and only the entries whose
+    # version differs are sent, along with the keys of the rest.
 
     # Ensure the node is correct
     with self.finger_lock.wrlocked() :
@@ -544,8 +885,7 @@ class Node(MutableMapping) :
         # Setup new node
         delegated_data = {}
         to_delete = set()
-        for k, v in self.data.iteritems() :
-          key_hash = self.hash_key(k)
+        for k, key_hash, v in self._live_hashed_items() :
           if (self.distance(key_hash, newnode.id)
               < self.distance(key_hash, self.id)) :
             delegated_data[k] = v
@@ -553,9 +893,19 @@ class Node(MutableMapping) :
                 < self.distance(key_hash, newnode.id)) :
               # Was storing it as a backup, but not needed anymore
               to_delete.add(k)
+        unchanged = None
+        if known_versions is not None :
+          versions = self.versions
+          unchanged = [k for k in delegated_data
+                       if known_versions.get(k) == versions.get(k)]
+          for k in unchanged :
+            del delegated_data[k]
+          self.metrics.count("restart.unchanged", len(unchanged))
+          self.metrics.count("restart.sent", len(delegated_data))
         self.logger.debug("Sending data: %s", delegated_data)
         newnode.setup(old_predecessor, dict(old_predecessor.get_fingers()),
-                      delegated_data)
+                      delegated_data, self._versions_for(delegated_data),
+                      self._expiries_for(delegated_data), unchanged)
 
       # Establish new fingers to bring the new node into chain
       self.logger.debug("Setting my predecessor to new node")
@@ -573,17 +923,20 @@ class Node(MutableMapping) :
     # since the caller is usually the main thread of the server
     # script, it doesn't gain us that much.)
     janitor_thread = threading.Thread(target=self._data_cleanup,
-                                      args=(to_delete,))
+                                      args=(to_delete,), name="janitor")
     janitor_thread.start()
 
 
   def _data_cleanup(self, keys) :
     with self.data_lock.wrlocked() :
       for k in keys :
-        del self.data[k]
+        # Might have expired in the meantime
+        if k in self.data :
+          self._forget(k)
 
 
-  def setup(self, predecessor, fingers, data) :
+  def setup(self, predecessor, fingers, data, versions=None, expiries=None,
+            unchanged=None) :
     with self.finger_lock.wrlocked() :
       self.logger.debug("Setting up node with predecessor: %s", predecessor.id)
       self.predecessor = predecessor
@@ -592,19 +945,38 @@ class Node(MutableMapping) :
                          for finger in fingers.values()])
       self.fingers = [fingers[step] for step in self.finger_steps]
     with self.data_lock.wrlocked() :
+      if unchanged is not None :
+        # Restarted from a checkpoint.  The successor has said which
+        # entries are still current; anything else was deleted, has
+        # expired or belongs to another node by now.
+        keep = set(unchanged)
+        for k in [k for k in self.data if k not in keep] :
+          self._forget(k)
       self.logger.debug("Setting up node with data: %s", data)
-      self.data.update(data)
+      self._take_data(data, versions, expiries)
     self.initialized = True
 
+  def restore(self, data, versions, expiries=None) :
+    """Load the data from a checkpoint before joining"""
+    with self.data_lock.wrlocked() :
+      self._take_data(data, versions, expiries)
 
-  def predecessor_leaving(self, new_predecessor, data) :
+  def known_versions(self) :
+    """Versions of all the keys held, to pass to prepend_node when
+    rejoining with restored data"""
+    with self.data_lock.rdlocked() :
+      return self._versions_for(self.data)
+
+
+  def predecessor_leaving(self, new_predecessor, data, versions=None,
+                          expiries=None) :
     with self.data_lock.wrlocked() :
       old_predecessor = self.predecessor
       with self.finger_lock.wrlocked() :
         self.logger.info("Predecessor %d shutting down", self.predecessor.id)
         self.logger.debug("New predecessor %d", new_predecessor.id)
         self.logger.debug("Taking over data: %s", data)
-        self.data.update(data)
+        self._take_data(data, versions, expiries)
         self.predecessor = new_predecessor
         self.logger.debug("Checking fingers")
         for i in xrange(len(self.fingers)-1, -1, -1) :
@@ -613,7 +985,7 @@ class Node(MutableMapping) :
           elif self.fingers[i].id != self.id :
             break
     if self.next.id != self :
-      self.update_backup(data)
+      self.update_backup(data, versions, expiries)
 
   def successor_leaving(self, new_successor) :
     with self.finger_lock.wrlocked() :
@@ -628,23 +1000,90 @@ class Node(MutableMapping) :
       node.update_fingers_on_leave(old_successor, new_successor)
 
     self.logger.debug("Backing up data on new successor")
-    # If this was a clean shut down, this is unnecessary, but there's
-    # no harm in doing this check, other than network time.
-    to_backup = {}
+    # If this was a clean shut down, the new successor already has
+    # most of it, and only the differences are sent.
+    self.sync_backup(new_successor)
+
+  def update_backup(self, data, versions=None, expiries=None) :
+    with self.data_lock.wrlocked() :
+      self._take_data(data, versions, expiries)
+
+  def merkle_digests(self, indices) :
+    """Digests of the given nodes of the Merkle tree"""
     with self.data_lock.rdlocked() :
-      for k, v in self.data.iteritems() :
+      digests = self.merkle.digests
+      return [digests[i] for i in indices]
+
+  def merkle_entries(self, buckets, start, end) :
+    """Versions of the live keys in the given Merkle tree buckets that
+    fall in the ring range (start, end]"""
+    distance = self.distance
+    with self.data_lock.rdlocked() :
+      now = self.clock()
+      rslt = {}
+      for k in self.merkle.keys_in(buckets) :
         key_hash = self.hash_key(k)
-        self.logger.log(5, "Comparing key %s, predecessor.id %s, current.id %s",
-                        k, self.predecessor.id, self.id)
-        if (self.distance(key_hash, self.predecessor.id) <
-            self.distance(key_hash, self.id)) :
-          to_backup[k] = v
-    self.logger.debug("Data to backup: %s", to_backup)
-    new_successor.update_backup(to_backup)
-
-  def update_backup(self, data) :
-    with self.data_lock.wrlocked() :
-      self.data.update(data)
+        if (distance(key_hash, end) < distance(key_hash, start)
+            and not self._expired(k, now)) :
+          rslt[k] = self.versions.get(k, 0)
+      return rslt
+
+  def fetch_entries(self, keys) :
+    """The data, versions and expiry times of those keys held here"""
+    with self.data_lock.rdlocked() :
+      data = dict((k, self.data[k]) for k in keys if k in self.data)
+      return data, self._versions_for(data), self._expiries_for(data)
+
+  def sync_backup(self, replica) :
+    """Bring replica's backup of this node's range up to date
+
+    The Merkle trees are compared from the top of the range down to
+    the buckets, and only the entries in buckets that differ are
+    looked at.  Entries the replica is missing or has an older version
+    of are sent to it, and entries it has a newer version of (written
+    while this node was out of touch) are taken from it.  Nothing is
+    deleted either way.  Returns the numbers of entries sent and
+    taken."""
+    start, end = self.predecessor.id, self.id
+    if start == end or replica.id == self.id :
+      return 0, 0
+    self.metrics.count("anti_entropy.syncs")
+    tree = self.merkle
+    pending = tree.cover(start, end)
+    buckets = set()
+    while pending :
+      mine = self.merkle_digests(pending)
+      theirs = replica.merkle_digests(pending)
+      self.metrics.count("anti_entropy.rounds")
+      differing = [i for i, a, b in zip(pending, mine, theirs) if a != b]
+      buckets.update(i - tree.leaves for i in differing if tree.is_leaf(i))
+      pending = [child for i in differing if not tree.is_leaf(i)
+                 for child in (2*i, 2*i + 1)]
+    if not buckets :
+      return 0, 0
+    buckets = sorted(buckets)
+    mine = self.merkle_entries(buckets, start, end)
+    theirs = replica.merkle_entries(buckets, start, end)
+    to_send = [k for k, version in mine.iteritems()
+               if theirs.get(k, -1) < version]
+    to_take = [k for k, version in theirs.iteritems()
+               if mine.get(k, -1) < version]
+    if to_take :
+      data, versions, expiries = replica.fetch_entries(to_take)
+      with self.data_lock.wrlocked() :
+        # Anything written here in the meantime wins
+        newer = dict((k, v) for k, v in data.iteritems()
+                     if self.versions.get(k, -1) < versions.get(k, 0))
+        self._take_data(newer, self._subset(versions, newer),
+                        self._subset(expiries, newer))
+    if to_send :
+      data, versions, expiries = self.fetch_entries(to_send)
+      replica.update_backup(data, versions, expiries)
+    self.logger.debug("Anti-entropy with %d: sent %d, took %d",
+                      replica.id, len(to_send), len(to_take))
+    self.metrics.count("anti_entropy.sent", len(to_send))
+    self.metrics.count("anti_entropy.taken", len(to_take))
+    return len(to_send), len(to_take)
 
   def leave(self) :
     with self.data_lock.wrlocked() :
@@ -653,8 +1092,11 @@ class Node(MutableMapping) :
         successor = self.next
         if successor.id != self.id :
           self.logger.debug("Notifying successor: %d", successor.id)
-          self.logger.debug("Sending data: %s", self.data)
-          successor.predecessor_leaving(self.predecessor, self.data)
+          data = dict(self._live_items())
+          self.logger.debug("Sending data: %s", data)
+          successor.predecessor_leaving(self.predecessor, data,
+                                        self._versions_for(data),
+                                        self._expiries_for(data))
         if self.predecessor.id != self.id :
           self.predecessor.successor_leaving(successor)
 
@@ -672,6 +1114,7 @@ def walk(start) :
 
 
 # Update fingers of other nodes for incoming node
+@metrics.attributed("announce")
 def announce(new_node) :
   logger = logging.getLogger("dyschord")
   for node in walk(new_node) :
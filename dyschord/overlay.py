@@ -0,0 +1,388 @@
+"""Routing overlays
+
+An overlay decides how a node finds the node responsible for a hash.
+Whatever the overlay, keys are owned and backed up as in Chord, by the
+first node at or after the hash on the ring, so the overlays can be
+swapped without changing storage, joins or departures.  They only
+change the path a lookup takes to the owner.
+
+- ChordOverlay follows the finger tables, as find_node always has.
+- KademliaOverlay keeps k-buckets of contacts by XOR distance, and
+  finds the node nearest the hash in XOR distance with alpha queries
+  in parallel per round, then finishes the last, usually zero or one,
+  steps to the owner along the ring.
+- KoordeOverlay routes along a de Bruijn graph embedded in the ring,
+  keeping a constant number of pointers per node, and takes
+  O(log n / log degree) hops."""
+
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+from . import node as core
+
+
+class XorMetric(core.Md5Metric) :
+  """Kademlia's metric: MD5 hashes, with the XOR of the ids as the
+  distance
+
+  Unlike the ring distance, it is symmetric."""
+
+  def distance(self, a, b) :
+    return a ^ b
+
+
+class Overlay(object) :
+  """Routing strategy for a node
+
+  Attaching an overlay to a node sets node.overlay, so other nodes in
+  the same process can query it as they would a remote one."""
+
+  name = None
+
+  def __init__(self, node) :
+    self.node = node
+    self.metric = XorMetric(node.hash_bits)
+    self.logger = logging.getLogger("dyschord.overlay." + self.name)
+    node.overlay = self
+    node.metrics.gauge("overlay.contacts", lambda : len(self.contacts()))
+
+  def find_node(self, key_hash, record_hops=None) :
+    """Node responsible for key_hash
+
+    If given, record_hops is called with the number of nodes the
+    lookup went through."""
+    raise NotImplementedError()
+
+  def contacts(self) :
+    """The other nodes this node knows of"""
+    node = self.node
+    known = dict((f.id, f) for f in node.fingers)
+    known[node.predecessor.id] = node.predecessor
+    known.pop(node.id, None)
+    return known.values()
+
+  def learn(self, contact) :
+    """Note that contact is up"""
+    pass
+
+  def forget(self, contact) :
+    """Note that contact is down"""
+    pass
+
+  def step(self, key_hash, imaginary, shifted) :
+    """One hop of a Koorde lookup, which only KoordeOverlay supports"""
+    raise NotImplementedError("The %s overlay doesn't route Koorde lookups"
+                              % self.name)
+
+  def find_closest(self, key_hash, count, sender=None) :
+    """The count known nodes nearest key_hash by XOR distance,
+    including this one"""
+    if sender is not None :
+      self.learn(sender)
+    distance = self.metric.distance
+    known = self.contacts() + [self.node]
+    known.sort(key=lambda contact : distance(contact.id, key_hash))
+    return known[:count]
+
+
+class ChordOverlay(Overlay) :
+  """Routing by finger tables"""
+
+  name = "chord"
+
+  def find_node(self, key_hash, record_hops=None) :
+    return core.find_node(self.node, key_hash, record_hops)
+
+
+class KademliaOverlay(Overlay) :
+  """Routing by k-buckets and XOR distance
+
+  Bucket i holds up to k contacts whose ids first differ from this
+  node's at bit i, counting from the lowest.  Contacts are learned
+  from the nodes that answer lookups and those that send them, and
+  the ring's fingers and predecessor are always known too.  Like in
+  Kademlia, a full bucket keeps its old contacts rather than the new
+  one, since nodes that have been up longer tend to stay up, and dead
+  contacts are dropped when a query to them fails."""
+
+  name = "kademlia"
+
+  def __init__(self, node, k=20, alpha=3) :
+    """Attach a Kademlia overlay to node
+
+    parameters
+    - k       Contacts per bucket, and nodes returned by each query
+    - alpha   Queries sent in parallel in each round of a lookup"""
+    Overlay.__init__(self, node)
+    self.k = k
+    self.alpha = alpha
+    self.buckets = [OrderedDict() for i in xrange(node.hash_bits)]
+    self._lock = threading.Lock()
+
+  def _bucket(self, contact_id) :
+    return self.buckets[(self.node.id ^ contact_id).bit_length() - 1]
+
+  def learn(self, contact) :
+    if contact.id == self.node.id :
+      return
+    with self._lock :
+      bucket = self._bucket(contact.id)
+      if contact.id in bucket :
+        # Most recently seen at the end
+        del bucket[contact.id]
+        bucket[contact.id] = contact
+      elif len(bucket) < self.k :
+        bucket[contact.id] = contact
+
+  def forget(self, contact) :
+    if contact.id == self.node.id :
+      return
+    with self._lock :
+      self._bucket(contact.id).pop(contact.id, None)
+
+  def contacts(self) :
+    known = dict((contact.id, contact) for contact in Overlay.contacts(self))
+    with self._lock :
+      for bucket in self.buckets :
+        known.update(bucket)
+    return known.values()
+
+  def _query(self, contacts, key_hash) :
+    # Ask each contact in its own thread.  Returns a list of
+    # (contact, closest nodes it knows), with None for the contacts
+    # that couldn't be reached.
+    results = [None] * len(contacts)
+    def query(i, contact) :
+      try :
+        results[i] = contact.find_closest(key_hash, self.k, self.node)
+      except (socket.error, socket.timeout) :
+        pass
+    threads = [threading.Thread(target=query, args=(i, contact),
+                                name="kademlia-query")
+               for i, contact in enumerate(contacts)]
+    for thread in threads :
+      thread.start()
+    for thread in threads :
+      thread.join()
+    return zip(contacts, results)
+
+  def closest_node(self, key_hash) :
+    """The node nearest key_hash by XOR distance, and the number of
+    rounds of queries it took to find
+
+    Each round asks the alpha nearest nodes not asked yet for the
+    nodes they know nearest key_hash.  The lookup ends when a round
+    gets no nearer."""
+    distance = lambda contact : self.metric.distance(contact.id, key_hash)
+    shortlist = dict((contact.id, contact) for contact
+                     in self.find_closest(key_hash, self.k))
+    asked = set([self.node.id])
+    best = min(shortlist.itervalues(), key=distance)
+    rounds = 0
+    while True :
+      candidates = sorted((contact for contact in shortlist.itervalues()
+                           if contact.id not in asked), key=distance)
+      candidates = candidates[:self.alpha]
+      if not candidates :
+        break
+      rounds += 1
+      for contact, found in self._query(candidates, key_hash) :
+        asked.add(contact.id)
+        if found is None :
+          self.logger.info("Dropping unreachable contact %d", contact.id)
+          del shortlist[contact.id]
+          self.forget(contact)
+          continue
+        self.learn(contact)
+        for other in found :
+          shortlist.setdefault(other.id, other)
+      nearest = min(shortlist.itervalues(), key=distance)
+      if distance(nearest) >= distance(best) :
+        break
+      best = nearest
+    return best, rounds
+
+  def find_node(self, key_hash, record_hops=None) :
+    nearest, rounds = self.closest_node(key_hash)
+    self.node.metrics.observe("kademlia_rounds", rounds, metrics.count_bounds)
+    # The nearest node by XOR shares the longest prefix with key_hash,
+    # so it is within a few nodes of the owner on the ring.
+    ring_hops = []
+    owner = core.find_node(nearest, key_hash, ring_hops.append)
+    if record_hops is not None :
+      record_hops(rounds + ring_hops[0])
+    return owner
+
+
+class KoordeOverlay(Overlay) :
+  """Routing along a de Bruijn graph
+
+  With degree k = 2**w, the de Bruijn graph links each id m to k*m,
+  k*m + 1, ..., k*m + k - 1 (mod the ring size), so any id can be
+  reached from any other in hash_bits / w steps by shifting in the
+  target's digits w bits at a time.  Koorde has each real node stand
+  in for the imaginary ids between it and its successor: it keeps
+  pointers to the node preceding k*m and the k - 1 nodes after it,
+  which between them cover the images of its whole range.  A lookup
+  starts at an imaginary id in the first node's range that already
+  ends in the key's top digits, as many as fit, and then each hop
+  shifts in the next digit and follows a pointer, walking successors
+  when the pointer falls short.  Only the successors have to be right
+  for lookups to succeed; stale pointers just cost extra hops, and
+  where none precedes the target the fingers are used instead.
+
+  The pointers are found with an ordinary Chord lookup, when first
+  needed and again every refresh_interval seconds."""
+
+  name = "koorde"
+
+  def __init__(self, node, degree=2, refresh_interval=30) :
+    """Attach a Koorde overlay to node
+
+    parameters
+    - degree             Pointers kept, and the base of the digits
+                         shifted in per hop.  A power of two whose
+                         logarithm divides the hash size, like 2, 4 or
+                         16.
+    - refresh_interval   Seconds between lookups of the pointers"""
+    Overlay.__init__(self, node)
+    digit_bits = degree.bit_length() - 1
+    if (degree < 2 or degree != 1 << digit_bits
+        or node.hash_bits % digit_bits) :
+      raise ValueError("Unsupported Koorde degree %r" % degree)
+    self.degree = degree
+    self.digit_bits = digit_bits
+    self.refresh_interval = refresh_interval
+    self.pointers = []
+    self._refreshed = None
+    self._lock = threading.Lock()
+
+  def contacts(self) :
+    known = dict((contact.id, contact) for contact in Overlay.contacts(self))
+    known.update((pointer.id, pointer) for pointer in self.pointers)
+    known.pop(self.node.id, None)
+    return known.values()
+
+  def _between(self, x, start, end) :
+    # Whether x is in (start, end], the whole ring when they're equal
+    distance = self.node.distance
+    span = distance(start, end) or 2**self.node.hash_bits
+    return 0 < distance(start, x) <= span or x == start == end
+
+  def refresh(self) :
+    """Look up the pointers again"""
+    node = self.node
+    target = (node.id << self.digit_bits) % 2**node.hash_bits
+    try :
+      pointer = core.find_predecessor(node, target)
+      pointers = [pointer]
+      while len(pointers) < self.degree :
+        pointer = pointer.next
+        if pointer.id == pointers[0].id :
+          break
+        pointers.append(pointer)
+    except (socket.error, socket.timeout), e :
+      self.logger.warn("Unable to refresh de Bruijn pointers: %s", e)
+      return
+    self.pointers = pointers
+    self.logger.debug("De Bruijn pointers: %s", [p.id for p in pointers])
+    self.node.metrics.count("koorde.refresh")
+
+  def _maybe_refresh(self) :
+    with self._lock :
+      now = time.time()
+      if (self._refreshed is None
+          or now - self._refreshed >= self.refresh_interval) :
+        self._refreshed = now
+        self.refresh()
+
+  def _preceding(self, target) :
+    # Known node closest before target, preferring the pointers
+    node = self.node
+    distance = node.distance
+    best = node
+    for pointer in self.pointers :
+      if distance(pointer.id, target) < distance(best.id, target) :
+        best = pointer
+    if best is node :
+      self.node.metrics.count("koorde.finger_fallback")
+      best = node.closest_preceding_node(target)
+    return best
+
+  def start(self, key_hash) :
+    """Imaginary id to start a lookup of key_hash from, and the
+    number of the key's bits it already ends in"""
+    node = self.node
+    bits = node.hash_bits
+    successor = node.next
+    # The more of the key's digits fit in my range, the fewer hops
+    for shifted in xrange(bits, 0, -self.digit_bits) :
+      prefix = (node.id >> shifted) << shifted
+      suffix = key_hash >> (bits - shifted)
+      for block in (prefix, prefix + (1 << shifted)) :
+        imaginary = (block | suffix) % 2**bits
+        if self._between(imaginary, node.id, successor.id) :
+          return imaginary, shifted
+    return successor.id, 0
+
+  def step(self, key_hash, imaginary, shifted) :
+    """Take one hop of a lookup
+
+    Returns the next node, the new imaginary id and the count of the
+    key's bits it ends in, and whether the node is the owner."""
+    node = self.node
+    successor = node.next
+    if self._between(key_hash, node.id, successor.id) :
+      return successor, imaginary, shifted, True
+    bits = node.hash_bits
+    if (shifted < bits
+        and self._between(imaginary, node.id, successor.id)) :
+      self._maybe_refresh()
+      width = self.digit_bits
+      digit = (key_hash >> (bits - shifted - width)) & (self.degree - 1)
+      imaginary = ((imaginary << width) | digit) % 2**bits
+      return self._preceding(imaginary), imaginary, shifted + width, False
+    # Short of the imaginary id.  Koorde walks the successors, but the
+    # fingers get there at least as fast.
+    return node.closest_preceding_node(imaginary), imaginary, shifted, False
+
+  def find_node(self, key_hash, record_hops=None) :
+    imaginary, shifted = self.start(key_hash)
+    current = self.node
+    hops = 0
+    while True :
+      current, imaginary, shifted, done = \
+          current.koorde_step(key_hash, imaginary, shifted)
+      if done :
+        break
+      hops += 1
+    if record_hops is not None :
+      record_hops(hops)
+    return current
+
+
+overlays = {ChordOverlay.name: ChordOverlay,
+            KademliaOverlay.name: KademliaOverlay,
+            KoordeOverlay.name: KoordeOverlay}
+
+
+def make_overlay(node, config=None) :
+  """Attach the overlay described by config to node
+
+  config is the name of an overlay, a dictionary with the name under
+  "type" and the rest as options, or None for Chord."""
+  if config is None :
+    config = "chord"
+  if isinstance(config, basestring) :
+    config = {"type": config}
+  options = dict(config)
+  name = options.pop("type", "chord").lower()
+  try :
+    overlay_class = overlays[name]
+  except KeyError :
+    raise Exception('Unrecognized overlay "%s"' % name)
+  return overlay_class(node, **options)
@@ -0,0 +1,177 @@
+"""Consistent hashing with bounded loads
+
+With plain consistent hashing, a node owning a wide or popular range
+of the ring holds more than its share of the keys.  Bounded-load
+placement caps each node at factor times the average number of keys
+per node.  When a node at its cap is asked to store a key it doesn't
+have, the value is stored under a probe key, the original key tagged
+with the probe number, which hashes to a different part of the ring,
+and once it's there the node keeps a small marker under the key saying
+which probe the value went to.  The marker gets the value's ttl, so it
+doesn't outlive it.  If the probe's node is full too, it does the same
+with the next probe, up to max_probes.
+
+Lookups follow the markers, so they always end where the store did,
+however the loads have changed since.  Markers and probe keys are
+ordinary entries as far as the nodes are concerned, so they are backed
+up, moved on joins and departures, and synced like any other key."""
+
+import math
+import socket
+import threading
+import xmlrpclib
+
+from . import codec
+
+# Prefix of the keys values are displaced to.  It has to be ASCII to
+# be hashed and valid in XML to be sent, so DEL it is, and client keys
+# can't start with it.  It's a str, as is the separator, so str keys
+# holding UTF-8 are never decoded to compare them.
+_PROBE_PREFIX = "\x7fprobe"
+
+
+def probe_key(key, probe) :
+  """Key the value of key is stored under at the given probe"""
+  return "%s%d\x7f%s" % (_PROBE_PREFIX, probe, original_key(key))
+
+
+def original_key(key) :
+  """Key a probe key was made from"""
+  if key.startswith(_PROBE_PREFIX) :
+    return key.split("\x7f", 2)[2]
+  return key
+
+
+def key_probe(key) :
+  """Probe number of a key, 0 for a client's own keys"""
+  if key.startswith(_PROBE_PREFIX) :
+    return int(key[len(_PROBE_PREFIX):].split("\x7f", 1)[0])
+  return 0
+
+
+def displaced_marker(probe) :
+  """Value left in place of one moved to the given probe"""
+  return xmlrpclib.Binary(chr(codec.DISPLACED) + str(probe))
+
+
+def displaced_probe(value) :
+  """Probe a marker points to, or None if value isn't a marker"""
+  if codec.value_flags(value) & codec.DISPLACED :
+    return int(value.data[1:])
+  return None
+
+
+class BoundedLoad(object) :
+  """Decides whether a node takes a new key or passes it on"""
+
+  def __init__(self, node, factor=1.25, max_probes=32, refresh_interval=10,
+               min_capacity=100) :
+    """Create a bounded-load policy for node
+
+    parameters
+    - factor             Keys a node may hold, as a multiple of the
+                         average over the nodes sampled
+    - max_probes         Probes to try before storing a key regardless
+    - refresh_interval   Seconds between estimates of the average,
+                         made from the loads of the node's fingers by
+                         whoever calls refresh, the server's
+                         PlacementRefresher thread
+    - min_capacity       Keys a node always takes, so small clouds
+                         don't displace keys over small differences"""
+    self.node = node
+    self.factor = factor
+    self.max_probes = max_probes
+    self.refresh_interval = refresh_interval
+    self.min_capacity = min_capacity
+    self._capacity = None
+    self._keys = 0
+    self._lock = threading.Lock()
+    node.metrics.gauge("placement.capacity", lambda : self._capacity)
+
+  def _count_values(self) :
+    # Keys this node owns that hold values rather than markers.  The
+    # markers are cheap, and counting them would have a full node
+    # that keeps getting probes look fuller still.
+    node = self.node
+    with node.data_lock.rdlocked() :
+      return sum(1 for key, key_hash, value in node._live_hashed_items()
+                 if node._responsible_for(key_hash)
+                 and displaced_probe(value) is None)
+
+  def values(self) :
+    """Values this node holds, as of the last refresh plus those
+    stored since"""
+    return self._keys
+
+  def refresh(self) :
+    """Estimate the average load again
+
+    The fingers are spread over the ring, so their loads, with the
+    predecessor's, make a fair sample of the whole cloud."""
+    node = self.node
+    keys = self._count_values()
+    loads = [keys]
+    seen = set([node.id])
+    for finger in list(node.fingers) + [node.predecessor] :
+      if finger.id in seen :
+        continue
+      seen.add(finger.id)
+      try :
+        load = finger.get_load()
+      except (socket.error, socket.timeout, xmlrpclib.Fault) :
+        continue
+      loads.append(load.get("values", load["keys"]))
+    average = float(sum(loads)) / len(loads)
+    with self._lock :
+      self._keys = keys
+      self._capacity = max(self.min_capacity,
+                           int(math.ceil(self.factor * average)))
+
+  def capacity(self) :
+    """Values this node may hold, or None until the first refresh"""
+    return self._capacity
+
+  def displaced(self, key) :
+    """Probe key's value was moved to, or None"""
+    node = self.node
+    with node.data_lock.rdlocked() :
+      value = node.data.get(key)
+    return displaced_probe(value) if value is not None else None
+
+  def place(self, key) :
+    """Where a store of key should go
+
+    Returns 0 to store it on this node, or the probe to forward it to,
+    either the one the key's marker points to or, if the key is new
+    and this node is full, the next one.  The caller marks the key
+    once the store at the probe succeeds."""
+    probe = self.displaced(key)
+    if probe is not None :
+      return probe
+    node = self.node
+    with node.data_lock.rdlocked() :
+      if key in node.data :
+        return 0
+    capacity = self.capacity()
+    probe = key_probe(key) + 1
+    with self._lock :
+      if (capacity is None or self._keys < capacity
+          or probe > self.max_probes) :
+        self._keys += 1
+        return 0
+    return probe
+
+  def mark(self, key, probe, ttl=None) :
+    """Point key at the probe its value was just stored at, with the
+    same ttl as the value"""
+    node = self.node
+    with node.data_lock.rdlocked() :
+      current = displaced_probe(node.data.get(key, ""))
+      expires = key in node.expiry
+    # Only a marker with an expiry needs writing again to follow the
+    # value's
+    if current == probe and ttl is None and not expires :
+      return
+    node.store(key, displaced_marker(probe), ttl)
+    if current is None :
+      node.metrics.count("placement.displaced")
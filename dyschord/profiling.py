@@ -0,0 +1,227 @@
+"""Profilers that can be started and stopped on a running node
+
+Two kinds are available:
+
+* SamplingProfiler periodically samples the stack of every thread and
+  writes the counts in the "collapsed" format used by flamegraph.pl
+  and speedscope.  It is cheap and covers all threads, including the
+  long-running ones.
+
+* DeterministicProfiler runs cProfile in every thread started while
+  it is on, which in the server is each incoming request, and writes
+  pstats files.  A thread still running when it stops turns its own
+  profiler off at its next call, since that's the only thread that
+  can.
+
+Both break the results down by thread, grouping threads by name with
+any trailing number removed, so "request-12" and "request-13" are
+reported together as "request"."""
+
+import cProfile
+import pstats
+import re
+import sys
+import threading
+import time
+import timeit
+
+
+def thread_group(name) :
+  """Group name of a thread, its name without a trailing number"""
+  return re.sub(r"[-_ ]?\d+$", "", name) or name
+
+
+def _frame_label(frame) :
+  code = frame.f_code
+  return "%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class SamplingProfiler(object) :
+  """Samples the stacks of all threads every interval seconds"""
+
+  kind = "sample"
+  extension = ".folded"
+
+  def __init__(self, interval=0.005) :
+    self.interval = interval
+    self.samples = {}
+    self.nsamples = 0
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="profiler")
+    self._thread.daemon = True
+
+  def start(self) :
+    self._thread.start()
+
+  def stop(self) :
+    self._stop_event.set()
+    self._thread.join()
+
+  def _run(self) :
+    me = threading.current_thread().ident
+    while not self._stop_event.is_set() :
+      names = dict((t.ident, t.name) for t in threading.enumerate())
+      for ident, frame in sys._current_frames().iteritems() :
+        if ident == me :
+          continue
+        stack = []
+        while frame is not None :
+          stack.append(_frame_label(frame))
+          frame = frame.f_back
+        stack.append(thread_group(names.get(ident, "unknown")))
+        stack.reverse()
+        key = ";".join(stack)
+        self.samples[key] = self.samples.get(key, 0) + 1
+      self.nsamples += 1
+      self._stop_event.wait(self.interval)
+
+  def write(self, path) :
+    """Write the samples in collapsed stack format"""
+    with open(path, "w") as out :
+      for stack, count in sorted(self.samples.iteritems()) :
+        out.write("%s %d\n" % (stack, count))
+    return [path]
+
+
+class DeterministicProfiler(object) :
+  """Runs cProfile in each thread started while profiling
+
+  Threads started before the profiler (such as the predecessor
+  monitor) can't be profiled this way; use the sampling profiler for
+  those."""
+
+  kind = "deterministic"
+  extension = ".prof"
+  # Threads of the profiling machinery itself
+  ignored = frozenset(["profiler-timer"])
+
+  def __init__(self, grace=1.0) :
+    """Create a profiler
+
+    parameters
+    - grace   Seconds write waits for the threads still running to
+              turn their profilers off.  Those that haven't are left
+              out."""
+    self.grace = grace
+    # (thread, profile, stopped event) for each thread profiled
+    self.profiles = []
+    self._lock = threading.Lock()
+    self._active = False
+
+  def _start_thread_profile(self, frame, event, arg) :
+    # Called by the first profiling event in each new thread.  Swap
+    # ourself out for a real profiler.
+    sys.setprofile(None)
+    thread = threading.current_thread()
+    if not self._active or thread.name in self.ignored :
+      return
+    stopped = threading.Event()
+    def timer() :
+      # cProfile calls this on every event in the thread, so it's
+      # where the thread notices the profiler has stopped
+      if not self._active and not stopped.is_set() :
+        sys.setprofile(None)
+        stopped.set()
+      return timeit.default_timer()
+    profile = cProfile.Profile(timer)
+    with self._lock :
+      self.profiles.append((thread, profile, stopped))
+    profile.enable()
+
+  def start(self) :
+    self._active = True
+    threading.setprofile(self._start_thread_profile)
+
+  def stop(self) :
+    self._active = False
+    threading.setprofile(None)
+
+  def write(self, path) :
+    """Write a pstats file for all threads, plus one per thread group
+
+    Only the profiles that have stopped collecting are included,
+    those of the threads that have finished or noticed the profiler
+    stopped.  Returns the list of files written."""
+    with self._lock :
+      profiles = list(self.profiles)
+    deadline = time.time() + self.grace
+    groups = {}
+    for thread, profile, stopped in profiles :
+      while (thread.is_alive() and not stopped.is_set()
+             and time.time() < deadline) :
+        stopped.wait(0.01)
+      if thread.is_alive() and not stopped.is_set() :
+        continue
+      profile.create_stats()
+      groups.setdefault(thread_group(thread.name), []).append(profile)
+    if not groups :
+      return []
+    written = []
+    combined = None
+    for group, profiles in sorted(groups.iteritems()) :
+      stats = pstats.Stats(*profiles)
+      group_path = "%s.%s" % (path, group)
+      stats.dump_stats(group_path)
+      written.append(group_path)
+      if combined is None :
+        combined = pstats.Stats(*profiles)
+      else :
+        combined.add(*profiles)
+    combined.dump_stats(path)
+    return [path] + written
+
+
+profilers = {SamplingProfiler.kind: SamplingProfiler,
+             DeterministicProfiler.kind: DeterministicProfiler}
+
+
+class ProfileSession(object) :
+  """At most one profiler at a time, stopped automatically after a while"""
+
+  def __init__(self, directory, prefix="dyschord") :
+    self.directory = directory
+    self.prefix = prefix
+    self.profiler = None
+    self.path = None
+    self._timer = None
+    self._lock = threading.Lock()
+
+  def start(self, kind="sample", seconds=30) :
+    """Start a profiler of the given kind for at most seconds
+
+    Returns the path the results will be written to."""
+    try :
+      profiler_class = profilers[kind]
+    except KeyError :
+      raise ValueError("Unknown profiler %s" % kind)
+    with self._lock :
+      if self.profiler is not None :
+        raise RuntimeError("Already profiling to %s" % self.path)
+      self.profiler = profiler_class()
+      self.path = "%s/%s-%s-%s%s" % (
+        self.directory, self.prefix, kind,
+        time.strftime("%Y%m%d-%H%M%S"), profiler_class.extension)
+      self._timer = threading.Timer(seconds, self.stop)
+      self._timer.name = "profiler-timer"
+      self._timer.daemon = True
+      self.profiler.start()
+      self._timer.start()
+      return self.path
+
+  def stop(self) :
+    """Stop the running profiler and write its results
+
+    Returns the list of files written."""
+    with self._lock :
+      if self.profiler is None :
+        return []
+      self._timer.cancel()
+      profiler, self.profiler = self.profiler, None
+      profiler.stop()
+      return profiler.write(self.path)
+
+  def status(self) :
+    with self._lock :
+      if self.profiler is None :
+        return {"running": False}
+      return {"running": True, "kind": self.profiler.kind, "path": self.path}
@@ -2,6 +2,7 @@
 
 from threading import *
 from threading import _get_ident
+from time import time as _time
 
 def RWLock(*args, **kwargs):
     return _RWLock(*args, **kwargs)
@@ -26,19 +27,26 @@ class _RWLock(object):
         self.nr = self.nw = 0 #number of waiting threads
         self.state = 0 #positive is readercount, negative writer count
         self.owning = [] #threads will be few, so a list is not inefficient
+        #called with the seconds spent waiting, whenever a lock has to wait
+        self.wait_observer = None
 
     def wrlock(self, blocking=True):
         """
         Get a Write lock
         """
         me = _get_ident()
+        waited = None
         with self.lock:
             while not self._wrlock(me):
                 if not blocking:
                     return False
+                if waited is None:
+                    waited = _time()
                 self.nw += 1
                 self.wcond.wait()
                 self.nw -= 1
+        if waited is not None and self.wait_observer is not None:
+            self.wait_observer(_time() - waited)
         return True
 
     def _wrlock(self, me):
@@ -56,15 +64,20 @@ class _RWLock(object):
         Read lock the lock
         """
         me = _get_ident()
+        waited = None
         with self.lock:
             while not self._rdlock(me):
                 if not blocking:
                     return False
+                if waited is None:
+                    waited = _time()
                 #keep track of the number of readers waiting to limit
                 #the number of notify_all() calls required.
                 self.nr += 1
                 self.rcond.wait()
                 self.nr -= 1
+        if waited is not None and self.wait_observer is not None:
+            self.wait_observer(_time() - waited)
         return True
 
     def _rdlock(self, me):
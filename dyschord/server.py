@@ -1,34 +1,227 @@
 #!/usr/bin/env python
 
-from SimpleXMLRPCServer import SimpleXMLRPCServer, Fault
+from SimpleXMLRPCServer import (SimpleXMLRPCServer, SimpleXMLRPCRequestHandler,
+                                Fault)
 from SocketServer import ThreadingMixIn
-from xmlrpclib import Binary
+import Queue
 import datetime
+import errno
+import collections
 import sys
 import json
 import threading
 import socket
 import logging
 import logging.config
+import multiprocessing
 import time
+import random
+import itertools
+import tempfile
 import optparse
+import os
+import signal
+import urlparse
+import xmlrpclib
 
 
-from . import readwritelock
+from . import checkpoint as checkpointing
 from . import node as core
+from . import cache as valuecache
+from . import lease
+from . import codec
+from . import compactstore
+from . import metrics
+from . import mux
+from . import placement
+from . import profiling
+from . import spillstore
+from . import trace
 from .client import NodeProxy
+from .overlay import ChordOverlay, make_overlay
 
 # Threaded XML RPC Server
 class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer) :
   """Threading XML-RPC Server"""
 
+  _request_ids = itertools.count(1)
+
+  def process_request(self, request, client_address) :
+    # Same as ThreadingMixIn, but with the threads named so they can be
+    # told apart when profiling.
+    thread = threading.Thread(target=self.process_request_thread,
+                              args=(request, client_address),
+                              name="request-%d" % next(self._request_ids))
+    thread.daemon = self.daemon_threads
+    thread.start()
+
+  # Registry to record the count and latency of every call in
+  metrics = None
+  # Whether to serve the metrics as plain text on GET /metrics
+  metrics_http = False
+
+  def _dispatch(self, method, params) :
+    if (self.metrics is None or method.startswith("_")
+        or not hasattr(self.instance, method)) :
+      # Unknown methods aren't recorded, so garbage requests can't
+      # fill the registry.
+      return SimpleXMLRPCServer._dispatch(self, method, params)
+    start = time.time()
+    try :
+      return SimpleXMLRPCServer._dispatch(self, method, params)
+    except Exception :
+      self.metrics.count("errors." + method)
+      raise
+    finally :
+      self.metrics.observe("requests." + method, time.time() - start)
+
+
+class SharedXMLRPCServer(ThreadedXMLRPCServer) :
+  """Threading XML-RPC Server on a port shared between processes
+
+  Each worker process binds the same port with SO_REUSEPORT, and the
+  kernel spreads the incoming connections between them."""
+
+  def server_bind(self) :
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    ThreadedXMLRPCServer.server_bind(self)
+
+
+class MetricsRequestHandler(SimpleXMLRPCRequestHandler) :
+  """XML-RPC request handler that also serves GET /metrics"""
+
+  def do_GET(self) :
+    if (self.path != "/metrics" or not self.server.metrics_http
+        or self.server.metrics is None) :
+      self.report_404()
+      return
+    response = self.server.metrics.render_text()
+    self.send_response(200)
+    self.send_header("Content-type", "text/plain")
+    self.send_header("Content-length", str(len(response)))
+    self.end_headers()
+    self.wfile.write(response)
+
+
+class InvalidationSender(threading.Thread) :
+  """Sends invalidate calls to the nodes caching keys, off the write
+  path
+
+  Writes only queue them, so they never wait on a subscriber, however
+  slow or dead.  Each pass sends everything queued, just the latest
+  version for each key at each url, and skips the rest of a url's
+  calls once one fails.  The thread starts with the first send."""
+
+  def __init__(self, max_pending=100000, metrics=None,
+               make_proxy=NodeProxy) :
+    """Create a sender
+
+    parameters
+    - max_pending   Invalidations to queue before dropping new ones.
+                    A dropped one leaves the cached value to expire.
+    - metrics       Optional metrics.Registry to count them in
+    - make_proxy    Makes the proxy for a node's url"""
+    threading.Thread.__init__(self, name="InvalidationSender")
+    self.daemon = True
+    self.metrics = metrics
+    self.make_proxy = make_proxy
+    self.logger = logging.getLogger("dyschord.service.invalidations")
+    self._queue = Queue.Queue(max_pending)
+    self._stop_event = threading.Event()
+    self._start_lock = threading.Lock()
+    self._started = False
+
+  def send(self, url, key, version) :
+    if not self._started :
+      with self._start_lock :
+        if not self._started :
+          self._started = True
+          self.start()
+    try :
+      self._queue.put_nowait((url, key, version))
+    except Queue.Full :
+      self._count("invalidations.dropped")
+
+  def _count(self, name) :
+    if self.metrics is not None :
+      self.metrics.count(name)
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      pending = [self._queue.get()]
+      try :
+        while True :
+          pending.append(self._queue.get_nowait())
+      except Queue.Empty :
+        pass
+      latest = collections.OrderedDict()
+      # stop puts None, just to wake the thread
+      for url, key, version in filter(None, pending) :
+        latest.pop((url, key), None)
+        latest[(url, key)] = version
+      proxies = {}
+      failed = set()
+      for (url, key), version in latest.iteritems() :
+        if url in failed :
+          self._count("invalidations.dropped")
+          continue
+        try :
+          if url not in proxies :
+            proxies[url] = self.make_proxy(url)
+          proxies[url].invalidate(key, version)
+        except (socket.error, socket.timeout, Fault), e :
+          self.logger.warn("Unable to invalidate key %s at %s: %s",
+                           key, url, e)
+          failed.add(url)
+          self._count("invalidations.dropped")
+        else :
+          self._count("invalidations.sent")
+
+  def stop(self) :
+    self._stop_event.set()
+    try :
+      self._queue.put_nowait(None)
+    except Queue.Full :
+      # Then it isn't waiting
+      pass
+
 
 class DyschordService(object) :
   """DyschordService handles incoming XML-RPC calls and translates for a node"""
-  def __init__(self, mynode) :
+  def __init__(self, mynode, cache=None, max_subscriptions=100000,
+               leases=None, placement=None) :
+    """Create a new service wrapping mynode
+
+    parameters
+    - mynode             The node to serve
+    - cache              Optional cache.LRUCache for values looked up
+                         from other nodes
+    - max_subscriptions  Maximum number of keys to track cache
+                         subscribers for
+    - leases             Optional lease.LeaseTable for granting
+                         clients read leases
+    - placement          Optional placement.BoundedLoad deciding
+                         whether new keys are stored here"""
     self.node = mynode
+    if mynode.overlay is None :
+      ChordOverlay(mynode)
     self.url = None
     self.logger = logging.getLogger("dyschord.service")
+    self.metrics = mynode.metrics
+    self.metrics.gauge("active_threads", threading.active_count)
+    self.metrics.gauge("data_entries", lambda : len(self.node.data))
+    self.profiles = profiling.ProfileSession(tempfile.gettempdir())
+    self.cache = cache
+    self.subscribers = collections.OrderedDict()
+    self.subscriber_lock = threading.Lock()
+    self.max_subscriptions = max_subscriptions
+    self.leases = leases if leases is not None else lease.NoLeases()
+    self.placement = placement
+    self.invalidations = InvalidationSender(metrics=self.metrics)
+    self.node.write_listeners.append(self._push_invalidations)
+    # Optional trace.TraceWriter for the client operations this node
+    # handles as owner
+    self.trace = None
 
   def ping(self) :
     return {"id": str(self.get_id())}
@@ -36,30 +229,177 @@ class DyschordService(object) :
   def get_id(self) :
     return self.node.id
 
-  def lookup(self, key) :
-    key_hash = self.node.hash_key(key)
+  def _route(self, key_hash) :
+    # Returns None if this node owns key_hash, otherwise the node that
+    # does.
     ntries = 2
     while ntries > 0 :
       ntries -= 1
       try :
         if (self.node.distance(key_hash, self.node.id)
             <= self.node.distance(key_hash, self.node.predecessor.id)) :
-          return self.node[key]
+          return None
+        return self.node.overlay.find_node(key_hash, self._record_hops)
       except (socket.error, socket.timeout) :
         if ntries == 0 :
           self.logger.error("Node pointer corruption!!!")
+          raise
         self.node.repair_predecessor()
         self.node.repair_fingers()
+
+  def _trace(self, operation, key_hash, value=None) :
+    if self.trace is not None :
+      self.trace.record(operation, key_hash, value)
+
+  def _record_hops(self, hops) :
+    self.metrics.observe("routing_hops", hops, metrics.count_bounds)
+
+  def stats(self) :
+    """Counters, latency histograms and gauges for this node"""
+    rslt = self.metrics.snapshot()
+    if self.cache is not None :
+      rslt["cache"] = self.cache.stats()
+    return rslt
+
+  def start_profile(self, kind="sample", seconds=30) :
+    """Start profiling this node for at most seconds
+
+    kind is "sample", for a sampling profiler writing flamegraph
+    collapsed stacks, or "deterministic", for cProfile of the request
+    threads writing pstats files.  Returns the path the results will
+    be written to."""
+    try :
+      return self.profiles.start(kind, seconds)
+    except (ValueError, RuntimeError), e :
+      raise Fault(400, str(e))
+
+  def stop_profile(self) :
+    """Stop profiling early, returning the list of files written"""
+    return self.profiles.stop()
+
+  def profile_status(self) :
+    return self.profiles.status()
+
+  def lookup(self, key) :
+    key_hash = self.node.hash_key(key)
+    target_node = self._route(key_hash)
+    if target_node is None :
+      self._trace(trace.LOOKUP, key_hash)
+      try :
+        value = self.node[key]
       except KeyError, e :
         raise Fault(404, e.message)
-      try :
-        target_node = core.find_node(self.node, key_hash)
-      except (socket.error, socket.timeout) :
-        if ntries == 0 :
-          self.logger.error("Node pointer corruption!!!")
-        self.repair_predecessor()
-        self.repair_fingers()
-    return target_node.lookup(key)
+      probe = placement.displaced_probe(value)
+      if probe is not None :
+        return self.lookup(placement.probe_key(key, probe))
+      return value
+    if self.cache is None :
+      return target_node.lookup(key)
+    try :
+      return self.cache.get(key)[0]
+    except KeyError :
+      pass
+    value, version = target_node.lookup_versioned(key, self.url)
+    self.cache.put(key, value, version)
+    return value
+
+  def lookup_versioned(self, key, subscriber=None) :
+    """Lookup the value and version of key
+
+    If subscriber is the url of a node, it will be sent an invalidate
+    call the next time the key changes."""
+    key_hash = self.node.hash_key(key)
+    target_node = self._route(key_hash)
+    if target_node is not None :
+      return target_node.lookup_versioned(key, subscriber)
+    self._trace(trace.LOOKUP_VERSIONED, key_hash)
+    # Subscribe before reading, so a write in between can't be missed
+    if subscriber is not None :
+      self._subscribe(key, subscriber)
+    try :
+      value, version = self.node.get_versioned(key)
+    except KeyError, e :
+      raise Fault(404, e.message)
+    probe = placement.displaced_probe(value)
+    if probe is not None :
+      return self.lookup_versioned(placement.probe_key(key, probe), subscriber)
+    return [value, version]
+
+  def lookup_if_changed(self, key, version) :
+    """Lookup the value of key, unless it is still at version
+
+    Returns a dictionary with "modified" and "version" entries, plus
+    the "value" if it was modified."""
+    key_hash = self.node.hash_key(key)
+    target_node = self._route(key_hash)
+    if target_node is not None :
+      return target_node.lookup_if_changed(key, version)
+    self._trace(trace.LOOKUP_IF_CHANGED, key_hash)
+    try :
+      value, current = self.node.get_versioned(key)
+    except KeyError, e :
+      raise Fault(404, e.message)
+    probe = placement.displaced_probe(value)
+    if probe is not None :
+      return self.lookup_if_changed(placement.probe_key(key, probe), version)
+    if current == version :
+      return {"modified": False, "version": current}
+    return {"modified": True, "version": current, "value": value}
+
+  def lookup_leased(self, key) :
+    """Lookup the value and version of key along with a read lease
+
+    Returns [value, version, lease], where lease is the number of
+    seconds the caller may cache the value, or 0 if it may not."""
+    key_hash = self.node.hash_key(key)
+    target_node = self._route(key_hash)
+    if target_node is not None :
+      return target_node.lookup_leased(key)
+    self._trace(trace.LOOKUP_LEASED, key_hash)
+    duration = self.leases.grant(key)
+    try :
+      value, version = self.node.get_versioned(key)
+    except KeyError, e :
+      raise Fault(404, e.message)
+    probe = placement.displaced_probe(value)
+    if probe is not None :
+      return self.lookup_leased(placement.probe_key(key, probe))
+    return [value, version, duration]
+
+  def _subscribe(self, key, url) :
+    with self.subscriber_lock :
+      urls = self.subscribers.pop(key, None)
+      if urls is None :
+        urls = set()
+      urls.add(url)
+      self.subscribers[key] = urls
+      while len(self.subscribers) > self.max_subscriptions :
+        # The dropped subscriber's entry will just expire
+        self.subscribers.popitem(last=False)
+
+  def _push_invalidations(self, key, version) :
+    if self.cache is not None :
+      # Only possible if we cached the key before taking ownership of it
+      self.cache.invalidate(key)
+    with self.subscriber_lock :
+      urls = self.subscribers.pop(key, ())
+    for url in urls :
+      if url != self.url :
+        self.invalidations.send(url, key, version)
+
+  def invalidate(self, key, version=None) :
+    if self.cache is not None :
+      self.cache.invalidate(key, version)
+      # A displaced value is also cached under the key it was looked up
+      # by
+      original = placement.original_key(key)
+      if original != key :
+        self.cache.invalidate(original, version)
+
+  def cache_stats(self) :
+    if self.cache is None :
+      return {}
+    return self.cache.stats()
 
   def repair_fingers(self) :
     self.node.repair_fingers()
@@ -67,22 +407,66 @@ class DyschordService(object) :
   def repair_predecessor(self) :
     self.node.repair_predecessor()
 
-  def store(self, key, value) :
+  def store(self, key, value, ttl=None) :
+    """Store value for key, expiring after ttl seconds if given"""
     key_hash = self.node.hash_key(key)
     if (self.node.distance(key_hash, self.node.id)
         <= self.node.distance(key_hash, self.node.predecessor.id)) :
-      self.node[key] = value
+      if self.placement is not None :
+        probe = self.placement.place(key)
+        if probe :
+          # Marking the key only once the value is stored means a
+          # failed store leaves no marker pointing at nothing
+          self.store(placement.probe_key(key, probe), value, ttl)
+          self.placement.mark(key, probe, ttl)
+          return
+      self._trace(trace.STORE, key_hash, value)
+      with self.leases.writing(key) :
+        self.node.store(key, value, ttl)
       return
-    target_node = core.find_node(self.node, key_hash)
-    target_node.store(key, value)
+    target_node = self.node.overlay.find_node(key_hash, self._record_hops)
+    target_node.store(key, value, ttl)
+
+  def store_if(self, key, value, expected_version, ttl=None) :
+    """Store value for key if key is at expected_version
 
-  def store_backup(self, key, value, predecessor) :
+    Returns the new version.  Raises a 409 fault if the version did
+    not match."""
+    key_hash = self.node.hash_key(key)
+    target_node = self._route(key_hash)
+    if target_node is not None :
+      return target_node.store_if(key, value, expected_version, ttl)
+    if self.placement is not None :
+      probe = self.placement.place(key)
+      if probe :
+        version = self.store_if(placement.probe_key(key, probe), value,
+                                expected_version, ttl)
+        self.placement.mark(key, probe, ttl)
+        return version
+    self._trace(trace.STORE_IF, key_hash, value)
+    try :
+      with self.leases.writing(key) :
+        return self.node.set_if(key, value, expected_version, ttl)
+    except core.VersionMismatch, e :
+      raise Fault(409, str(e))
+
+  def store_backup(self, key, value, predecessor, version=None, expiry=None) :
     self.logger.debug("Storing backup of key-value (%s, %s)", key, value)
     self.node.store_backup(key, value,
-                                  self._node_from_descr(predecessor))
+                           self._node_from_descr(predecessor), version, expiry)
+
+  def update_backup(self, data, versions=None, expiries=None) :
+    self.node.update_backup(codec.unpack_batch(data), versions, expiries)
+
+  def merkle_digests(self, indices) :
+    return ["%x" % digest for digest in self.node.merkle_digests(indices)]
 
-  def update_backup(self, data) :
-    self.node.update_backup(data)
+  def merkle_entries(self, buckets, start, end) :
+    return self.node.merkle_entries(buckets, int(start), int(end))
+
+  def fetch_entries(self, keys) :
+    data, versions, expiries = self.node.fetch_entries(keys)
+    return codec.pack_batch(data), versions, expiries
 
   def _serialize_node_descr(self, node) :
     return NodeProxy.to_descr(node)
@@ -93,10 +477,22 @@ class DyschordService(object) :
     return NodeProxy.from_descr(descr)
 
   def find_successor(self, key_hash) :
-    rslt = core.find_node(self.node, key_hash)
+    rslt = self.node.overlay.find_node(int(key_hash), self._record_hops)
     return self._serialize_node_descr(rslt)
 
+  def find_closest(self, key_hash, count, sender=None) :
+    if sender is not None :
+      sender = self._node_from_descr(sender)
+    return [self._serialize_node_descr(node) for node in
+            self.node.find_closest(int(key_hash), count, sender)]
+
+  def koorde_step(self, key_hash, imaginary, shifted) :
+    node, imaginary, shifted, done = self.node.koorde_step(
+      int(key_hash), int(imaginary), shifted)
+    return [self._serialize_node_descr(node), str(imaginary), shifted, done]
+
   def closest_preceding_node(self, key_hash) :
+    key_hash = int(key_hash)
     ntries = 2
     while ntries > 0 :
       ntries -= 1
@@ -132,13 +528,14 @@ class DyschordService(object) :
       NodeProxy.node_translator.from_descr(successor_of_leaving))
 
 
-  def prepend_node(self, node_descr) :
+  def prepend_node(self, node_descr, known_versions=None) :
     node_proxy = self._node_from_descr(node_descr)
     self.logger.debug("Trying to prepend node %d", node_proxy.id)
-    self.node.prepend_node(node_proxy)
+    self.node.prepend_node(node_proxy, known_versions)
     self.logger.debug("Successfully prepended node")
 
-  def setup(self, predecessor, fingers, data) :
+  def setup(self, predecessor, fingers, data, versions=None, expiries=None,
+            unchanged=None) :
     self.logger.debug(
       "Setup called with predecessor %s, fingers %s, and data %s",
       predecessor, fingers, data)
@@ -146,7 +543,7 @@ class DyschordService(object) :
       self._node_from_descr(predecessor),
       dict((int(step), self._node_from_descr(finger))
            for step, finger in fingers.iteritems()),
-      data)
+      codec.unpack_batch(data), versions, expiries, unchanged)
     self.logger.debug("Successfully setup node")
 
   def get_fingers(self) :
@@ -159,8 +556,21 @@ class DyschordService(object) :
   def successor_leaving(self, new_successor) :
     self.node.successor_leaving(self._node_from_descr(new_successor))
 
-  def predecessor_leaving(self, new_predecessor, data) :
-    self.node.predecessor_leaving(self._node_from_descr(new_predecessor), data)
+  def predecessor_leaving(self, new_predecessor, data, versions=None,
+                          expiries=None) :
+    self.node.predecessor_leaving(self._node_from_descr(new_predecessor),
+                                  codec.unpack_batch(data), versions, expiries)
+
+  def get_load(self) :
+    load = self.node.get_load()
+    if self.placement is not None :
+      load["values"] = self.placement.values()
+    return load
+
+  def split_point(self, by="keys") :
+    # Hashes don't fit in XML-RPC integers, so send them as strings
+    rslt = self.node.split_point(by)
+    return str(rslt) if rslt is not None else None
 
   def leave() :
     self.logger.info("Shutting down")
@@ -169,6 +579,8 @@ class DyschordService(object) :
 
 class PredecessorMonitor(threading.Thread) :
   def __init__(self, node, heartbeat=10) :
+    threading.Thread.__init__(self, name="PredecessorMonitor")
+    self.daemon = True
     self.node = node
     self.frequency = heartbeat
     self.logger = logging.getLogger("dyschord.service.link_monitor")
@@ -202,47 +614,388 @@ class PredecessorMonitor(threading.Thread) :
       self._wakeup.notify()
 
 
+class Rebalancer(threading.Thread) :
+  """Moves the node along the ring to split an overloaded successor
+
+  Every interval seconds the successor's load is compared to our own.
+  If it is more than ratio times ours (in either request rate or
+  number of keys), this node leaves and rejoins at the successor's
+  split point, taking over the first half of its range.  After a move
+  the node waits at least cooldown seconds before considering another,
+  so the handoff traffic can't snowball."""
+
+  def __init__(self, node, interval=60, ratio=2.0, min_rate=1.0,
+               min_keys=100, cooldown=600, on_relocate=None) :
+    threading.Thread.__init__(self, name="Rebalancer")
+    self.daemon = True
+    self.node = node
+    self.interval = interval
+    self.ratio = ratio
+    self.min_rate = min_rate
+    self.min_keys = min_keys
+    self.cooldown = cooldown
+    self.on_relocate = on_relocate
+    self.last_move = None
+    self.logger = logging.getLogger("dyschord.service.rebalancer")
+    self._stop_event = threading.Event()
+
+  def _overloaded_by(self, mine, theirs) :
+    # Returns what the successor is overloaded by, if anything
+    if (theirs["requests"] >= self.min_rate
+        and theirs["requests"] > self.ratio * mine["requests"]) :
+      return "requests"
+    if (theirs["keys"] >= self.min_keys
+        and theirs["keys"] > self.ratio * mine["keys"]) :
+      return "keys"
+    return None
+
+  def check(self) :
+    """Relocate if the successor is overloaded
+
+    Returns the new id of the node, or None if it did not move."""
+    now = time.time()
+    if self.last_move is not None and now - self.last_move < self.cooldown :
+      return None
+    successor = self.node.next
+    if successor.id == self.node.id :
+      return None
+    mine = self.node.get_load()
+    theirs = successor.get_load()
+    by = self._overloaded_by(mine, theirs)
+    if by is None :
+      return None
+    split = successor.split_point(by)
+    if split is None :
+      return None
+    split = int(split)
+    self.logger.info(
+      "Successor %d overloaded by %s (%s vs. %s), moving to %d",
+      successor.id, by, theirs, mine, split)
+    old_id = self.node.id
+    try :
+      moved = self.node.relocate(split)
+    finally :
+      # Even a failed move hands off the data, and can leave the node
+      # at another id
+      self.last_move = time.time()
+      if self.node.id != old_id and self.on_relocate is not None :
+        self.on_relocate(old_id, self.node)
+    if not moved :
+      self.logger.warn("Unable to move to %d, back at %d", split, self.node.id)
+      return None
+    return self.node.id
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      # Jitter the checks so neighbors don't all move at once
+      self._stop_event.wait(self.interval * random.uniform(0.5, 1.5))
+      if self._stop_event.is_set() :
+        break
+      try :
+        self.check()
+      except (socket.error, socket.timeout, core.Uninitialized), e :
+        self.logger.warn("Unable to rebalance: %s", e)
+      except Exception :
+        # Keep the thread going, whatever went wrong
+        self.logger.exception("Unable to rebalance")
+
+  def stop(self) :
+    self._stop_event.set()
+
+
+class Reaper(threading.Thread) :
+  """Drops expired keys from the node every interval seconds
+
+  The node's timer wheel hands over just the keys that have come due,
+  so each pass costs nothing when no keys have a ttl.  Reads already
+  skip expired keys, so the interval only bounds how long dead data
+  takes up memory."""
+
+  def __init__(self, node, interval=1.0) :
+    threading.Thread.__init__(self, name="Reaper")
+    self.daemon = True
+    self.node = node
+    self.interval = interval
+    self.logger = logging.getLogger("dyschord.service.reaper")
+    self._stop_event = threading.Event()
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      self._stop_event.wait(self.interval)
+      if self._stop_event.is_set() :
+        break
+      try :
+        dropped = self.node.expire()
+      except Exception :
+        self.logger.exception("Unable to expire keys")
+      else :
+        if dropped :
+          self.logger.debug("Expired %d keys", dropped)
+
+  def stop(self) :
+    self._stop_event.set()
+
+
+class PlacementRefresher(threading.Thread) :
+  """Estimates the average load for a placement.BoundedLoad every
+  refresh_interval seconds
+
+  Counting the node's values and asking its fingers for their loads
+  takes a scan and a round of calls, so it's done here rather than by
+  whichever store happens to find the estimate stale.  Until the
+  first estimate the node takes every key."""
+
+  def __init__(self, placement) :
+    threading.Thread.__init__(self, name="PlacementRefresher")
+    self.daemon = True
+    self.placement = placement
+    self.logger = logging.getLogger("dyschord.service.placement")
+    self._stop_event = threading.Event()
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      try :
+        self.placement.refresh()
+      except Exception :
+        self.logger.exception("Unable to estimate the average load")
+      self._stop_event.wait(self.placement.refresh_interval)
+
+  def stop(self) :
+    self._stop_event.set()
+
+
+class AntiEntropy(threading.Thread) :
+  """Periodically brings the successor's backups of this node's range
+  up to date
+
+  Writes that failed to reach the backup, or that happened while the
+  successor was being replaced, are caught up without resending the
+  whole range, since only the parts of the Merkle trees that differ
+  are compared."""
+
+  def __init__(self, node, interval=60) :
+    threading.Thread.__init__(self, name="AntiEntropy")
+    self.daemon = True
+    self.node = node
+    self.interval = interval
+    self.logger = logging.getLogger("dyschord.service.anti_entropy")
+    self._stop_event = threading.Event()
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      # Jittered like the rebalancer, so a ring started at once doesn't
+      # sync all at once
+      self._stop_event.wait(self.interval * random.uniform(0.5, 1.5))
+      if self._stop_event.is_set() :
+        break
+      successor = self.node.next
+      if successor.id == self.node.id :
+        continue
+      try :
+        sent, taken = self.node.sync_backup(successor)
+      except (socket.error, socket.timeout, Fault), e :
+        self.logger.warn("Unable to sync backups with %d: %s",
+                         successor.id, e)
+      else :
+        if sent or taken :
+          self.logger.info("Synced backups with %d: sent %d, took %d",
+                           successor.id, sent, taken)
+
+  def stop(self) :
+    self._stop_event.set()
+
+
+class Checkpointer(threading.Thread) :
+  """Periodically saves a checkpoint of the node
+
+  The last one is saved on shutdown, but saving as it goes means a
+  node that crashed only has to catch up on what it missed since."""
+
+  def __init__(self, node, path, interval=300) :
+    threading.Thread.__init__(self, name="Checkpointer")
+    self.daemon = True
+    self.node = node
+    self.path = path
+    self.interval = interval
+    self.logger = logging.getLogger("dyschord.service.checkpoint")
+    self._stop_event = threading.Event()
+
+  def save(self, clean=False) :
+    try :
+      count = checkpointing.save(self.node, self.path, clean)
+    except (IOError, OSError), e :
+      self.logger.warn("Unable to save checkpoint %s: %s", self.path, e)
+    else :
+      self.logger.info("Saved %d keys to %s", count, self.path)
+
+  def run(self) :
+    while not self._stop_event.is_set() :
+      self._stop_event.wait(self.interval)
+      if self._stop_event.is_set() :
+        break
+      self.save()
+
+  def stop(self) :
+    self._stop_event.set()
+
+
+def probe_seeds(urls, timeout=1, refused=None) :
+  """Ping all of urls at once, yielding those that answer within
+  timeout seconds as they answer, so fastest first
+
+  Trying them one at a time means waiting out the timeout of every
+  node that's down before getting to one that's up, and this way the
+  join can start as soon as the first one answers.
+
+  parameters
+  - refused   Optional list to add the urls that failed outright to,
+              rather than just being slow"""
+  answers = Queue.Queue()
+  def probe(url) :
+    try :
+      NodeProxy(url, timeout=timeout).ping()
+    except socket.timeout :
+      answers.put(None)
+    except socket.error :
+      if refused is not None :
+        refused.append(url)
+      answers.put(None)
+    else :
+      answers.put(url)
+  for url in urls :
+    thread = threading.Thread(target=probe, args=(url,), name="seed-probe")
+    thread.daemon = True
+    thread.start()
+  deadline = time.time() + timeout
+  for i in xrange(len(urls)) :
+    # Stragglers can still answer, but too late to count
+    remaining = deadline - time.time()
+    if remaining <= 0 :
+      break
+    try :
+      url = answers.get(timeout=remaining)
+    except Queue.Empty :
+      break
+    if url is not None :
+      yield url
+
+
+def probe_seeds_again(urls, timeout=1, retry_timeout=5) :
+  """Like probe_seeds, then if none of those that answered is taken,
+  probe the ones that were only slow again with retry_timeout"""
+  answered = []
+  refused = []
+  for url in probe_seeds(urls, timeout, refused) :
+    answered.append(url)
+    yield url
+  # A seed whose probe was still going when the first round ended
+  # counts as slow
+  slow = [url for url in urls if url not in answered and url not in refused]
+  for url in probe_seeds(slow, retry_timeout) :
+    yield url
+
+
 def start_in_thread(server) :
-  server_main_thread = threading.Thread(target=server.serve_forever)
+  server_main_thread = threading.Thread(target=server.serve_forever,
+                                        name="xmlrpc-server")
   server_main_thread.start()
   return server_main_thread
 
   
   
 def start(port, node=None, cloud_addrs=[], heartbeat=10,
-          log_requests=False, forever=True) :
+          log_requests=False, forever=True, rebalance=None, cache=None,
+          leases=None, metrics_http=False, profile_dir=None, url=None,
+          trace_dir=None, expiry_interval=1.0, anti_entropy_interval=60,
+          overlay=None, bounded_load=None, multiplex=None,
+          shared_port=None, checkpoint=None, bootstrap_timeout=1) :
   if node is None :
     node = core.Node()
-  service = DyschordService(node)
-  service.url = "http://localhost:%d" % port
+  restored = None
+  if checkpoint is not None :
+    # So several servers can share a config file
+    checkpoint = dict(checkpoint, path=checkpoint["path"].format(port=port))
+    restored = checkpointing.load(checkpoint["path"])
+  if restored is not None :
+    # After a crash the successor may still have the old node as its
+    # predecessor, so the position is only taken back after a clean
+    # shutdown.  The data is still worth having either way, since
+    # only what changed is sent.
+    if restored["clean"] :
+      node.id = restored["id"]
+    node.restore(restored["data"], restored["versions"], restored["expiries"])
+    # The old fingers are spread around the ring, so any of them gets
+    # to the successor in a hop or two
+    cloud_addrs = restored["fingers"] + list(cloud_addrs)
+    print "Restored %d keys from %s" % (len(restored["data"]),
+                                        checkpoint["path"])
+  make_overlay(node, overlay)
+  if cache is not None :
+    cache = valuecache.LRUCache(**cache)
+  if leases is not None :
+    leases = lease.LeaseTable(**leases)
+  if bounded_load is not None :
+    bounded_load = placement.BoundedLoad(node, **bounded_load)
+  service = DyschordService(node, cache=cache, leases=leases,
+                            placement=bounded_load)
+  service.profiles = profiling.ProfileSession(
+    profile_dir or tempfile.gettempdir(), "dyschord-%d" % port)
+  if trace_dir is not None :
+    service.trace = trace.TraceWriter(
+      os.path.join(trace_dir, "dyschord-%d.trace" % port))
+  # The url other nodes are told to use, which differs from the port
+  # when the node is behind a proxy
+  service.url = url or "http://localhost:%d" % port
   service.node.url = service.url
   NodeProxy.node_translator.url = service.url
   NodeProxy.node_translator.local_nodes[node.id] = node
+  NodeProxy.metrics = node.metrics
 
   server = ThreadedXMLRPCServer(("localhost", port),
+                                requestHandler=MetricsRequestHandler,
                                 logRequests=log_requests,
                                 allow_none=True)
+  server.metrics = node.metrics
+  server.metrics_http = metrics_http
   server.register_introspection_functions()
   server.register_multicall_functions()
   server.register_instance(service)
 
+  mux_listener = None
+  if multiplex is not None :
+    # Other nodes call this one over a single multiplexed connection
+    # each, on the host of its url.  The port is passed along with the
+    # url, so by default any free one will do.
+    mux_listener = mux.MuxListener(server, multiplex.get("port", 0))
+    service.node.mux = "%s:%d" % (urlparse.urlparse(service.url).hostname,
+                                  mux_listener.address[1])
+    NodeProxy.node_translator.mux = service.node.mux
+
   server_thread = None
+  shared_server = None
+  checkpointer = None
   pred_monitor = None
+  rebalancer = None
+  reaper = None
+  anti_entropy = None
+  placement_refresher = None
   try :
     print "Starting service on port", port
     print "Use Contrl-C to exit"
     server_thread = start_in_thread(server)
+    if mux_listener is not None :
+      mux_listener.start()
+    seeds = []
     for cloud_addr in cloud_addrs :
       # Simple check so I can use the same configuration file for
       # multiple test servers.
-      if cloud_addr == "http://localhost:%d" % port :
-        continue
+      if (cloud_addr not in ("http://localhost:%d" % port, service.url)
+          and cloud_addr not in seeds) :
+        seeds.append(cloud_addr)
+    # If none of them can be joined, give the slow ones the usual
+    # timeout before starting a cloud of my own
+    for cloud_addr in probe_seeds_again(seeds, bootstrap_timeout) :
       neighbor = NodeProxy(cloud_addr)
-      try :
-        neighbor.ping()
-      except (socket.timeout, socket.error) :
-        # Node down.  Try next in list
-        continue
       try :
         successor = core.find_node(neighbor, node.id)
       except (socket.timeout, socket.error) :
@@ -256,7 +1009,11 @@ def start(port, node=None, cloud_addrs=[], heartbeat=10,
       # What if this fails?  How could it fail?
       try :
         print "Connectiong to node %d at %s" % (successor.id, successor.url)
-        successor.prepend_node(service.node)
+        if restored is not None :
+          successor.prepend_node(service.node,
+                                 known_versions=node.known_versions())
+        else :
+          successor.prepend_node(service.node)
       except (socket.timeout, socket.error) :
         # Node might have went down while trying to connect.  Try another.
         print ("Unable to connect to node %d @ %s"
@@ -270,11 +1027,48 @@ def start(port, node=None, cloud_addrs=[], heartbeat=10,
     # All initialized
     service.logger.info("Successfully setup node")
     service.node.initialized = True
+    if shared_port is not None :
+      # Clients can reach any of the host's workers on the shared port.
+      # Other nodes use each worker's own port, given in its url.  It's
+      # only bound now, or the kernel would hand it connections that
+      # would wait for the join.
+      shared_server = SharedXMLRPCServer(("localhost", shared_port),
+                                         requestHandler=MetricsRequestHandler,
+                                         logRequests=log_requests,
+                                         allow_none=True)
+      shared_server.metrics = node.metrics
+      shared_server.metrics_http = metrics_http
+      shared_server.register_introspection_functions()
+      shared_server.register_multicall_functions()
+      shared_server.register_instance(service)
+      start_in_thread(shared_server)
+
+    if rebalance is not None :
+      def update_local_node(old_id, moved) :
+        local_nodes = NodeProxy.node_translator.local_nodes
+        local_nodes.pop(old_id, None)
+        local_nodes[moved.id] = moved
+      rebalancer = Rebalancer(service.node, on_relocate=update_local_node,
+                              **rebalance)
+      rebalancer.start()
 
     # Kick off another thread to monitor the successor and make sure
     # that's always correct...
     pred_monitor = PredecessorMonitor(service.node, heartbeat=heartbeat)
-    pred_monitor.run()
+    pred_monitor.start()
+    reaper = Reaper(service.node, interval=expiry_interval)
+    reaper.start()
+    if bounded_load is not None :
+      placement_refresher = PlacementRefresher(bounded_load)
+      placement_refresher.start()
+    if anti_entropy_interval :
+      anti_entropy = AntiEntropy(service.node, interval=anti_entropy_interval)
+      anti_entropy.start()
+    if checkpoint is not None :
+      checkpointer = Checkpointer(service.node, checkpoint["path"],
+                                  checkpoint.get("interval", 300))
+      if checkpointer.interval :
+        checkpointer.start()
     while forever :
       time.sleep(60)
   except KeyboardInterrupt :
@@ -289,14 +1083,101 @@ def start(port, node=None, cloud_addrs=[], heartbeat=10,
       if pred_monitor is not None :
         logging.debug("Shutting down predecessor monitor")
         pred_monitor.stop()
+      if rebalancer is not None :
+        rebalancer.stop()
+      if reaper is not None :
+        reaper.stop()
+      if placement_refresher is not None :
+        placement_refresher.stop()
+      service.invalidations.stop()
+      if anti_entropy is not None :
+        anti_entropy.stop()
+      if checkpointer is not None :
+        checkpointer.stop()
+        checkpointer.save(clean=True)
+      if shared_server is not None :
+        # Stop taking clients first, so they go to the other workers
+        shared_server.shutdown()
       service.node.leave()
       server.shutdown()
+      if mux_listener is not None :
+        mux_listener.stop()
       if server_thread is not None :
         server_thread.join()
+      if service.trace is not None :
+        service.trace.close()
 
   return service, server_thread
 
 
+def _wait_for_worker(url, pid) :
+  # A worker only answers once it's joined the cloud
+  proxy = NodeProxy(url, timeout=1)
+  while True :
+    try :
+      proxy.get_load()
+      return
+    except (socket.error, xmlrpclib.Fault) :
+      pass
+    if os.waitpid(pid, os.WNOHANG)[0] :
+      raise Exception("Worker at %s exited while starting" % url)
+    time.sleep(0.1)
+
+
+def run_workers(urls, launch) :
+  """Run a worker process for each url, each a separate node
+
+  Each worker owns its own position on the ring, so a request that
+  comes into one worker for a key another owns is routed there like
+  one for any other node, just over localhost.  The workers are started
+  one at a time, each joining through the ones before, so they don't
+  all try to insert themselves at once.  SIGTERM is passed on to the
+  workers, which leave the cloud as they would for a Control-C.
+
+  parameters
+  - urls     Url of each worker
+  - launch   Called in the new process with the worker's index to run
+             it; it shouldn't return until the worker is done"""
+  children = []
+  def forward(signum, frame) :
+    for pid in children :
+      try :
+        os.kill(pid, signal.SIGTERM)
+      except OSError :
+        pass
+  signal.signal(signal.SIGTERM, forward)
+  try :
+    for index, url in enumerate(urls) :
+      pid = os.fork()
+      if pid == 0 :
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        status = 1
+        try :
+          launch(index)
+          status = 0
+        finally :
+          os._exit(status)
+      children.append(pid)
+      _wait_for_worker(url, pid)
+  except KeyboardInterrupt :
+    # Control-C went to the workers as well
+    pass
+  except Exception :
+    forward(None, None)
+    raise
+  finally :
+    for pid in children :
+      while True :
+        try :
+          os.waitpid(pid, 0)
+          break
+        except OSError, e :
+          if e.errno == errno.ECHILD :
+            break
+        except KeyboardInterrupt :
+          pass
+
+
 def main(args=sys.argv) :
   parser = optparse.OptionParser("%prog [OPTIONS] OTHER_NODES")
   parser.add_option("--conf", default="dyschord.conf",
@@ -304,6 +1185,9 @@ def main(args=sys.argv) :
   parser.add_option("-p", "--port", type=int)
   parser.add_option("--id", type=int,
                     help="Id value of node")
+  parser.add_option("--url",
+                    help="Url other nodes should use to reach this one "
+                    "[default: http://localhost:PORT]")
   parser.add_option("--log-config", dest="log_config",
                     help="Logging configuration ini file")
   parser.add_option("--log-requests", dest="log_requests",
@@ -328,6 +1212,8 @@ def main(args=sys.argv) :
     config["port"] = options.port
   if options.id is not None :
     config["node_id"] = options.id
+  if options.url is not None :
+    config["url"] = options.url
 
   metric_name = config.get("metric")
   if metric_name is not None :
@@ -351,12 +1237,120 @@ def main(args=sys.argv) :
 
   NodeProxy.verbose = config.get("proxy_verbose", False)
 
-  node = core.Node(config.get("node_id"), metric=metric)
+  cache = config.get("cache")
+  if cache is True :
+    cache = {}
+  elif not cache :
+    cache = None
+
+  leases = config.get("leases")
+  if leases is True :
+    leases = {}
+  elif not leases :
+    leases = None
+
+  rebalance = config.get("rebalance")
+  if rebalance is True :
+    rebalance = {}
+  elif not rebalance :
+    rebalance = None
+
+  bounded_load = config.get("bounded_load")
+  if bounded_load is True :
+    bounded_load = {}
+  elif not bounded_load :
+    bounded_load = None
+
+  multiplex = config.get("multiplex")
+  if multiplex is True :
+    multiplex = {}
+  elif not multiplex :
+    multiplex = None
+
+  checkpoint = config.get("checkpoint")
+  if isinstance(checkpoint, basestring) :
+    checkpoint = {"path": checkpoint}
+  elif not checkpoint :
+    checkpoint = None
+
+  workers = config.get("workers")
+  if workers is True :
+    workers = {}
+  elif not workers :
+    workers = None
+  elif isinstance(workers, int) :
+    workers = {"count": workers}
+
+  spill = config.get("spill")
+  if spill is True :
+    spill = {}
+  elif not spill :
+    spill = None
+  compact = config.get("compact_store")
+  if compact is True :
+    compact = {}
+  elif not compact :
+    compact = None
+
+  if spill is not None and compact is not None :
+    raise Exception("spill and compact_store can't be used together")
+
+  def launch(port, node_id, url, cloud_addrs, shared_port=None,
+             checkpoint=checkpoint) :
+    store = None
+    if spill is not None :
+      store = spillstore.SpillingStore(**spill)
+    elif compact is not None :
+      store = compactstore.CompactStore(metric.hash_key, **compact)
+
+    node = core.Node(node_id, metric=metric, store=store)
+
+    start(port, node,
+          cloud_addrs=cloud_addrs,
+          heartbeat=config.get("heartbeat", 10),
+          log_requests=config.get("log_requests", False),
+          rebalance=rebalance,
+          cache=cache,
+          leases=leases,
+          metrics_http=config.get("metrics_http", False),
+          profile_dir=config.get("profile_dir"),
+          url=url,
+          trace_dir=config.get("trace_dir"),
+          expiry_interval=config.get("expiry_interval", 1.0),
+          anti_entropy_interval=config.get("anti_entropy_interval", 60),
+          overlay=config.get("overlay"),
+          bounded_load=bounded_load,
+          multiplex=multiplex,
+          shared_port=shared_port,
+          checkpoint=checkpoint,
+          bootstrap_timeout=config.get("bootstrap_timeout", 1))
+
+  port = config.get("port", 10000)
+  cloud_addrs = config.get("cloud_members", [])
+  if workers is None :
+    launch(port, config.get("node_id"), config.get("url"), cloud_addrs)
+    return
 
-  start(config.get("port", 10000), node,
-        cloud_addrs=config.get("cloud_members", []),
-        heartbeat=config.get("heartbeat", 10),
-        log_requests=config.get("log_requests", False))
+  # Each worker listens on a port of its own for the other nodes, and
+  # on the shared port for clients.  Only the first gets node_id, the
+  # rest pick random ids of their own.
+  count = workers.get("count") or multiprocessing.cpu_count()
+  base_port = workers.get("base_port", port + 1)
+  host = "localhost"
+  if config.get("url") :
+    host = urlparse.urlparse(config["url"]).hostname
+  urls = ["http://%s:%d" % (host, base_port + index)
+          for index in range(count)]
+  def launch_worker(index) :
+    worker_checkpoint = checkpoint
+    if checkpoint is not None :
+      # Each worker is a node of its own, with its own checkpoint
+      worker_checkpoint = dict(checkpoint,
+                               path="%s.%d" % (checkpoint["path"], index))
+    launch(base_port + index, config.get("node_id") if index == 0 else None,
+           urls[index], urls[:index] + cloud_addrs, shared_port=port,
+           checkpoint=worker_checkpoint)
+  run_workers(urls, launch_worker)
 
 
 if __name__=="__main__" :
@@ -0,0 +1,279 @@
+"""Offline simulator for routing in large rings
+
+Building a ring of real Nodes costs a lot of memory per node and a
+quadratic number of announcements, which limits experiments to a few
+thousand nodes.  The simulator instead keeps the ring as a sorted list
+of ids with each finger table as an array of indices into it, which
+handles 100,000 nodes with the full 128 fingers.  Fingers are chosen
+with the same compute_finger_steps as Node, and lookups follow the
+same closest preceding node rule as find_predecessor, so hop counts
+match what the real nodes would do.
+
+For each combination of ring size, finger table size and id
+distribution it reports the distribution of lookup hops, how evenly
+the routing load falls on the nodes, and the size of the finger
+tables, as JSON or CSV for plotting."""
+
+import array
+import bisect
+import csv
+import json
+import optparse
+import random
+import sys
+
+from .node import Md5Metric, compute_finger_steps, finger_table_size
+
+
+id_distributions = ("uniform", "even", "clustered")
+
+
+def make_ids(n, distribution="uniform", hash_bits=128, rng=random,
+             clusters=8) :
+  """n distinct node ids, in sorted order
+
+  parameters
+  - distribution   "uniform" for random ids, "even" for evenly spaced
+                   ids, or "clustered" for ids bunched around a few
+                   random points, as when nodes are placed by
+                   rebalancing towards hot ranges
+  - hash_bits      Bits in the ring size
+  - clusters       Number of clusters for the "clustered" distribution"""
+  size = 2**hash_bits
+  if n > size :
+    raise ValueError("Can't fit %d nodes in a ring of %d" % (n, size))
+  if distribution == "even" :
+    offset = rng.randrange(size)
+    return sorted(set((offset + i*size // n) % size for i in xrange(n)))
+  ids = set()
+  if distribution == "uniform" :
+    while len(ids) < n :
+      ids.add(rng.randrange(size))
+  elif distribution == "clustered" :
+    centers = [rng.randrange(size) for i in xrange(clusters)]
+    spread = max(1, size // (clusters * 100))
+    while len(ids) < n :
+      ids.add(int(rng.choice(centers) + rng.gauss(0, spread)) % size)
+  else :
+    raise ValueError("Unknown id distribution %s" % distribution)
+  return sorted(ids)
+
+
+class Ring(object) :
+  """Static ring with complete, correct finger tables"""
+
+  def __init__(self, ids, nfingers=None, metric=None) :
+    """Create a ring from a sorted list of distinct ids
+
+    nfingers and metric are as for Node."""
+    self.metric = metric or Md5Metric()
+    self.size = 2**self.metric.hash_bits
+    self.ids = list(ids)
+    self.finger_steps = compute_finger_steps(self.metric.hash_bits,
+                                             nfingers or finger_table_size)
+    self.fingers = [self._compute_fingers(i) for i in xrange(len(self.ids))]
+
+  def __len__(self) :
+    return len(self.ids)
+
+  def successor_index(self, key_hash) :
+    """Index of the node responsible for key_hash"""
+    return bisect.bisect_left(self.ids, key_hash % self.size) % len(self.ids)
+
+  def _compute_fingers(self, index) :
+    ids = self.ids
+    node_id = ids[index]
+    successor = (index + 1) % len(ids)
+    # Most steps are smaller than the gap to the successor, and all of
+    # those fingers are just the successor.
+    gap = self.metric.distance(node_id, ids[successor]) or self.size
+    near = bisect.bisect_right(self.finger_steps, gap)
+    fingers = array.array("i", [successor] * near)
+    for step in self.finger_steps[near:] :
+      fingers.append(self.successor_index(node_id + step))
+    return fingers
+
+  def closest_preceding_node(self, index, key_hash) :
+    # Same rule as Node.closest_preceding_node, on indices
+    distance = self.metric.distance
+    ids = self.ids
+    node_id = ids[index]
+    distance_from_node = distance(node_id, key_hash)
+    if distance_from_node == 0 :
+      return index - 1 if index else len(ids) - 1
+    distance_to_node = distance(key_hash, node_id)
+    fingers = self.fingers[index]
+    for i in xrange(len(fingers) - 1, -1, -1) :
+      finger = fingers[i]
+      finger_id = ids[finger]
+      if finger_id == key_hash :
+        return finger - 1 if finger else len(ids) - 1
+      if self.finger_steps[i] >= distance_from_node :
+        continue
+      if distance_to_node < distance(key_hash, finger_id) :
+        return finger
+    return index
+
+  def find_predecessor(self, start, key_hash, visited=None) :
+    """Index of the predecessor of key_hash and the hops to reach it
+
+    Same walk as find_predecessor.  If given, visited is called with
+    the index of each node asked for its closest preceding node."""
+    current = start
+    hops = 0
+    while True :
+      if visited is not None :
+        visited(current)
+      next = self.closest_preceding_node(current, key_hash)
+      if next == current :
+        return current, hops
+      current = next
+      hops += 1
+
+  def find_node(self, start, key_hash) :
+    predecessor, hops = self.find_predecessor(start, key_hash)
+    return self.fingers[predecessor][0], hops
+
+  def distinct_fingers(self, index) :
+    return len(set(self.fingers[index]))
+
+
+def _percentile(ordered, fraction) :
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def simulate(nodes, nfingers=None, ids="uniform", lookups=10000,
+             metric=None, rng=random) :
+  """Route random lookups through a ring and summarize the results
+
+  parameters
+  - nodes      Number of nodes in the ring
+  - nfingers   Finger table size
+  - ids        Id distribution, one of id_distributions
+  - lookups    Number of lookups, each from a random node for a random
+               hash
+  - metric     Metric, Md5Metric by default
+  - rng        Source of randomness
+
+  Returns a dictionary of the parameters, hop statistics and
+  histogram, routing load statistics and finger table sizes."""
+  metric = metric or Md5Metric()
+  ring = Ring(make_ids(nodes, ids, metric.hash_bits, rng), nfingers, metric)
+  load = [0] * nodes
+  def visited(index) :
+    load[index] += 1
+  hop_counts = []
+  for i in xrange(lookups) :
+    start = rng.randrange(nodes)
+    key_hash = rng.randrange(ring.size)
+    predecessor, hops = ring.find_predecessor(start, key_hash, visited)
+    hop_counts.append(hops)
+
+  histogram = {}
+  for hops in hop_counts :
+    histogram[hops] = histogram.get(hops, 0) + 1
+  hop_counts.sort()
+  ordered_load = sorted(load)
+  mean_load = float(sum(load)) / nodes
+  distinct = sorted(ring.distinct_fingers(i) for i in xrange(nodes))
+  return {
+    "nodes": nodes,
+    "fingers": len(ring.finger_steps),
+    "ids": ids,
+    "lookups": lookups,
+    "hops_mean": float(sum(hop_counts)) / lookups if lookups else None,
+    "hops_p50": _percentile(hop_counts, 0.5) if lookups else None,
+    "hops_p99": _percentile(hop_counts, 0.99) if lookups else None,
+    "hops_max": hop_counts[-1] if lookups else None,
+    "hops_histogram": histogram,
+    # Calls to closest_preceding_node handled by each node
+    "load_mean": mean_load,
+    "load_p99": _percentile(ordered_load, 0.99),
+    "load_max": ordered_load[-1],
+    "load_imbalance": ordered_load[-1] / mean_load if mean_load else None,
+    "distinct_fingers_mean": float(sum(distinct)) / nodes,
+    "distinct_fingers_max": distinct[-1],
+    # What the finger list of a real Node costs, not counting the
+    # nodes it points to
+    "finger_list_bytes": sys.getsizeof([None] * len(ring.finger_steps)),
+    }
+
+
+summary_fields = ["nodes", "fingers", "ids", "lookups", "hops_mean",
+                  "hops_p50", "hops_p99", "hops_max", "load_mean",
+                  "load_p99", "load_max", "load_imbalance",
+                  "distinct_fingers_mean", "distinct_fingers_max",
+                  "finger_list_bytes"]
+
+
+def write_csv(results, out) :
+  """One row of summary statistics per simulated configuration"""
+  writer = csv.writer(out)
+  writer.writerow(summary_fields)
+  for result in results :
+    writer.writerow([result[field] for field in summary_fields])
+
+
+def write_histogram_csv(results, out) :
+  """Hop histograms, one row per configuration and hop count"""
+  writer = csv.writer(out)
+  writer.writerow(["nodes", "fingers", "ids", "hops", "count"])
+  for result in results :
+    for hops, count in sorted(result["hops_histogram"].iteritems()) :
+      writer.writerow([result["nodes"], result["fingers"], result["ids"],
+                       hops, count])
+
+
+def main(args=sys.argv) :
+  parser = optparse.OptionParser("%prog [OPTIONS]")
+  parser.add_option("-n", "--nodes", default="100,1000,10000",
+                    help="Comma-separated ring sizes [default: %default]")
+  parser.add_option("-f", "--fingers", default=str(finger_table_size),
+                    help="Comma-separated finger table sizes "
+                    "[default: %default]")
+  parser.add_option("--ids", default="uniform",
+                    help="Comma-separated id distributions, from %s "
+                    "[default: %%default]" % ", ".join(id_distributions))
+  parser.add_option("-l", "--lookups", type=int, default=10000,
+                    help="Lookups per configuration [default: %default]")
+  parser.add_option("--hash-bits", dest="hash_bits", type=int, default=128,
+                    help="Bits in the ring size [default: %default]")
+  parser.add_option("--seed", type=int, help="Random seed")
+  parser.add_option("--format", default="json",
+                    help="Output format, json or csv [default: %default]")
+  parser.add_option("-o", "--output",
+                    help="File to write results to [default: standard output]")
+  parser.add_option("--histogram-csv", dest="histogram_csv",
+                    help="File to write the hop histograms to as CSV")
+  options, args = parser.parse_args(args)
+
+  if options.format not in ("json", "csv") :
+    parser.error("Unknown format %s" % options.format)
+  rng = random.Random(options.seed)
+  metric = Md5Metric(options.hash_bits)
+  results = []
+  for nodes in [int(n) for n in options.nodes.split(",")] :
+    for nfingers in [int(f) for f in options.fingers.split(",")] :
+      for ids in options.ids.split(",") :
+        sys.stderr.write("Simulating %d nodes, %d fingers, %s ids\n"
+                         % (nodes, nfingers, ids))
+        results.append(simulate(nodes, nfingers, ids, options.lookups,
+                                metric, rng))
+
+  out = open(options.output, "w") if options.output else sys.stdout
+  try :
+    if options.format == "csv" :
+      write_csv(results, out)
+    else :
+      json.dump(results, out, indent=1, sort_keys=True)
+      out.write("\n")
+  finally :
+    if options.output :
+      out.close()
+  if options.histogram_csv :
+    with open(options.histogram_csv, "w") as out :
+      write_histogram_csv(results, out)
+
+
+if __name__=="__main__" :
+  main()
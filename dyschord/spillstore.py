@@ -0,0 +1,220 @@
+"""Node storage that spills cold values to disk
+
+A SpillingStore can stand in for the dictionary holding a node's
+data.  Values are kept in memory up to a budget in bytes; past that
+the least recently used ones are written to a spill file and read
+back the next time they are looked up.  All the keys stay in memory,
+so routing, range splits and handing data over to other nodes never
+need to read the whole file."""
+
+from collections import MutableMapping, OrderedDict
+import cPickle
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+
+def value_size(value) :
+  """Rough number of bytes a value takes, for the memory budget"""
+  if isinstance(value, str) :
+    return len(value)
+  if isinstance(value, unicode) :
+    # UCS-2 or UCS-4, depending on the build
+    return len(value) * 4
+  if isinstance(value, xmlrpclib.Binary) :
+    return len(value.data)
+  return len(cPickle.dumps(value, 2))
+
+
+class SpillingStore(MutableMapping) :
+
+  def __init__(self, memory_budget=64 << 20, directory=None,
+               compact_threshold=1 << 20) :
+    """Create an empty store
+
+    parameters
+    - memory_budget       Bytes of values to keep in memory
+    - directory           Where to create the spill file, the system
+                          temporary directory by default.  The file is
+                          deleted when the store is closed.
+    - compact_threshold   Bytes of overwritten values the spill file
+                          may hold before it is rewritten, as long as
+                          they are also at least half of it"""
+    self.memory_budget = memory_budget
+    self.directory = directory
+    self.compact_threshold = compact_threshold
+    # key -> (value, size), least recently used first
+    self._resident = OrderedDict()
+    self.resident_bytes = 0
+    # key -> (offset, length) in the spill file
+    self._spilled = {}
+    # Same for the resident values read back from the file and not
+    # changed since, so evicting them again needn't write them
+    self._clean = {}
+    self._file = None
+    self._file_size = 0
+    # Bytes in the spill file no longer referenced
+    self._garbage = 0
+    self.faults = 0
+    self.evictions = 0
+    self.metrics = None
+    self._lock = threading.RLock()
+
+  def register_metrics(self, registry) :
+    """Report the store's state in a metrics.Registry"""
+    self.metrics = registry
+    registry.gauge("store.resident_keys", lambda : len(self._resident))
+    registry.gauge("store.spilled_keys", lambda : len(self._spilled))
+    registry.gauge("store.resident_bytes", lambda : self.resident_bytes)
+    registry.gauge("store.spill_file_bytes", lambda : self._file_size)
+    registry.gauge("store.resident_fraction", self.resident_fraction)
+
+  def resident_fraction(self) :
+    """Fraction of the keys whose values are in memory"""
+    total = len(self._resident) + len(self._spilled)
+    return float(len(self._resident)) / total if total else 1.0
+
+  def __len__(self) :
+    return len(self._resident) + len(self._spilled)
+
+  def __iter__(self) :
+    # Copy the keys, so the caller can modify the store while
+    # iterating, which a dictionary wouldn't allow but is harmless here
+    with self._lock :
+      keys = self._resident.keys() + self._spilled.keys()
+    return iter(keys)
+
+  def __contains__(self, key) :
+    return key in self._resident or key in self._spilled
+
+  def __getitem__(self, key) :
+    with self._lock :
+      try :
+        value, size = self._resident.pop(key)
+      except KeyError :
+        pass
+      else :
+        self._resident[key] = (value, size)
+        return value
+      start = time.time()
+      value = self._read(key)
+      self._clean[key] = self._spilled.pop(key)
+      self._insert(key, value, value_size(value))
+      self.faults += 1
+      if self.metrics is not None :
+        self.metrics.count("store.faults")
+        self.metrics.observe("store.fault", time.time() - start)
+      return value
+
+  def __setitem__(self, key, value) :
+    with self._lock :
+      self._discard(key)
+      self._insert(key, value, value_size(value))
+
+  def __delitem__(self, key) :
+    with self._lock :
+      if not self._discard(key) :
+        raise KeyError(key)
+
+  def iteritems(self) :
+    """Items of the store, reading spilled values without bringing them
+    back into memory"""
+    for key in self :
+      with self._lock :
+        if key in self._resident :
+          value = self._resident[key][0]
+        elif key in self._spilled :
+          value = self._read(key)
+        else :
+          continue
+      yield key, value
+
+  def clear(self) :
+    with self._lock :
+      self._resident.clear()
+      self.resident_bytes = 0
+      self._spilled.clear()
+      self._clean.clear()
+      self._close_file()
+
+  def close(self) :
+    self.clear()
+
+  def _discard(self, key) :
+    # Remove key from wherever it is.  Returns whether it was there.
+    try :
+      value, size = self._resident.pop(key)
+    except KeyError :
+      location = self._spilled.pop(key, None)
+      if location is None :
+        return False
+    else :
+      self.resident_bytes -= size
+      location = self._clean.pop(key, None)
+    if location is not None :
+      self._garbage += location[1]
+      self._maybe_compact()
+    return True
+
+  def _insert(self, key, value, size) :
+    self._resident[key] = (value, size)
+    self.resident_bytes += size
+    # The newest value stays, even if it alone is over the budget
+    while self.resident_bytes > self.memory_budget and len(self._resident) > 1 :
+      self._evict()
+
+  def _evict(self) :
+    key, (value, size) = self._resident.popitem(last=False)
+    self.resident_bytes -= size
+    location = self._clean.pop(key, None)
+    if location is None :
+      if self._file is None :
+        self._file = tempfile.TemporaryFile(prefix="dyschord-spill-",
+                                            dir=self.directory)
+      pickled = cPickle.dumps(value, 2)
+      self._file.seek(self._file_size)
+      self._file.write(pickled)
+      location = (self._file_size, len(pickled))
+      self._file_size += len(pickled)
+    self._spilled[key] = location
+    self.evictions += 1
+    if self.metrics is not None :
+      self.metrics.count("store.evictions")
+
+  def _read(self, key) :
+    offset, length = self._spilled[key]
+    self._file.seek(offset)
+    return cPickle.loads(self._file.read(length))
+
+  def _maybe_compact(self) :
+    if (self._garbage < self.compact_threshold
+        or self._garbage * 2 < self._file_size) :
+      return
+    if not self._spilled and not self._clean :
+      self._close_file()
+      return
+    # Copy the live values to a new file, in file order so the old one
+    # is read sequentially
+    old = self._file
+    self._file = tempfile.TemporaryFile(prefix="dyschord-spill-",
+                                        dir=self.directory)
+    entries = [(location, key, table) for table in (self._spilled, self._clean)
+               for key, location in table.iteritems()]
+    entries.sort(key=lambda entry : entry[0][0])
+    offset = 0
+    for (old_offset, length), key, table in entries :
+      old.seek(old_offset)
+      self._file.write(old.read(length))
+      table[key] = (offset, length)
+      offset += length
+    old.close()
+    self._file_size = offset
+    self._garbage = 0
+
+  def _close_file(self) :
+    if self._file is not None :
+      self._file.close()
+      self._file = None
+    self._file_size = 0
+    self._garbage = 0
@@ -0,0 +1,110 @@
+"""Hierarchical timer wheel
+
+Keeps track of when each of a large number of keys is due, so the ones
+that have come due can be found without scanning all of them.
+Scheduling and cancelling are O(1).  Each level of the wheel is a ring
+of slots, one tick wide on the first level and slots times wider on
+each level above.  A key goes in the lowest level whose range covers
+its due time, and is moved down a level each time the wheel turns past
+the start of its slot, so by the time it is due it is in the first
+level.  Keys due further out than the top level can reach wait in an
+overflow bucket until they come within range."""
+
+import math
+
+
+class TimerWheel(object) :
+
+  def __init__(self, tick=1.0, slots=64, levels=4, now=0) :
+    """Create an empty timer wheel
+
+    parameters
+    - tick     Resolution in seconds.  Keys come due up to a tick late,
+               never early.
+    - slots    Slots on each level
+    - levels   Number of levels.  With the defaults the wheel covers
+               64**4 seconds, about 194 days, before the overflow.
+    - now      Starting time"""
+    self.tick = tick
+    self.slots = slots
+    self.levels = levels
+    self.current = int(math.floor(now / tick))
+    # Ticks covered by a slot on each level
+    self._spans = [slots**level for level in xrange(levels + 1)]
+    self.wheels = [[{} for i in xrange(slots)] for level in xrange(levels)]
+    self.overflow = {}
+    # Keys already due when they were scheduled
+    self._due = {}
+    # Bucket each key is in, so it can be cancelled without a search
+    self._where = {}
+
+  def __len__(self) :
+    return len(self._where)
+
+  def __contains__(self, key) :
+    return key in self._where
+
+  def schedule(self, key, when) :
+    """Schedule key to come due at time when, replacing any earlier
+    schedule for it"""
+    self.cancel(key)
+    due = int(math.ceil(when / self.tick))
+    if due <= self.current :
+      self._due[key] = due
+      self._where[key] = self._due
+    else :
+      self._insert(key, due)
+
+  def cancel(self, key) :
+    bucket = self._where.pop(key, None)
+    if bucket is not None :
+      del bucket[key]
+
+  def _insert(self, key, due) :
+    delta = due - self.current
+    for level in xrange(self.levels) :
+      if delta < self._spans[level + 1] :
+        bucket = self.wheels[level][(due // self._spans[level]) % self.slots]
+        break
+    else :
+      bucket = self.overflow
+    bucket[key] = due
+    self._where[key] = bucket
+
+  def _cascade(self, bucket) :
+    entries = bucket.items()
+    bucket.clear()
+    for key, due in entries :
+      self._insert(key, due)
+
+  def advance(self, now) :
+    """Turn the wheel up to time now
+
+    Returns the keys that have come due, which are no longer
+    scheduled."""
+    target = int(math.floor(now / self.tick))
+    expired = self._due.keys()
+    for key in expired :
+      del self._where[key]
+    self._due.clear()
+    while self.current < target :
+      if not self._where :
+        # Nothing to turn past
+        self.current = target
+        break
+      self.current += 1
+      # Move keys down from every level whose slot boundary we just
+      # crossed, starting at the top so keys can fall through several
+      # levels in one tick.
+      if self.current % self._spans[self.levels] == 0 :
+        self._cascade(self.overflow)
+      for level in xrange(self.levels - 1, 0, -1) :
+        if self.current % self._spans[level] == 0 :
+          self._cascade(self.wheels[level][
+              (self.current // self._spans[level]) % self.slots])
+      slot = self.wheels[0][self.current % self.slots]
+      for key in slot :
+        del self._where[key]
+      expired.extend(slot)
+      slot.clear()
+    return expired
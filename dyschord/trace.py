@@ -0,0 +1,289 @@
+"""Capture and replay of client operations
+
+A node started with a trace directory appends a fixed-size record for
+each client operation it handles as the owner of the key: the time,
+the operation, the MD5 hash of the key and the size of the value
+written.  Forwarded requests are only recorded by the owner, so
+merging the traces of all the nodes gives each operation once.
+
+Only the hashes of the keys are kept, which is enough to reproduce how
+often each key is used but not where it falls on the ring.  Replaying
+uses a made-up key for each hash."""
+
+import heapq
+import itertools
+import optparse
+import Queue
+import random
+import string
+import struct
+import sys
+import threading
+import time
+import xmlrpclib
+
+from . import bench
+from .client import Client
+
+
+MAGIC = "DYTR\x01"
+
+# Operation codes
+LOOKUP = 1
+LOOKUP_VERSIONED = 2
+LOOKUP_IF_CHANGED = 3
+LOOKUP_LEASED = 4
+STORE = 5
+STORE_IF = 6
+
+operation_names = {LOOKUP: "lookup",
+                   LOOKUP_VERSIONED: "lookup_versioned",
+                   LOOKUP_IF_CHANGED: "lookup_if_changed",
+                   LOOKUP_LEASED: "lookup_leased",
+                   STORE: "store",
+                   STORE_IF: "store_if"}
+
+writes = frozenset([STORE, STORE_IF])
+
+# Timestamp, operation, key hash (128 bits, big-endian) and value size
+_record = struct.Struct("<dB16sI")
+
+
+def value_size(value) :
+  """Size in bytes of a stored value, as sent over the wire"""
+  if value is None :
+    return 0
+  if isinstance(value, xmlrpclib.Binary) :
+    return len(value.data)
+  if isinstance(value, unicode) :
+    return len(value.encode("utf-8"))
+  return len(value)
+
+
+def _pack_hash(key_hash) :
+  return ("%032x" % key_hash).decode("hex")
+
+
+def _unpack_hash(packed) :
+  return int(packed.encode("hex"), 16)
+
+
+class TraceWriter(object) :
+  """Appends operation records to a trace file"""
+
+  def __init__(self, path, flush_interval=1.0, clock=time.time) :
+    """Create a new trace file
+
+    parameters
+    - path             File to write, replacing any existing one
+    - flush_interval   Seconds between flushes to disk
+    - clock            Time function, replaceable for testing"""
+    self.path = path
+    self.flush_interval = flush_interval
+    self.clock = clock
+    self.records = 0
+    self._file = open(path, "wb")
+    self._file.write(MAGIC)
+    self._last_flush = clock()
+    self._lock = threading.Lock()
+
+  def record(self, operation, key_hash, value=None) :
+    now = self.clock()
+    packed = _record.pack(now, operation, _pack_hash(key_hash),
+                          value_size(value))
+    with self._lock :
+      if self._file is None :
+        return
+      self._file.write(packed)
+      self.records += 1
+      if now - self._last_flush >= self.flush_interval :
+        self._file.flush()
+        self._last_flush = now
+
+  def close(self) :
+    with self._lock :
+      if self._file is not None :
+        self._file.close()
+        self._file = None
+
+
+def read_trace(path) :
+  """Generate the (timestamp, operation, key hash, value size) records of
+  a trace file
+
+  A partial record at the end, as left by a node that was killed, is
+  ignored."""
+  with open(path, "rb") as trace :
+    if trace.read(len(MAGIC)) != MAGIC :
+      raise ValueError("%s is not a dyschord trace" % path)
+    while True :
+      data = trace.read(_record.size)
+      if len(data) < _record.size :
+        return
+      timestamp, operation, packed, size = _record.unpack(data)
+      yield timestamp, operation, _unpack_hash(packed), size
+
+
+def merge_traces(paths) :
+  """Records of several traces, in time order"""
+  return heapq.merge(*[read_trace(path) for path in paths])
+
+
+class _Payload(object) :
+  # Values of a given JSON-encoded size.  Random letters, so they
+  # don't compress, and nothing that needs escaping.
+  def __init__(self, max_size=1 << 16, rng=random) :
+    self.text = "".join(rng.choice(string.ascii_letters)
+                        for i in xrange(max_size))
+
+  def value(self, size) :
+    # Two of the bytes are the quotes
+    size = max(0, size - 2)
+    while len(self.text) < size :
+      self.text += self.text
+    return self.text[:size]
+
+
+def replay_key(key_hash) :
+  return "trace-%032x" % key_hash
+
+
+def replay(records, peers, speed=1.0, threads=8) :
+  """Perform the operations of a trace against a cloud
+
+  parameters
+  - records   Trace records, in time order
+  - peers     Urls of nodes in the cloud
+  - speed     Multiple of the original rate to replay at, or None to
+              replay as fast as possible
+  - threads   Number of threads performing the operations
+
+  Returns a bench.Recorder of the latencies, another of how late each
+  operation started relative to the schedule, and the elapsed time."""
+  work = Queue.Queue(maxsize=threads * 100)
+  payload = _Payload()
+  recorders = [bench.Recorder() for i in xrange(threads)]
+  lateness = [bench.Recorder() for i in xrange(threads)]
+
+  def worker(recorder, late) :
+    # Values are sent as recorded, so the sizes match the trace
+    client = Client(peers, compress_threshold=None)
+    while True :
+      item = work.get()
+      if item is None :
+        client.close()
+        return
+      scheduled, operation, key_hash, size = item
+      name = operation_names.get(operation, "unknown")
+      start = time.time()
+      if scheduled is not None :
+        late.record(name, max(0, start - scheduled))
+      try :
+        if operation in writes :
+          client.store(replay_key(key_hash), payload.value(size))
+        else :
+          try :
+            client.lookup(replay_key(key_hash))
+          except KeyError :
+            pass
+      except bench.request_errors :
+        recorder.record(name, time.time() - start, error=True)
+        client = bench.reconnect(client, peers, {"compress_threshold": None})
+      else :
+        recorder.record(name, time.time() - start)
+
+  workers = [threading.Thread(target=worker, args=(recorders[i], lateness[i]),
+                              name="replay-%d" % i)
+             for i in xrange(threads)]
+  for thread in workers :
+    thread.daemon = True
+    thread.start()
+  start = time.time()
+  first = None
+  for timestamp, operation, key_hash, size in records :
+    scheduled = None
+    if speed :
+      if first is None :
+        first = timestamp
+      scheduled = start + (timestamp - first) / speed
+      delay = scheduled - time.time()
+      if delay > 0 :
+        time.sleep(delay)
+    work.put((scheduled, operation, key_hash, size))
+  for thread in workers :
+    work.put(None)
+  for thread in workers :
+    thread.join()
+  elapsed = time.time() - start
+
+  rslt = bench.Recorder()
+  late = bench.Recorder()
+  for recorder in recorders :
+    rslt.merge(recorder)
+  for recorder in lateness :
+    late.merge(recorder)
+  return rslt, late, elapsed
+
+
+def main(args=sys.argv) :
+  parser = optparse.OptionParser("%prog [OPTIONS] TRACE_FILES")
+  parser.add_option("-s", "--speed", default="1",
+                    help="Multiple of the recorded rate to replay at, or "
+                    '"max" for as fast as possible [default: %default]')
+  parser.add_option("-n", "--nodes", type=int, default=4,
+                    help="Number of local servers to start [default: %default]")
+  parser.add_option("--base-port", dest="base_port", type=int, default=10000,
+                    help="Port of the first local server [default: %default]")
+  parser.add_option("--peers",
+                    help="Comma-separated urls of an already running cloud, "
+                    "instead of starting local servers")
+  parser.add_option("-t", "--threads", type=int, default=8,
+                    help="Replay threads [default: %default]")
+  parser.add_option("--limit", type=int,
+                    help="Only replay this many operations")
+  parser.add_option("--dump", action="store_true",
+                    help="Print the records instead of replaying them")
+  options, args = parser.parse_args(args)
+  paths = args[1:]
+  if not paths :
+    parser.error("No trace files given")
+
+  records = merge_traces(paths)
+  if options.limit is not None :
+    records = itertools.islice(records, options.limit)
+  if options.dump :
+    for timestamp, operation, key_hash, size in records :
+      print "%.6f %s %032x %d" % (timestamp, operation_names.get(operation),
+                                  key_hash, size)
+    return
+  if options.speed == "max" :
+    speed = None
+  else :
+    speed = float(options.speed)
+
+  cluster = None
+  if options.peers :
+    peers = options.peers.split(",")
+  else :
+    cluster = bench.LocalCluster(options.nodes, options.base_port)
+    peers = cluster.urls
+  try :
+    if cluster is not None :
+      cluster.start()
+    recorder, late, elapsed = replay(records, peers, speed, options.threads)
+  finally :
+    if cluster is not None :
+      cluster.stop()
+
+  print bench.format_report(
+    [("replay", bench.summarize_phase(recorder, elapsed))])
+  lateness = [l for latencies in late.latencies.values() for l in latencies]
+  if lateness :
+    lateness.sort()
+    print ("Started behind schedule: p50 %.2f ms, p99 %.2f ms, max %.2f ms"
+           % (bench.percentile(lateness, 0.5)*1000,
+              bench.percentile(lateness, 0.99)*1000, lateness[-1]*1000))
+
+
+if __name__=="__main__" :
+  main()
@@ -12,7 +12,11 @@ setup(
 
   entry_points = {
     'console_scripts': [
-      'dyschord-server = dyschord.server:main'
+      'dyschord-server = dyschord.server:main',
+      'dyschord-bench = dyschord.bench:main',
+      'dyschord-churn = dyschord.churn:main',
+      'dyschord-replay = dyschord.trace:main',
+      'dyschord-simulate = dyschord.simulator:main',
       ]
     }
   )
@@ -1,8 +1,43 @@
 #!/usr/bin/env python
 
+import itertools
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer
 
 import dyschord
+from dyschord import checkpoint
+from dyschord import codec
+from dyschord import metrics
+from dyschord import placement
+from dyschord import trace
+from dyschord.bench import Workload, ZipfianGenerator, percentile
+from dyschord.cache import LRUCache
+from dyschord.churn import FaultProxy, generate_schedule
+from dyschord.compactstore import CompactStore
+from dyschord.lease import LeaseTable
+from dyschord.merkle import MerkleTree
+from dyschord.metrics import Histogram
+from dyschord.mux import Channel, ChannelPool, MuxListener, MuxServerProxy
+from dyschord.overlay import (ChordOverlay, KademliaOverlay, KoordeOverlay,
+                              make_overlay)
+from dyschord.placement import BoundedLoad
+from dyschord.profiling import ProfileSession, thread_group
+from dyschord.server import (DyschordService, InvalidationSender,
+                             Rebalancer, SharedXMLRPCServer,
+                             ThreadedXMLRPCServer, probe_seeds,
+                             probe_seeds_again, start_in_thread)
+from dyschord.simulator import Ring, simulate
+from dyschord.spillstore import SpillingStore
+from dyschord.timerwheel import TimerWheel
 
 
 
@@ -296,6 +331,1349 @@ class SimpleTest(unittest.TestCase) :
     self.assertRaises(Exception, distributed_hash.join, n)
     
 
+class RebalanceTest(unittest.TestCase) :
+  def setUp(self) :
+    self.metric = dyschord.TrivialMetric(4)
+    self.Node = lambda i=None : dyschord.Node(i, nfingers=1, metric=self.metric)
+    self.nodes = dict((i, self.Node(i)) for i in (0, 3, 12))
+    self.distributed_hash = DistributedHash()
+    for node in self.nodes.itervalues() :
+      self.distributed_hash.join(node)
+    for k in xrange(4, 12) :
+      self.distributed_hash.store(str(k), k)
+
+  def testSplitPoint(self) :
+    self.assertEquals(self.nodes[12].split_point(), 7)
+    self.assertEquals(self.nodes[0].split_point(), None)
+
+  def testRelocate(self) :
+    dh = self.distributed_hash
+    self.nodes[3].relocate(7)
+    self.assertEquals(self.nodes[3].id, 7)
+    self.assertEquals(dh.num_nodes(), 3)
+    self.assertEquals(len(self.nodes[3]), 4)
+    self.assertEquals(len(self.nodes[12]), 4)
+    for k in xrange(4, 12) :
+      self.assertEquals(dh.lookup(str(k)), k)
+
+  def testRelocateFallsBack(self) :
+    dh = self.distributed_hash
+    successor = self.nodes[12]
+    prepend_node = successor.prepend_node
+    def fail_once(node, known_versions=None) :
+      successor.prepend_node = prepend_node
+      raise socket.error("Connection reset")
+    successor.prepend_node = fail_once
+    self.assertFalse(self.nodes[3].relocate(7))
+    # Back where it was, rather than out of the ring
+    self.assertEquals(self.nodes[3].id, 3)
+    self.assertTrue(self.nodes[3].initialized)
+    self.assertEquals(dh.num_nodes(), 3)
+    for k in xrange(4, 12) :
+      self.assertEquals(dh.lookup(str(k)), k)
+
+  def testRebalancer(self) :
+    rebalancer = Rebalancer(self.nodes[3], min_keys=4)
+    self.assertEquals(rebalancer.check(), 7)
+    self.assertEquals(len(self.nodes[12]), 4)
+    # Within the cooldown, so no further moves
+    self.assertEquals(rebalancer.check(), None)
+
+
+class FakeClock(object) :
+  def __init__(self) :
+    self.now = 0.0
+
+  def __call__(self) :
+    return self.now
+
+
+class CacheTest(unittest.TestCase) :
+  def setUp(self) :
+    self.clock = FakeClock()
+    self.cache = LRUCache(max_entries=2, ttl=10, clock=self.clock)
+
+  def testEviction(self) :
+    self.cache.put("a", 1, 1)
+    self.cache.put("b", 2, 1)
+    self.cache.get("a")
+    self.cache.put("c", 3, 1)
+    self.assertEquals(self.cache.get("a"), (1, 1))
+    self.assertRaises(KeyError, self.cache.get, "b")
+    stats = self.cache.stats()
+    self.assertEquals(stats["evictions"], 1)
+    self.assertEquals(stats["hits"], 2)
+    self.assertEquals(stats["misses"], 1)
+
+  def testExpiry(self) :
+    self.cache.put("a", 1, 1)
+    self.clock.now = 11
+    self.assertRaises(KeyError, self.cache.get, "a")
+    self.assertEquals(self.cache.stats()["expirations"], 1)
+
+  def testStaleInvalidation(self) :
+    self.cache.put("a", 1, 1)
+    self.cache.invalidate("a", 2)
+    self.assertRaises(KeyError, self.cache.get, "a")
+    # A slow response with the old version must not be cached
+    self.assertFalse(self.cache.put("a", 1, 1))
+    self.assertTrue(self.cache.put("a", 2, 2))
+    self.assertEquals(self.cache.get("a"), (2, 2))
+
+  def testInvalidationsDontBlockWrites(self) :
+    sent = []
+    slow = threading.Event()
+    class Proxy(object) :
+      def __init__(self, url) :
+        self.url = url
+      def invalidate(self, key, version) :
+        if self.url == "dead" :
+          raise socket.error("Connection refused")
+        slow.wait()
+        sent.append((self.url, key, version))
+    sender = InvalidationSender(make_proxy=Proxy)
+    try :
+      for version in (1, 2, 3) :
+        for url in ("dead", "slow") :
+          sender.send(url, "a", version)
+      # None of the sends waited for the slow node
+      self.assertEquals(sent, [])
+      slow.set()
+      deadline = time.time() + 5
+      while ("slow", "a", 3) not in sent and time.time() < deadline :
+        time.sleep(0.01)
+      # Queued invalidations of the same key are sent once
+      self.assertEquals(sent[-1], ("slow", "a", 3))
+      self.assertTrue(len(sent) <= 2)
+    finally :
+      sender.stop()
+      sender.join()
+
+
+# Overlay handing back the owner's service instead of its node, so
+# services in the same process call each other as they would through
+# NodeProxy
+class ServiceOverlay(object) :
+  def __init__(self, overlay, services) :
+    self.overlay = overlay
+    self.services = services
+
+  def find_node(self, key_hash, record_hops=None) :
+    return self.services[self.overlay.find_node(key_hash, record_hops).url]
+
+  def __getattr__(self, name) :
+    return getattr(self.overlay, name)
+
+
+class ServiceCacheTest(unittest.TestCase) :
+  def setUp(self) :
+    metric = dyschord.TrivialMetric(4)
+    distributed_hash = DistributedHash()
+    self.services = {}
+    for i in (0, 3, 8) :
+      node = dyschord.Node(i, nfingers=1, metric=metric)
+      distributed_hash.join(node)
+      service = DyschordService(node, cache=LRUCache())
+      service.url = node.url = "node-%d" % i
+      service.invalidations = InvalidationSender(
+        metrics=service.metrics, make_proxy=self.services.__getitem__)
+      node.overlay = ServiceOverlay(node.overlay, self.services)
+      self.services[service.url] = service
+    # Key 1 is owned by node 3
+    self.owner = self.services["node-3"]
+    self.router = self.services["node-8"]
+
+  def tearDown(self) :
+    for service in self.services.itervalues() :
+      service.invalidations.stop()
+      if service.invalidations.is_alive() :
+        service.invalidations.join()
+
+  def testRepeatedLookupsAreCached(self) :
+    self.owner.store("1", '"one"')
+    self.assertEquals(self.router.lookup("1"), '"one"')
+    self.assertEquals(self.router.lookup("1"), '"one"')
+    stats = self.router.cache.stats()
+    self.assertEquals(stats["misses"], 1)
+    self.assertEquals(stats["hits"], 1)
+    # The owner answers from its data, not a cache
+    self.assertEquals(self.owner.cache.stats()["misses"], 0)
+    self.assertEquals(len(self.owner.cache), 0)
+
+  def testOwnerWriteInvalidates(self) :
+    self.owner.store("1", '"one"')
+    self.router.lookup("1")
+    self.owner.store("1", '"uno"')
+    counters = self.owner.metrics.snapshot()["counters"]
+    deadline = time.time() + 5
+    while (not counters.get("invalidations.sent")
+           and time.time() < deadline) :
+      time.sleep(0.01)
+      counters = self.owner.metrics.snapshot()["counters"]
+    self.assertEquals(counters.get("invalidations.sent"), 1)
+    self.assertEquals(self.router.cache.stats()["invalidations"], 1)
+    self.assertEquals(self.router.lookup("1"), '"uno"')
+    self.assertEquals(self.router.cache.stats()["misses"], 2)
+
+
+class LeaseTest(unittest.TestCase) :
+  def setUp(self) :
+    self.clock = FakeClock()
+    self.slept = []
+    def sleep(seconds) :
+      self.slept.append(seconds)
+      self.clock.now += seconds
+    self.leases = LeaseTable(duration=2, clock=self.clock, sleep=sleep)
+
+  def testWriteWaitsForLease(self) :
+    self.assertEquals(self.leases.grant("a"), 2)
+    self.clock.now = 0.5
+    with self.leases.writing("a") :
+      self.assertEquals(self.slept, [1.5])
+      # No new leases while the write is in progress
+      self.assertEquals(self.leases.grant("a"), 0)
+    self.assertEquals(self.leases.grant("a"), 2)
+
+  def testUnleasedWrite(self) :
+    self.leases.grant("a")
+    with self.leases.writing("b") :
+      pass
+    self.assertEquals(self.slept, [])
+
+
+# Serves service over XML-RPC on a free port, recording the calls in
+# its metrics
+def serve(service) :
+  server = ThreadedXMLRPCServer(("localhost", 0), logRequests=False,
+                                allow_none=True)
+  server.metrics = service.metrics
+  server.register_instance(service)
+  service.url = "http://localhost:%d" % server.server_address[1]
+  return server, start_in_thread(server)
+
+
+class LeasedClientTest(unittest.TestCase) :
+  def setUp(self) :
+    node = dyschord.Node(0, nfingers=1, metric=dyschord.TrivialMetric(4))
+    DistributedHash(node)
+    self.service = DyschordService(node, leases=LeaseTable(duration=0.5))
+    self.server, self.thread = serve(self.service)
+    self.client = dyschord.Client([self.service.url], min_connections=1,
+                                  cache_size=10, refresh_interval=None)
+
+  def tearDown(self) :
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+  def requests(self) :
+    histograms = self.service.metrics.snapshot()["histograms"]
+    return histograms.get("requests.lookup_leased", {}).get("count", 0)
+
+  def testCachedUnderLease(self) :
+    self.client.store("1", {"a": 1})
+    value = self.client.lookup("1")
+    self.assertEquals(value, {"a": 1})
+    # The decoded object itself, without asking the node again
+    self.assertTrue(self.client.lookup("1") is value)
+    self.assertEquals(self.requests(), 1)
+
+  def testWriteRevokesLease(self) :
+    self.client.store("1", "one")
+    self.assertEquals(self.client.lookup("1"), "one")
+    # The owner's write waits for the client's lease to run out
+    start = time.time()
+    self.service.store("1", codec.encode("uno"))
+    self.assertTrue(time.time() - start > 0.3)
+    self.assertEquals(self.client.lookup("1"), "uno")
+    self.assertEquals(self.requests(), 2)
+
+
+class CodecTest(unittest.TestCase) :
+  def testSmallValue(self) :
+    self.assertEquals(codec.encode_value('"abc"', 10), '"abc"')
+    self.assertEquals(codec.decode_value('"abc"'), '"abc"')
+
+  def testCompressedValue(self) :
+    text = '"%s"' % ("abc"*1000)
+    encoded = codec.encode_value(text, 10)
+    self.assertTrue(len(encoded.data) < len(text))
+    self.assertEquals(codec.decode_value(encoded), text)
+
+  def testBatch(self) :
+    data = {"a": '"x"', "b": codec.encode_value('"%s"' % ("y"*2000))}
+    unpacked = codec.unpack_batch(codec.pack_batch(data))
+    self.assertEquals(unpacked["a"], data["a"])
+    self.assertEquals(codec.decode_value(unpacked["b"]),
+                      codec.decode_value(data["b"]))
+    self.assertEquals(codec.unpack_batch(data), data)
+
+  def testRawValue(self) :
+    data = "\x00\xff" * 10
+    encoded = codec.encode(data, codec.raw_serializer)
+    self.assertEquals(codec.decode(encoded, codec.raw_serializer), data)
+    self.assertRaises(TypeError, codec.decode, encoded)
+    self.assertRaises(TypeError, codec.encode, u"text", codec.raw_serializer)
+
+
+class MetricsTest(unittest.TestCase) :
+  def testHistogram(self) :
+    histogram = Histogram([1, 2, 4, 8])
+    for value in (0.5, 1, 3, 3, 100) :
+      histogram.observe(value)
+    self.assertEquals(histogram.counts, [2, 0, 2, 0, 1])
+    self.assertEquals(histogram.percentile(0.5), 4)
+    self.assertEquals(histogram.percentile(1.0), 100)
+    self.assertEquals(histogram.max, 100)
+
+  def testHopCounts(self) :
+    metric = dyschord.TrivialMetric(4)
+    dh = DistributedHash()
+    nodes = [dyschord.Node(i, nfingers=4, metric=metric) for i in (0, 4, 8, 12)]
+    for node in nodes :
+      dh.join(node)
+    hops = []
+    self.assertEquals(dyschord.find_node(nodes[0], 11, hops.append).id, 12)
+    self.assertEquals(len(hops), 1)
+    self.assertTrue(1 <= hops[0] < len(nodes))
+
+  def testAttributed(self) :
+    @metrics.attributed("outer")
+    def outer() :
+      return metrics.current_activity(), inner()
+    @metrics.attributed("inner")
+    def inner() :
+      return metrics.current_activity()
+    self.assertEquals(outer(), ("outer", "inner"))
+    self.assertEquals(metrics.current_activity(), None)
+
+  def testRepairCounts(self) :
+    node = dyschord.Node(0, nfingers=1, metric=dyschord.TrivialMetric(4))
+    DistributedHash(node)
+    node.repair_predecessor()
+    self.assertEquals(node.metrics.snapshot()["counters"],
+                      {"repair_predecessor": 1})
+
+
+class ProfilingTest(unittest.TestCase) :
+  def setUp(self) :
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self) :
+    shutil.rmtree(self.directory)
+
+  def testThreadGroup(self) :
+    self.assertEquals(thread_group("request-12"), "request")
+    self.assertEquals(thread_group("PredecessorMonitor"), "PredecessorMonitor")
+
+  def _busy_thread(self, name) :
+    def spin() :
+      end = time.time() + 0.2
+      while time.time() < end :
+        pass
+    thread = threading.Thread(target=spin, name=name)
+    thread.start()
+    return thread
+
+  def testSampling(self) :
+    session = ProfileSession(self.directory)
+    path = session.start("sample", seconds=10)
+    self._busy_thread("request-1").join()
+    self.assertEquals(session.stop(), [path])
+    stacks = open(path).read()
+    self.assertTrue("\nrequest;" in "\n" + stacks)
+    self.assertEquals(session.status(), {"running": False})
+
+  def testDeterministic(self) :
+    session = ProfileSession(self.directory)
+    path = session.start("deterministic", seconds=10)
+    self._busy_thread("request-1").join()
+    self.assertEquals(session.stop(), [path, path + ".request"])
+
+  def testDeterministicRunningThread(self) :
+    session = ProfileSession(self.directory)
+    path = session.start("deterministic", seconds=10)
+    done = threading.Event()
+    profilers = []
+    def serve() :
+      while not done.is_set() :
+        time.sleep(0.01)
+      profilers.append(sys.getprofile())
+    thread = threading.Thread(target=serve, name="mux-reader")
+    thread.start()
+    time.sleep(0.05)
+    try :
+      # The thread stops its own profiler, and then it can be written
+      self.assertEquals(session.stop(), [path, path + ".mux-reader"])
+    finally :
+      done.set()
+      thread.join()
+    self.assertEquals(profilers, [None])
+
+
+class VersionTest(unittest.TestCase) :
+  def setUp(self) :
+    self.metric = dyschord.TrivialMetric(4)
+    self.Node = lambda i=None : dyschord.Node(i, nfingers=1, metric=self.metric)
+    self.nodes = dict((i, self.Node(i)) for i in (0, 3, 8))
+    self.distributed_hash = DistributedHash()
+    for node in self.nodes.itervalues() :
+      self.distributed_hash.join(node)
+
+  def testWriteListeners(self) :
+    writes = []
+    self.nodes[3].write_listeners.append(
+      lambda key, version : writes.append((key, version)))
+    self.distributed_hash.store("1", "one")
+    self.distributed_hash.store("1", "uno")
+    self.assertEquals(self.nodes[3].get_versioned("1"), ("uno", 2))
+    self.distributed_hash.delete("1")
+    self.assertEquals(writes, [("1", 1), ("1", 2), ("1", None)])
+
+  def testSetIf(self) :
+    node = self.nodes[3]
+    self.assertEquals(node.set_if("1", "one", 0), 1)
+    self.assertRaises(dyschord.VersionMismatch, node.set_if, "1", "uno", 0)
+    self.assertEquals(node.set_if("1", "uno", 1), 2)
+    self.assertEquals(node.get_versioned("1"), ("uno", 2))
+    # The backup carries the version too
+    self.assertEquals(self.nodes[8].versions["1"], 2)
+
+  def testVersionsSurviveMoves(self) :
+    dh = self.distributed_hash
+    dh.store("1", "one")
+    dh.store("1", "uno")
+    new_node = self.Node(2)
+    dh.join(new_node)
+    self.assertEquals(new_node.get_versioned("1"), ("uno", 2))
+    dh.leave(new_node)
+    self.assertEquals(self.nodes[3].get_versioned("1"), ("uno", 2))
+
+  def testLookupIfChanged(self) :
+    service = DyschordService(self.nodes[3])
+    service.store("1", '"one"')
+    self.assertEquals(service.lookup_if_changed("1", 1),
+                      {"modified": False, "version": 1})
+    service.store("1", '"uno"')
+    self.assertEquals(service.lookup_if_changed("1", 1),
+                      {"modified": True, "version": 2, "value": '"uno"'})
+
+  def testStoreIf(self) :
+    service = DyschordService(self.nodes[3])
+    self.assertEquals(service.store_if("1", '"one"', 0), 1)
+    self.assertEquals(service.store_if("1", '"uno"', 1), 2)
+    self.assertEquals(service.lookup_versioned("1"), ['"uno"', 2])
+
+
+class VersionedClientTest(unittest.TestCase) :
+  def setUp(self) :
+    node = dyschord.Node(0, nfingers=1, metric=dyschord.TrivialMetric(4))
+    DistributedHash(node)
+    service = DyschordService(node)
+    self.server, self.thread = serve(service)
+    self.client = dyschord.Client([service.url], min_connections=1,
+                                  refresh_interval=None)
+
+  def tearDown(self) :
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+  def testLookupIfChanged(self) :
+    client = self.client
+    client.store("1", "one")
+    value, version = client.lookup_versioned("1")
+    self.assertEquals(client.lookup_if_changed("1", version), None)
+    client.store("1", "uno")
+    self.assertEquals(client.lookup_if_changed("1", version),
+                      ("uno", version + 1))
+    self.assertRaises(KeyError, client.lookup_if_changed, "2", 0)
+
+  def testStoreIf(self) :
+    client = self.client
+    self.assertEquals(client.store_if("1", "one", 0), 1)
+    self.assertEquals(client.store_if("1", "uno", 1), 2)
+    self.assertEquals(client.lookup_versioned("1"), ("uno", 2))
+    self.assertRaises(dyschord.VersionConflict,
+                      client.store_if, "1", "dos", 1)
+    self.assertEquals(client.lookup("1"), "uno")
+
+
+class TimerWheelTest(unittest.TestCase) :
+  def setUp(self) :
+    self.wheel = TimerWheel(tick=1.0, slots=4, levels=2)
+
+  def testDueInOrder(self) :
+    wheel = self.wheel
+    # On the first level, the second level and in the overflow
+    for key, when in (("a", 2.5), ("b", 7), ("c", 40)) :
+      wheel.schedule(key, when)
+    self.assertEquals(wheel.advance(2), [])
+    self.assertEquals(wheel.advance(3), ["a"])
+    self.assertEquals(wheel.advance(6.9), [])
+    self.assertEquals(wheel.advance(7), ["b"])
+    self.assertEquals(wheel.advance(39), [])
+    self.assertEquals(wheel.advance(100), ["c"])
+    self.assertEquals(len(wheel), 0)
+
+  def testCancelAndReschedule(self) :
+    wheel = self.wheel
+    wheel.schedule("a", 5)
+    wheel.schedule("b", 5)
+    wheel.cancel("a")
+    wheel.schedule("b", 9)
+    self.assertEquals(wheel.advance(8), [])
+    wheel.schedule("c", 1)
+    self.assertEquals(sorted(wheel.advance(9)), ["b", "c"])
+
+  def testManyKeys(self) :
+    rng = random.Random(1)
+    times = dict((i, rng.uniform(0, 200)) for i in xrange(1000))
+    for key, when in times.iteritems() :
+      self.wheel.schedule(key, when)
+    now = 0
+    while now < 210 :
+      # Never early, and no later than a tick after the previous advance
+      earliest = now - 1
+      now += rng.uniform(0, 10)
+      for key in self.wheel.advance(now) :
+        self.assertTrue(earliest < times[key] <= now)
+        del times[key]
+    self.assertEquals(times, {})
+
+
+class ExpiryTest(unittest.TestCase) :
+  def setUp(self) :
+    self.clock = FakeClock()
+    self.metric = dyschord.TrivialMetric(4)
+    def Node(i=None) :
+      node = dyschord.Node(i, nfingers=1, metric=self.metric)
+      node.clock = self.clock
+      node.timers = TimerWheel(now=self.clock())
+      return node
+    self.Node = Node
+    self.nodes = dict((i, self.Node(i)) for i in (0, 3, 8))
+    self.distributed_hash = DistributedHash()
+    for node in self.nodes.itervalues() :
+      self.distributed_hash.join(node)
+
+  def testExpiry(self) :
+    node = self.nodes[3]
+    writes = []
+    node.write_listeners.append(
+      lambda key, version : writes.append((key, version)))
+    node.store("1", "one", ttl=10)
+    node.store("2", "two")
+    self.assertEquals(self.nodes[8].expiry["1"], 10)
+    self.clock.now = 10
+    # Gone for readers before the reaper runs
+    self.assertRaises(KeyError, node.__getitem__, "1")
+    self.assertTrue("1" not in node)
+    self.assertEquals(node.set_if("1", "uno", 0, ttl=10), 2)
+    self.clock.now = 20
+    for n in self.nodes.itervalues() :
+      n.expire()
+    self.assertTrue("1" not in node.data)
+    self.assertTrue("1" not in self.nodes[8].data)
+    self.assertEquals(node["2"], "two")
+    self.assertEquals(writes, [("1", 1), ("2", 1), ("1", 2), ("1", None)])
+    self.assertEquals(node.metrics.snapshot()["counters"]["expired"], 1)
+
+  def testRewriteClearsTtl(self) :
+    node = self.nodes[3]
+    node.store("1", "one", ttl=10)
+    node.store("1", "uno")
+    self.clock.now = 20
+    node.expire()
+    self.assertEquals(node["1"], "uno")
+    self.assertTrue("1" not in self.nodes[8].expiry)
+
+  def testExpiredNotTransferred(self) :
+    dh = self.distributed_hash
+    self.nodes[3].store("1", "one", ttl=10)
+    self.nodes[3].store("2", "two", ttl=30)
+    self.clock.now = 20
+    new_node = self.Node(2)
+    dh.join(new_node)
+    self.assertEquals(new_node.data, {"2": "two"})
+    self.assertEquals(new_node.expiry, {"2": 30})
+    dh.leave(new_node)
+    self.assertEquals(self.nodes[3].expiry["2"], 30)
+    self.clock.now = 30
+    self.nodes[3].expire()
+    self.assertEquals(self.nodes[3].data, {})
+
+
+class SpillingStoreTest(unittest.TestCase) :
+  def setUp(self) :
+    self.store = SpillingStore(memory_budget=10, compact_threshold=0)
+
+  def tearDown(self) :
+    self.store.close()
+
+  def testSpillAndFault(self) :
+    store = self.store
+    for key in "abcd" :
+      store[key] = key * 4
+    # Only the two most recently used fit
+    self.assertEquals(store.resident_bytes, 8)
+    self.assertEquals(sorted(store), ["a", "b", "c", "d"])
+    self.assertTrue("a" in store)
+    self.assertEquals(store.faults, 0)
+    self.assertEquals(store["a"], "aaaa")
+    self.assertEquals(store.faults, 1)
+    self.assertEquals(store.resident_fraction(), 0.5)
+    self.assertEquals(dict(store.iteritems()),
+                      dict((key, key * 4) for key in "abcd"))
+    # Reading the items doesn't fault anything in
+    self.assertEquals(store.faults, 1)
+
+  def testOverwriteAndDelete(self) :
+    store = self.store
+    for key in "abcd" :
+      store[key] = key * 4
+    store["a"] = "A"
+    del store["b"]
+    self.assertRaises(KeyError, store.__delitem__, "b")
+    self.assertEquals(len(store), 3)
+    self.assertEquals([store[key] for key in "acd"], ["A", "cccc", "dddd"])
+
+  def testReadsDontGrowFile(self) :
+    store = self.store
+    for key in "abcd" :
+      store[key] = key * 4
+    # Once every value has been spilled once, reading them back and
+    # evicting them again reuses the copies in the file
+    for key in "abcd" :
+      store[key]
+    size = store._file_size
+    for i in xrange(10) :
+      for key in "abcd" :
+        self.assertEquals(store[key], key * 4)
+    self.assertEquals(store._file_size, size)
+    # A changed value is written again, and the old copy is garbage
+    store["a"] = "AAAA"
+    for key in "bcd" :
+      store[key]
+    self.assertEquals(store["a"], "AAAA")
+    self.assertEquals(store._file_size - store._garbage, size)
+
+  def testNodeStore(self) :
+    metric = dyschord.TrivialMetric(4)
+    nodes = [dyschord.Node(i, nfingers=1, metric=metric,
+                           store=SpillingStore(memory_budget=10))
+             for i in (0, 8)]
+    dh = DistributedHash()
+    for node in nodes :
+      dh.join(node)
+    for i in xrange(16) :
+      dh.store(str(i), "value %d" % i)
+    self.assertEquals([dh.lookup(str(i)) for i in xrange(16)],
+                      ["value %d" % i for i in xrange(16)])
+    gauges = nodes[0].metrics.snapshot()["gauges"]
+    self.assertEquals(gauges["store.resident_keys"]
+                      + gauges["store.spilled_keys"], 16)
+    dh.leave(nodes[0])
+    self.assertEquals(len(nodes[1]), 16)
+
+
+class CompactStoreTest(unittest.TestCase) :
+  def setUp(self) :
+    self.metric = dyschord.Md5Metric()
+    self.store = CompactStore(self.metric.hash_key, compact_threshold=0)
+
+  def testMatchesDict(self) :
+    rng = random.Random(2)
+    store = self.store
+    expected = {}
+    values = ["", "short", "x" * 300, u"caf\xe9", {"a": [1, 2]}]
+    for i in xrange(5000) :
+      key = "key%d" % rng.randrange(1000)
+      if rng.random() < 0.7 :
+        expected[key] = store[key] = rng.choice(values)
+      elif key in expected :
+        del expected[key]
+        del store[key]
+      else :
+        self.assertRaises(KeyError, store.__delitem__, key)
+    self.assertEquals(len(store), len(expected))
+    self.assertEquals(dict(store.iteritems()), expected)
+    self.assertEquals(dict(store.iterhashes()),
+                      dict((k, self.metric.hash_key(k)) for k in expected))
+    store[u"unicode"] = xmlrpclib.Binary("\x00\x01")
+    self.assertEquals(store[u"unicode"].data, "\x00\x01")
+    self.assertEquals([type(k) for k in store if k == "unicode"], [unicode])
+    self.assertTrue(3 not in store)
+
+  def testFields(self) :
+    store = self.store
+    store["a"] = "value"
+    store.versions["a"] = 3
+    store.expiry["a"] = 10.5
+    self.assertRaises(KeyError, store.versions.__setitem__, "b", 1)
+    # Overwriting, growing the table and compacting keep the fields
+    store["a"] = "a longer value"
+    for i in xrange(100) :
+      store[str(i)] = i
+    self.assertEquals(dict(store.versions), {"a": 3})
+    self.assertEquals(store.expiry["a"], 10.5)
+    del store.expiry["a"]
+    self.assertTrue("a" not in store.expiry)
+    del store["a"]
+    store["a"] = "again"
+    self.assertEquals(store.versions.get("a"), None)
+    store.versions.clear()
+    self.assertEquals(len(store.versions), 0)
+
+  def testNodeStore(self) :
+    metric = dyschord.TrivialMetric(4)
+    Node = lambda i : dyschord.Node(i, nfingers=1, metric=metric,
+                                    store=CompactStore(metric.hash_key))
+    nodes = dict((i, Node(i)) for i in (0, 8))
+    dh = DistributedHash()
+    for node in nodes.itervalues() :
+      dh.join(node)
+    for i in xrange(16) :
+      dh.store(str(i), "value %d" % i)
+    self.assertEquals(len(nodes[0]) + len(nodes[8]), 16)
+    new_node = Node(4)
+    dh.join(new_node)
+    self.assertEquals(sorted(new_node, key=int), ["1", "2", "3", "4"])
+    self.assertEquals(new_node.split_point(), 2)
+    dh.leave(nodes[0])
+    self.assertEquals([dh.lookup(str(i)) for i in xrange(16)],
+                      ["value %d" % i for i in xrange(16)])
+
+  def testNodeKeepsFieldsInStore(self) :
+    metric = dyschord.TrivialMetric(4)
+    Node = lambda i : dyschord.Node(i, nfingers=1, metric=metric,
+                                    store=CompactStore(metric.hash_key))
+    owner, replica = Node(3), Node(8)
+    dh = DistributedHash()
+    dh.join(owner)
+    dh.join(replica)
+    for key in ("1", "2", "3") :
+      dh.store(key, "value " + key)
+    self.assertTrue(owner.versions is owner.data.versions)
+    self.assertEquals(dict(replica.versions), {"1": 1, "2": 1, "3": 1})
+    replica.clock = lambda : 100
+    replica.store("4", "value 4", ttl=10)
+    self.assertEquals(owner.expiry["4"], 110)
+    # The Merkle tree finds the keys through the store's hashes
+    with replica.data_lock.wrlocked() :
+      replica._forget("1")
+    self.assertEquals(owner.sync_backup(replica), (1, 0))
+    self.assertEquals(replica.versions["1"], 1)
+
+
+class MerkleTest(unittest.TestCase) :
+  def setUp(self) :
+    self.metric = dyschord.TrivialMetric(4)
+    self.Node = lambda i=None : dyschord.Node(i, nfingers=1, metric=self.metric)
+    self.nodes = dict((i, self.Node(i)) for i in (0, 3, 8))
+    self.distributed_hash = DistributedHash()
+    for node in self.nodes.itervalues() :
+      self.distributed_hash.join(node)
+
+  def testTree(self) :
+    tree = MerkleTree(hash_bits=8, depth=3)
+    tree.add("a", 5, 1)
+    tree.add("b", 200, 1)
+    self.assertNotEquals(tree.digests[1], 0)
+    tree.remove("a", 5, 1)
+    tree.remove("b", 200, 1)
+    self.assertEquals(set(tree.digests), set([0]))
+    self.assertEquals(list(tree.keys_in(range(8))), [])
+    # (31, 127] is buckets 1 to 3; (200, 40] wraps
+    self.assertEquals(tree.cover(31, 127), [5, 9])
+    self.assertEquals(tree.cover(200, 40), [4, 7])
+
+  def testSyncSendsDifferences(self) :
+    owner, replica = self.nodes[3], self.nodes[8]
+    for key in ("1", "2", "3") :
+      self.distributed_hash.store(key, "value " + key)
+    self.assertEquals(owner.merkle_digests([1]), replica.merkle_digests([1]))
+    self.assertEquals(owner.sync_backup(replica), (0, 0))
+    # Lose a backup, and get a newer version of another at the replica
+    with replica.data_lock.wrlocked() :
+      replica._forget("1")
+    replica.update_backup({"2": "newer"}, {"2": 5})
+    self.assertEquals(owner.sync_backup(replica), (1, 1))
+    self.assertEquals(replica.data["1"], "value 1")
+    self.assertEquals(owner.get_versioned("2"), ("newer", 5))
+    self.assertEquals(owner.sync_backup(replica), (0, 0))
+    self.assertEquals(owner.metrics.snapshot()["counters"]["anti_entropy.sent"],
+                      1)
+
+  def testLeaveSendsOnlyMissing(self) :
+    dh = self.distributed_hash
+    for i in xrange(16) :
+      dh.store(str(i), "value %d" % i)
+    # 8 backs up 3's range (1 to 3), and is already up to date
+    dh.leave(self.nodes[3])
+    self.assertEquals(len(self.nodes[8]), 8)
+    counters = self.nodes[0].metrics.snapshot()["counters"]
+    self.assertEquals(counters.get("anti_entropy.sent", 0), 0)
+
+
+class RestartTest(unittest.TestCase) :
+  def setUp(self) :
+    self.metric = dyschord.TrivialMetric(4)
+    self.Node = lambda i=None : dyschord.Node(i, nfingers=1, metric=self.metric)
+    self.nodes = dict((i, self.Node(i)) for i in (0, 3, 8))
+    self.distributed_hash = DistributedHash()
+    for node in self.nodes.itervalues() :
+      self.distributed_hash.join(node)
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self) :
+    shutil.rmtree(self.dir)
+
+  def testRejoinSendsOnlyChanges(self) :
+    dh = self.distributed_hash
+    for i in xrange(16) :
+      dh.store(str(i), "value %d" % i)
+    path = os.path.join(self.dir, "node-3.checkpoint")
+    self.assertEquals(checkpoint.save(self.nodes[3], path, clean=True), 11)
+    dh.leave(self.nodes[3])
+    dh.store("2", "changed")
+    dh.delete("3")
+
+    state = checkpoint.load(path)
+    self.assertTrue(state["clean"])
+    node = self.Node(state["id"])
+    node.restore(state["data"], state["versions"], state["expiries"])
+    self.nodes[8].prepend_node(node, node.known_versions())
+    node.update_fingers()
+    dyschord.announce(node)
+    self.assertEquals(dh.lookup("1"), "value 1")
+    self.assertEquals(dh.lookup("2"), "changed")
+    self.assertEquals(sorted(node.iterkeys()), ["1", "2"])
+    # Only the changed value came over; the rest, 0's backups
+    # included, were kept from the checkpoint
+    counters = self.nodes[8].metrics.snapshot()["counters"]
+    self.assertEquals(counters["restart.sent"], 1)
+    self.assertEquals(counters["restart.unchanged"], 9)
+
+  def testMissingCheckpoint(self) :
+    self.assertEquals(checkpoint.load(os.path.join(self.dir, "none")), None)
+
+
+class OverlayTest(unittest.TestCase) :
+  def setUp(self) :
+    # Few fingers, so lookups take a few rounds
+    self.distributed_hash = construct_dh(
+      16, lambda : dyschord.Node(nfingers=8))
+    self.nodes = list(self.distributed_hash._iternodes())
+    for node in self.nodes :
+      KademliaOverlay(node, k=4, alpha=2)
+
+  def testKademliaFindsOwner(self) :
+    start = self.nodes[0]
+    for i in xrange(50) :
+      key_hash = start.hash_key(str(i))
+      hops = []
+      owner = start.overlay.find_node(key_hash, hops.append)
+      self.assertEquals(owner.id, dyschord.find_node(start, key_hash).id)
+      self.assertTrue(hops[0] >= 0)
+    # Lookups teach the nodes about each other
+    self.assertTrue(len(start.overlay.contacts())
+                    > len(set(f.id for f in start.fingers)))
+
+  def testBucketsHoldK(self) :
+    overlay = self.nodes[0].overlay
+    for node in self.nodes[1:] :
+      overlay.learn(node)
+    for bucket in overlay.buckets :
+      self.assertTrue(len(bucket) <= 4)
+    overlay.forget(self.nodes[1])
+    self.assertTrue(all(self.nodes[1].id not in bucket
+                        for bucket in overlay.buckets))
+
+  def testKoordeFindsOwner(self) :
+    for degree in (2, 16) :
+      for node in self.nodes :
+        KoordeOverlay(node, degree=degree)
+      for i in xrange(50) :
+        start = self.nodes[i % len(self.nodes)]
+        key_hash = start.hash_key(str(i))
+        owner = start.overlay.find_node(key_hash)
+        self.assertEquals(owner.id, dyschord.find_node(start, key_hash).id)
+      self.assertEquals(len(start.overlay.pointers), degree)
+    self.assertRaises(ValueError, KoordeOverlay, self.nodes[0], degree=8)
+
+  def testMakeOverlay(self) :
+    node = dyschord.Node()
+    self.assertTrue(isinstance(make_overlay(node), ChordOverlay))
+    overlay = make_overlay(node, {"type": "kademlia", "k": 8})
+    self.assertTrue(node.overlay is overlay)
+    self.assertEquals(overlay.k, 8)
+    self.assertRaises(Exception, make_overlay, node, "pastry")
+
+
+class PlacementTest(unittest.TestCase) :
+  def setUp(self) :
+    self.distributed_hash = construct_dh(
+      4, lambda : dyschord.Node(nfingers=8))
+    self.node = list(self.distributed_hash._iternodes())[0]
+    # Full after three keys
+    self.service = DyschordService(
+      self.node, placement=BoundedLoad(self.node, factor=0.01,
+                                       min_capacity=3))
+    self.service.placement.refresh()
+    self.keys = list(itertools.islice(
+      (key for key in (str(i) for i in itertools.count())
+       if self.node._responsible_for(self.node.hash_key(key))), 10))
+
+  def resolve(self, key) :
+    # Follow the markers, as the services would between them
+    while True :
+      value = self.distributed_hash.lookup(key)
+      probe = placement.displaced_probe(value)
+      if probe is None :
+        return value
+      key = placement.probe_key(key, probe)
+
+  def testProbeKeys(self) :
+    key = placement.probe_key(placement.probe_key("a\x7fb", 1), 2)
+    self.assertEquals(placement.key_probe(key), 2)
+    self.assertEquals(placement.original_key(key), "a\x7fb")
+    self.assertEquals(placement.key_probe("a"), 0)
+    # str keys can hold any bytes, unicode ones any characters
+    self.assertEquals(placement.original_key(
+        placement.probe_key("caf\xc3\xa9", 1)), "caf\xc3\xa9")
+    self.assertEquals(placement.key_probe(placement.probe_key(u"caf\xe9", 2)),
+                      2)
+    self.assertEquals(placement.displaced_probe(placement.displaced_marker(3)),
+                      3)
+    self.assertEquals(placement.displaced_probe('"value"'), None)
+
+  def testDisplacesBeyondCapacity(self) :
+    service = self.service
+    for key in self.keys :
+      service.store(key, '"%s"' % key)
+    values = [self.node.data[key] for key in self.keys]
+    markers = [value for value in values
+               if placement.displaced_probe(value) is not None]
+    self.assertEquals(len(markers), len(self.keys) - 3)
+    # A probe can land back on the full node and be displaced again
+    displaced = self.node.metrics.snapshot()["counters"]["placement.displaced"]
+    self.assertTrue(displaced >= len(markers))
+    for key in self.keys :
+      self.assertEquals(self.resolve(key), '"%s"' % key)
+    # Updates follow the marker rather than leaving another
+    key = [key for key, value in zip(self.keys, values)
+           if value in markers][0]
+    service.store(key, '"new"')
+    self.assertEquals(self.resolve(key), '"new"')
+    self.assertEquals(len(self.distributed_hash), len(self.keys) + displaced)
+
+  def testUnboundedUntilRefreshed(self) :
+    # Stores never wait on an estimate; the refresher thread makes it
+    load = BoundedLoad(self.node, factor=0.01, min_capacity=3)
+    self.assertEquals(load.capacity(), None)
+    self.assertEquals([load.place(key) for key in self.keys],
+                      [0] * len(self.keys))
+    load.refresh()
+    self.assertEquals(load.capacity(), 3)
+
+  def testMarkersFollowValues(self) :
+    service = self.service
+    for key in self.keys[:3] :
+      service.store(key, '"%s"' % key)
+    # A failed conditional store leaves no marker behind.  The probe
+    # key has to be on this node too, since the others are bare nodes,
+    # and stay there.
+    service.placement.max_probes = 1
+    owned = lambda key : self.node._responsible_for(self.node.hash_key(key))
+    key = (key for key in (str(i) for i in itertools.count())
+           if key not in self.keys and owned(key)
+           and owned(placement.probe_key(key, 1))).next()
+    self.assertRaises(xmlrpclib.Fault, service.store_if, key, '"value"', 5)
+    self.assertFalse(key in self.node.data)
+    # The marker expires with the value, and follows its ttl
+    self.node.clock = lambda : 100
+    key = self.keys[4]
+    service.store(key, '"value"', ttl=10)
+    self.assertEquals(self.node.expiry[key], 110)
+    self.assertEquals(self.resolve(key), '"value"')
+    service.store(key, '"forever"')
+    self.assertFalse(key in self.node.expiry)
+    self.assertEquals(self.resolve(key), '"forever"')
+
+
+class BenchTest(unittest.TestCase) :
+  def testZipfian(self) :
+    generator = ZipfianGenerator(1000, rng=random.Random(1))
+    draws = [generator.next() for i in xrange(10000)]
+    self.assertTrue(all(0 <= d < 1000 for d in draws))
+    # The most popular item is drawn far more often than average
+    self.assertTrue(draws.count(0) > 50 * len(draws) / 1000)
+
+  def testWorkload(self) :
+    workload = Workload(records=100, read=0.9, update=0.1, value_size=10,
+                        max_value_size=20, value_size_distribution="uniform",
+                        seed=1)
+    operations = [workload.next_operation() for i in xrange(1000)]
+    self.assertEquals(set(operations), set(["read", "update"]))
+    self.assertTrue(operations.count("read") > 800)
+    self.assertTrue(all(10 <= len(workload.next_value()) <= 20
+                        for i in xrange(100)))
+    self.assertNotEquals(workload.next_insert_key(), workload.next_key())
+    self.assertRaises(ValueError, Workload, read=0)
+
+  def testPercentile(self) :
+    ordered = range(1, 1001)
+    self.assertEquals(percentile(ordered, 0.5), 500)
+    self.assertEquals(percentile(ordered, 0.999), 999)
+    self.assertEquals(percentile([7], 0.99), 7)
+
+  def testNodeDescriptions(self) :
+    # md5 ids are too big for XML-RPC integers
+    translation = dyschord.client.ProxyTranslation("http://localhost:1")
+    node = dyschord.Node(2**127 + 1)
+    translation.local_nodes[node.id] = node
+    descr = xmlrpclib.loads(xmlrpclib.dumps(
+        (translation.to_descr(node),)))[0][0]
+    self.assertTrue(translation.from_descr(descr) is node)
+
+
+class SimulatorTest(unittest.TestCase) :
+  def testMatchesNodes(self) :
+    rng = random.Random(2)
+    dh = DistributedHash()
+    nodes = [dyschord.Node(rng.getrandbits(128), nfingers=16)
+             for i in xrange(20)]
+    for node in nodes :
+      dh.join(node)
+    nodes.sort(key=lambda node : node.id)
+    ring = Ring([node.id for node in nodes], 16)
+    self.assertEquals([[ring.ids[f] for f in ring.fingers[i]]
+                       for i in xrange(len(nodes))],
+                      [[f.id for f in node.fingers] for node in nodes])
+    for i in xrange(200) :
+      start = rng.randrange(len(nodes))
+      key_hash = rng.getrandbits(128)
+      hops = []
+      expected = dyschord.find_node(nodes[start], key_hash, hops.append)
+      index, sim_hops = ring.find_node(start, key_hash)
+      self.assertEquals(ring.ids[index], expected.id)
+      self.assertEquals(sim_hops, hops[0])
+
+  def testSimulate(self) :
+    result = simulate(64, 128, "even", lookups=100, rng=random.Random(1))
+    self.assertEquals(sum(result["hops_histogram"].values()), 100)
+    self.assertEquals(result["distinct_fingers_max"], 6)
+    # Evenly spaced, so each finger halves the distance
+    self.assertTrue(result["hops_max"] <= 6)
+
+
+class ChurnTest(unittest.TestCase) :
+  def setUp(self) :
+    self.server = SimpleXMLRPCServer(("localhost", 0), logRequests=False)
+    self.server.register_function(lambda x : x + 1, "increment")
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self) :
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testProxy(self) :
+    proxy = FaultProxy(0, self.server.server_address[1])
+    proxy.start()
+    try :
+      remote = xmlrpclib.ServerProxy(proxy.url)
+      self.assertEquals(remote.increment(1), 2)
+      proxy.partitioned = True
+      self.assertRaises(socket.error, remote.increment, 1)
+      self.assertTrue(proxy.counts["refused"] >= 1)
+      proxy.partitioned = False
+      self.assertEquals(remote.increment(2), 3)
+      # A server that's down looks down through the proxy too
+      unused = socket.socket()
+      unused.bind(("localhost", 0))
+      proxy.target_port = unused.getsockname()[1]
+      unused.close()
+      self.assertRaises(socket.error, remote.increment, 1)
+    finally :
+      proxy.stop()
+
+  def testSchedule(self) :
+    events = generate_schedule(3, 100, 10, 5, random.Random(1))
+    self.assertEquals([e["at"] for e in events[:2]], [10, 15])
+    self.assertEquals([e["action"] for e in events[:2]], ["kill", "start"])
+    self.assertEquals(events[0]["node"], events[1]["node"])
+    down = set()
+    for event in events :
+      if event["action"] == "kill" :
+        down.add(event["node"])
+      else :
+        down.discard(event["node"])
+      # Always leaves at least two running
+      self.assertTrue(len(down) <= 1)
+
+
+class MuxTest(unittest.TestCase) :
+  def setUp(self) :
+    self.server = SimpleXMLRPCServer(("localhost", 0), logRequests=False,
+                                     allow_none=True)
+    def wait(seconds, value) :
+      time.sleep(seconds)
+      return value
+    def fail() :
+      raise ValueError("failed")
+    self.server.register_function(wait, "wait")
+    self.server.register_function(fail, "fail")
+    self.listener = MuxListener(self.server, 0)
+    self.listener.start()
+    self.pool = ChannelPool(timeout=2)
+
+  def tearDown(self) :
+    self.pool.close()
+    self.listener.stop()
+    self.server.server_close()
+
+  def testOutOfOrder(self) :
+    proxy = MuxServerProxy(self.listener.address, pool=self.pool)
+    finished = []
+    def call(seconds, value) :
+      self.assertEquals(proxy.wait(seconds, value), value)
+      finished.append(value)
+    threads = [threading.Thread(target=call, args=(seconds, value))
+               for seconds, value in ((0.4, "slow"), (0.2, "medium"),
+                                      (0, None))]
+    for thread in threads :
+      thread.start()
+    for thread in threads :
+      thread.join()
+    # All over the one connection, without waiting for the slow call
+    self.assertEquals(finished, [None, "medium", "slow"])
+    self.assertEquals(len(self.pool._channels), 1)
+    self.assertRaises(xmlrpclib.Fault, proxy.fail)
+    self.assertEquals(proxy.wait(0, u"after"), u"after")
+
+  def testTimeoutAndReconnect(self) :
+    pool = ChannelPool(timeout=0.1)
+    proxy = MuxServerProxy(self.listener.address, pool=pool)
+    try :
+      self.assertRaises(socket.timeout, proxy.wait, 0.5, 1)
+      self.assertEquals(proxy.wait(0, 2), 2)
+      pool._channels.values()[0].close()
+      self.assertEquals(proxy.wait(0, 3), 3)
+    finally :
+      pool.close()
+
+  def testSendTimeout(self) :
+    # A peer that never reads fills the buffers, and then the send
+    # gives up and fails the channel rather than holding the write lock
+    peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    peer.bind(("localhost", 0))
+    peer.listen(1)
+    channel = Channel(peer.getsockname(), timeout=0.2)
+    try :
+      for i in xrange(100) :
+        if channel.closed :
+          break
+        self.assertRaises(socket.timeout, channel.call, "wait",
+                          (0, "x" * (1 << 20)))
+      self.assertTrue(channel.closed)
+      self.assertRaises(socket.error, channel.call, "wait", (0, 1))
+    finally :
+      channel.close()
+      peer.close()
+
+
+class SharedPortTest(unittest.TestCase) :
+  def testSpreadsConnections(self) :
+    first = SharedXMLRPCServer(("localhost", 0), logRequests=False)
+    port = first.server_address[1]
+    second = SharedXMLRPCServer(("localhost", port), logRequests=False)
+    servers = [first, second]
+    threads = []
+    try :
+      for name, server in zip(("first", "second"), servers) :
+        server.register_function(lambda name=name : name, "name")
+        threads.append(start_in_thread(server))
+      # Each new connection goes to one or the other
+      names = set(xmlrpclib.ServerProxy("http://localhost:%d" % port).name()
+                  for i in range(64))
+      self.assertEquals(names, set(["first", "second"]))
+    finally :
+      for server in servers :
+        server.shutdown()
+        server.server_close()
+      for thread in threads :
+        thread.join()
+
+
+class BootstrapTest(unittest.TestCase) :
+  def testProbeSeeds(self) :
+    servers = []
+    threads = []
+    try :
+      for delay in (0.2, 0, 1.2) :
+        server = SimpleXMLRPCServer(("localhost", 0), logRequests=False)
+        server.register_function(
+          lambda delay=delay : time.sleep(delay) or {"id": "1"}, "ping")
+        servers.append(server)
+        threads.append(start_in_thread(server))
+      urls = ["http://localhost:%d" % server.server_address[1]
+              for server in servers]
+      # Nothing listens on a port just let go of
+      sock = socket.socket()
+      sock.bind(("localhost", 0))
+      dead = "http://localhost:%d" % sock.getsockname()[1]
+      sock.close()
+      start = time.time()
+      # Fastest first, without the dead seed or the one too slow
+      self.assertEquals(list(probe_seeds([dead] + urls, timeout=0.7)),
+                        [urls[1], urls[0]])
+      self.assertTrue(time.time() - start < 1.1)
+    finally :
+      for server in servers :
+        server.shutdown()
+        server.server_close()
+      for thread in threads :
+        thread.join()
+
+  def testProbeSeedsAgain(self) :
+    servers = []
+    threads = []
+    pings = []
+    try :
+      for number, delay in enumerate((0, 1)) :
+        server = ThreadedXMLRPCServer(("localhost", 0), logRequests=False)
+        server.register_function(
+          lambda number=number, delay=delay :
+            pings.append(number) or time.sleep(delay) or {"id": "1"},
+          "ping")
+        servers.append(server)
+        threads.append(start_in_thread(server))
+      urls = ["http://localhost:%d" % server.server_address[1]
+              for server in servers]
+      sock = socket.socket()
+      sock.bind(("localhost", 0))
+      dead = "http://localhost:%d" % sock.getsockname()[1]
+      sock.close()
+      self.assertEquals(list(probe_seeds_again([dead] + urls, 0.5, 3)),
+                        urls)
+      # Only the slow seed was tried again
+      self.assertEquals(sorted(pings), [0, 1, 1])
+    finally :
+      for server in servers :
+        server.shutdown()
+        server.server_close()
+      for thread in threads :
+        thread.join()
+
+
+class ClientTest(unittest.TestCase) :
+  def setUp(self) :
+    self.servers = []
+    self.threads = []
+    self.requests = []
+    for number, delay in enumerate((0, 0, 0.05)) :
+      server = ThreadedXMLRPCServer(("localhost", 0), logRequests=False,
+                                    allow_none=True)
+      def lookup(key, number=number, delay=delay) :
+        self.requests.append(number)
+        time.sleep(delay)
+        return codec.encode(number)
+      server.register_function(lambda number=number : {"id": str(number)},
+                               "ping")
+      server.register_function(lambda : {}, "get_fingers")
+      server.register_function(lookup, "lookup")
+      self.servers.append(server)
+      self.threads.append(start_in_thread(server))
+    self.urls = ["http://localhost:%d" % server.server_address[1]
+                 for server in self.servers]
+
+  def tearDown(self) :
+    for server in self.servers :
+      server.shutdown()
+      server.server_close()
+    for thread in self.threads :
+      thread.join()
+
+  def testPrefersFastPeers(self) :
+    client = dyschord.Client(self.urls, refresh_interval=None)
+    for i in xrange(60) :
+      client.lookup("key")
+    # Once its latency is known, the slow peer loses every pairing
+    self.assertTrue(self.requests.count(2) <= 3, self.requests)
+    self.assertTrue(client.latency[self.urls[2]] > client.latency[self.urls[0]])
+
+  def testDropsAndRefindsPeers(self) :
+    client = dyschord.Client(self.urls[:1], refresh_interval=None)
+    down = self.servers.pop(0)
+    down.shutdown()
+    down.server_close()
+    self.assertRaises(dyschord.ConnectionError, client.lookup, "key")
+    self.assertEquals(client.cloud, {})
+    # Back up on the same port
+    port = int(self.urls[0].rsplit(":", 1)[1])
+    server = ThreadedXMLRPCServer(("localhost", port), logRequests=False)
+    server.register_function(lambda : {"id": "0"}, "ping")
+    server.register_function(lambda : {}, "get_fingers")
+    server.register_function(lambda key : codec.encode("back"), "lookup")
+    self.servers.append(server)
+    self.threads.append(start_in_thread(server))
+    # Out of peers, the request goes back to the seeds itself
+    self.assertEquals(client.lookup("key"), "back")
+    self.assertEquals(client.cloud.keys(), self.urls[:1])
+
+  def testMaintainerStartsOnFirstLoss(self) :
+    client = dyschord.Client(self.urls)
+    try :
+      self.assertEquals(client.maintainer, None)
+      client._drop(self.urls[2])
+      self.assertTrue(client.maintainer.is_alive())
+    finally :
+      client.close()
+    self.assertFalse(client.maintainer.is_alive())
+
+
+class TraceTest(unittest.TestCase) :
+  def setUp(self) :
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self) :
+    shutil.rmtree(self.directory)
+
+  def testRoundTrip(self) :
+    clock = FakeClock()
+    paths = [os.path.join(self.directory, name) for name in ("a", "b")]
+    writers = [trace.TraceWriter(path, clock=clock) for path in paths]
+    clock.now = 1.0
+    writers[0].record(trace.STORE, 2**127 + 5, '"abc"')
+    clock.now = 2.0
+    writers[1].record(trace.LOOKUP, 7)
+    clock.now = 3.0
+    writers[0].record(trace.LOOKUP, 2**127 + 5)
+    for writer in writers :
+      writer.close()
+    self.assertEquals(list(trace.merge_traces(paths)),
+                      [(1.0, trace.STORE, 2**127 + 5, 5),
+                       (2.0, trace.LOOKUP, 7, 0),
+                       (3.0, trace.LOOKUP, 2**127 + 5, 0)])
+
+  def testServiceRecordsOwnedKeys(self) :
+    node = dyschord.Node(0, nfingers=1, metric=dyschord.TrivialMetric(4))
+    DistributedHash(node)
+    service = DyschordService(node)
+    path = os.path.join(self.directory, "trace")
+    service.trace = trace.TraceWriter(path)
+    service.store("1", '"one"')
+    service.lookup("1")
+    service.trace.close()
+    self.assertEquals([(op, key_hash, size) for timestamp, op, key_hash, size
+                       in trace.read_trace(path)],
+                      [(trace.STORE, 1, 5), (trace.LOOKUP, 1, 0)])
+
+
 class WordsTest(unittest.TestCase) :
   def setUp(self) :
     self.distributed_hash = construct_dh(10)